@@ -99,6 +99,8 @@ namespace HeTu
         internal const string QueryRange = "range";
         internal const string MessageResponse = "rsp";
         internal const string MessageUpdate = "updt";
+        internal const string MessageDelta = "delt";
+        internal const string MessageBatch = "bat";
         internal const string MessageSubed = "sub";
         internal const string MessageReject = "rej";
         internal const string MessageError = "err";
@@ -665,9 +667,23 @@ namespace HeTu
                 structuredMsg.Length == 0)
                 return;
 
+            Dispatch(structuredMsg, decodeMetrics);
+        }
+
+        private void Dispatch(object[] structuredMsg, PipelineMetrics decodeMetrics)
+        {
             var messageType = structuredMsg[0] as string;
             switch (messageType)
             {
+                case MessageBatch:
+                    // 服务器开启PUSH_COALESCE_WINDOW时，把多条消息合为一条，按顺序逐条处理
+                    foreach (var message in (object[])structuredMsg[1])
+                    {
+                        if (message is object[] { Length: > 0 } inner)
+                            Dispatch(inner, decodeMetrics);
+                    }
+
+                    break;
                 case MessageResponse:
                 case MessageSubed:
                 case MessageReject:
@@ -676,6 +692,7 @@ namespace HeTu
                     ResponseQueue.CompleteNext(structuredMsg);
                     break;
                 case MessageUpdate:
+                case MessageDelta:
                     // 这个是主动推送，需要根据subID找到对应的订阅对象
                     var subID = (string)structuredMsg[1];
                     if (!Subscriptions.TryGet(subID, out var subscribed))
@@ -686,7 +703,11 @@ namespace HeTu
                         subscribed.CreationTrace,
                         decodeMetrics.SourceSizeBytes,
                         decodeMetrics.TransportSizeBytes);
-                    subscribed.UpdateRows(rows);
+                    // 服务器开启SUBSCRIPTION_DELTA_UPDATES时推送差量
+                    if (messageType == MessageDelta)
+                        subscribed.PatchRows(rows);
+                    else
+                        subscribed.UpdateRows(rows);
                     break;
             }
         }
@@ -102,7 +102,7 @@ namespace HeTu
 
     /// <summary>
     ///     MessagePack 编解码层。
-    ///     对服务器标准协议（<c>rsp/sub/updt</c>）进行轻量解析，复杂负载使用 <see cref="JsonObject" /> 延迟反序列化。
+    ///     对服务器标准协议（<c>rsp/sub/updt/delt/bat</c>）进行轻量解析，复杂负载使用 <see cref="JsonObject" /> 延迟反序列化。
     /// </summary>
     public class JsonbLayer : MessageProcessLayer
     {
@@ -134,12 +134,14 @@ namespace HeTu
             if (count < 2) throw new Exception("数据包格式错误，长度不足2");
             // 2. 读取 Cmd (int)
             var cmd = reader.ReadString();
-            // 服务器标准消息：rsp / sub / updt / rej / err
+            // 服务器标准消息：rsp / sub / updt / delt / rej / err / bat
             // ["rsp", json_data]
             // ["sub", sub_id, struct_data | list[struct_data]]
             // ["updt", sub_id, dict[id, struct_data]]
+            // ["delt", sub_id, dict[id, 变化的属性 | struct_data | null]]
             // ["rej", system_name, code]    —— 业务软拒绝（如限流），连接保持
             // ["err", system_name, reason]  —— 服务端执行失败（仅 debug 模式回传原因）
+            // ["bat", list[message]]        —— 多条消息合批发送
             switch (cmd)
             {
                 case HeTuClientBase.MessageResponse: // list[Any] | dict[Any, Any]
@@ -149,11 +151,26 @@ namespace HeTu
                     }
                 case HeTuClientBase.MessageSubed: // dict[str, Any] | list[dict[str, Any]]
                 case HeTuClientBase.MessageUpdate: // dict[str, dict[str, Any]]
+                case HeTuClientBase.MessageDelta: // dict[str, dict[str, Any] | None]
                     {
                         var subId = reader.ReadString();
                         var jsonData = new JsonObject(ref reader, memory);
                         return new object[] { cmd, subId, jsonData };
                     }
+                case HeTuClientBase.MessageBatch: // list[message]
+                    {
+                        var num = reader.ReadArrayHeader();
+                        var messages = new object[num];
+                        for (var i = 0; i < num; i++)
+                        {
+                            var start = (int)reader.Consumed;
+                            reader.Skip();
+                            var length = (int)reader.Consumed - start;
+                            messages[i] = TryDecodeStandardMessage(memory.Slice(start, length));
+                        }
+
+                        return new object[] { cmd, messages };
+                    }
                 case HeTuClientBase.MessageReject: // ["rej", system_name, code]
                 case HeTuClientBase.MessageError: // ["err", system_name, reason]
                     {
@@ -9,6 +9,7 @@ using System.Collections.Generic;
 using System.Diagnostics;
 using System.Linq;
 using JetBrains.Annotations;
+using MessagePack;
 using R3;
 #if UNITY_2022_3_OR_NEWER
 using UnityEngine;
@@ -141,6 +142,31 @@ namespace HeTu
         /// <param name="data">更新数据。</param>
         public abstract void UpdateRows(JsonObject data);
 
+        /// <summary>
+        ///     应用服务器推送的差量更新（delt 消息）：已有的行只包含变化的属性，
+        ///     新的行是整行，<see langword="null" /> 表示删除。
+        /// </summary>
+        /// <param name="data">差量数据。</param>
+        public abstract void PatchRows(JsonObject data);
+
+        /// <summary>
+        ///     把差量合并到已有的行，返回合并后的新行；没有已有行时，差量就是整行。
+        /// </summary>
+        /// <param name="current">已有的行；可为空。</param>
+        /// <param name="patch">变化的属性。</param>
+        protected static T MergePatch<T>(T current, Dictionary<string, object> patch)
+        {
+            if (current is null)
+                return MessagePackSerializer.Deserialize<T>(
+                    MessagePackSerializer.Serialize(patch));
+            var fields = MessagePackSerializer.Deserialize<Dictionary<string, object>>(
+                MessagePackSerializer.Serialize(current));
+            foreach (var (key, value) in patch)
+                fields[key] = value;
+            return MessagePackSerializer.Deserialize<T>(
+                MessagePackSerializer.Serialize(fields));
+        }
+
         internal void RebindRemote(string subscriptID, HeTuClientBase client)
         {
             if (SubId != subscriptID)
@@ -266,6 +292,15 @@ namespace HeTu
             }
         }
 
+        public override void PatchRows(JsonObject data)
+        {
+            var patches = data.ToDict<long, Dictionary<string, object>>();
+            foreach (var (_, patch) in patches)
+            {
+                Update(patch is null ? default : MergePatch(Data, patch));
+            }
+        }
+
         internal void Rebind(
             string subscriptID,
             T row,
@@ -438,6 +473,22 @@ namespace HeTu
             }
         }
 
+        public override void PatchRows(JsonObject data)
+        {
+            var patches = data.ToDict<long, Dictionary<string, object>>();
+            foreach (var (rowID, patch) in patches)
+            {
+                if (patch is null)
+                {
+                    Update(rowID, default);
+                    continue;
+                }
+
+                Rows.TryGetValue(rowID, out var current);
+                Update(rowID, MergePatch(current, patch));
+            }
+        }
+
         /// <summary>
         ///     获得范围订阅的新增热源，初始行也会先依次发出。
         ///     你需要在本ObserveAdd事件中，通过ObserveRow订阅新增数据，不然只能收到1次初始值。
@@ -194,6 +194,10 @@ namespace Tests.HeTu
             public override void UpdateRows(JsonObject data)
             {
             }
+
+            public override void PatchRows(JsonObject data)
+            {
+            }
         }
     }
 }
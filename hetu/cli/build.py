@@ -36,6 +36,11 @@ class BuildCommand(CommandInterface):
         parser_build.add_argument(
             "--output", metavar="./Components.cs", help=_("输出文件路径"), required=True
         )
+        parser_build.add_argument(
+            "--columnar",
+            action="store_true",
+            help=_("同时生成列式格式(columnar层)的行struct，需要开启unsafe代码"),
+        )
 
     @classmethod
     def execute(cls, args):
@@ -55,5 +60,5 @@ class BuildCommand(CommandInterface):
 
         from hetu.sourcegen.csharp import generate_all_components
 
-        generate_all_components(args.namespace, args.output)
+        generate_all_components(args.namespace, args.output, args.columnar)
         print(_("✅ 已生成C#代码到 {output}").format(output=args.output))
@@ -8,14 +8,21 @@
 import logging
 import random
 import time
+from collections.abc import Callable
+from typing import TYPE_CHECKING
 
 from tabulate import tabulate
 
 from ..i18n import _
 
+if TYPE_CHECKING:
+    from ..data.backend import RaceCondition
+
 logger = logging.getLogger("HeTu.root")
 SLOW_LOG_TIME_THRESHOLD = 1
 SLOW_LOG_RETRY_THRESHOLD = 5
+# 最多统计多少个冲突key，超出后淘汰冲突次数少的一半
+SLOW_LOG_MAX_RACE_KEYS = 10000
 
 
 class InplaceAverage:
@@ -35,11 +42,27 @@ class InplaceAverage:
         self.size -= 1
 
 
+class RaceStat:
+    """单个key的事务冲突统计"""
+
+    __slots__ = ("count", "checks", "systems")
+
+    def __init__(self):
+        self.count = 0
+        # {check_type: count}
+        self.checks: dict[str, int] = {}
+        # {system_name: count}
+        self.systems: dict[str, int] = {}
+
+
 class SlowLog:
     def __init__(self):
         self._time_averages = {}
         self._retry_averages = {}
         self._logged = {}
+        # {key: RaceStat} 各行/索引的冲突统计，用于找出热点数据
+        self._race_keys: dict[str, RaceStat] = {}
+        self._metrics_hook: Callable[[str, RaceCondition], None] | None = None
         # 每个进程都会打印相同内容，所以随机下间隔
         self.log_interval = random.randint(60, 600)
         self._last_clean = time.time()
@@ -48,8 +71,53 @@ class SlowLog:
         self._time_averages.clear()
         self._retry_averages.clear()
         self._logged.clear()
+        self._race_keys.clear()
         self._last_clean = time.time()
 
+    def set_metrics_hook(
+        self, hook: Callable[[str, RaceCondition], None] | None
+    ) -> None:
+        """
+        设置事务冲突的监控回调，每次System调用遇到 `RaceCondition` 都会调用
+        `hook(system_name, race)`，可在此把 `race.key` / `race.check` 上报到
+        Prometheus等监控系统。传入None取消。
+
+        回调在System调用的协程中同步执行，不要做耗时操作。
+        """
+        self._metrics_hook = hook
+
+    def log_race(self, name: str, race: RaceCondition) -> None:
+        """记录一次事务冲突的key和检查类型，按key聚合"""
+        if (hook := self._metrics_hook) is not None:
+            try:
+                hook(name, race)
+            except Exception as e:
+                logger.error(
+                    _("❌ [📞慢日志] 冲突监控回调异常: {err}").format(err=repr(e))
+                )
+        key = race.key
+        if key is None:
+            return
+        if (stat := self._race_keys.get(key)) is None:
+            if len(self._race_keys) >= SLOW_LOG_MAX_RACE_KEYS:
+                self._evict_race_keys()
+            stat = self._race_keys[key] = RaceStat()
+        stat.count += 1
+        check = race.check or "?"
+        stat.checks[check] = stat.checks.get(check, 0) + 1
+        stat.systems[name] = stat.systems.get(name, 0) + 1
+
+    def _evict_race_keys(self):
+        ranked = sorted(self._race_keys.items(), key=lambda x: x[1].count)
+        for key, _stat in ranked[: len(ranked) // 2]:
+            del self._race_keys[key]
+
+    def hot_keys(self, top: int = 20) -> list[tuple[str, RaceStat]]:
+        """返回冲突次数最多的top个key，及其统计"""
+        return sorted(self._race_keys.items(), key=lambda x: x[1].count, reverse=True)[
+            :top
+        ]
+
     def log(self, elapsed, name, retry):
         # 每小时清理一次，防止InplaceAverage的数据越来越不准
         now = time.time()
@@ -91,12 +159,29 @@ class SlowLog:
         tops = [name for name, avg in slow20]
         tops.extend(name for name, avg in retry20 if name not in tops)
         rows = [
-            (name, self._time_averages[name].value, self._time_averages[name].value)
+            (name, self._time_averages[name].value, self._retry_averages[name].value)
             for name in tops
         ]
-        return tabulate(
+        table = tabulate(
             rows,
             headers=[_("系统"), _("平均时间"), _("平均冲突次数")],
             tablefmt="github",
             floatfmt=".2f",
         )
+        if not self._race_keys:
+            return table
+
+        def _fmt(counts: dict[str, int]) -> str:
+            ranked = sorted(counts.items(), key=lambda x: x[1], reverse=True)
+            return ", ".join(f"{k}:{v}" for k, v in ranked[:3])
+
+        key_rows = [
+            (key, stat.count, _fmt(stat.checks), _fmt(stat.systems))
+            for key, stat in self.hot_keys()
+        ]
+        key_table = tabulate(
+            key_rows,
+            headers=[_("冲突Key"), _("冲突次数"), _("检查类型"), _("系统")],
+            tablefmt="github",
+        )
+        return f"{table}\n\n{key_table}"
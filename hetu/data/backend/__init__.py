@@ -10,6 +10,7 @@ from . import sql as _  # noqa: F401,F811 注册sql后端，但不导出
 from .base import (
     BackendClient,
     BackendClientFactory,
+    BoundViolation,
     MQClient,
     RaceCondition,
     RowFormat,
@@ -23,6 +24,7 @@ from .table import Table, TableReference
 __all__ = [
     "RaceCondition",
     "UniqueViolation",
+    "BoundViolation",
     "RowFormat",
     "BackendClient",
     "Backend",
@@ -31,9 +31,12 @@
 
 """
 
+import asyncio
 import hashlib
 import logging
+import time
 import warnings
+from collections.abc import Iterable
 from contextlib import AbstractContextManager
 from dataclasses import dataclass
 from enum import Enum
@@ -41,6 +44,7 @@ from typing import TYPE_CHECKING, Any, Literal, final, overload
 
 import numpy as np
 
+from ...common.multimap import MultiMap
 from ...i18n import _
 
 if TYPE_CHECKING:
@@ -63,9 +67,28 @@ class RaceCondition(Exception):
     - 表维护、连接保活等内部流程检测到依赖状态已被其他执行流改变。
 
     `SystemCaller` 和 `Session.retry(...)` 会捕获此异常并重新执行事务。
+
+    提交阶段的冲突会附带诊断信息，便于定位热点数据：
+
+    - `key`: 冲突的行key或索引key，格式见 `BackendClient.row_key/index_key`；
+    - `check`: 失败的检查类型，`VER` 版本不符、`NX` 行已存在、`EX` 行不存在、
+      `UNIQ` 唯一索引被占用；
+    - `expected` / `actual`: 期望值与实际值，比如 `_version`，未知时为 None。
     """
 
-    pass
+    def __init__(
+        self,
+        *args: object,
+        key: str | None = None,
+        check: str | None = None,
+        expected: str | None = None,
+        actual: str | None = None,
+    ) -> None:
+        super().__init__(*args)
+        self.key = key
+        self.check = check
+        self.expected = expected
+        self.actual = actual
 
 
 class UniqueViolation(IndexError):
@@ -88,6 +111,20 @@ class UniqueViolation(IndexError):
     pass
 
 
+class BoundViolation(ValueError):
+    """
+    数值边界违反异常，表示 `SessionRepository.increment(...)` 的结果超出了
+    `min` / `max` 边界（或超出了字段类型本身的取值范围）。
+
+    行已在Session缓存中时，`increment` 会在本地立即检查并抛出；否则在提交阶段由
+    数据库原子地检查，整个事务不会写入任何数据。
+
+    此异常代表**确定性**的业务冲突（典型如“金币不足”），不应被自动重试。
+    """
+
+    pass
+
+
 class RowFormat(Enum):
     """行格式枚举"""
 
@@ -108,6 +145,20 @@ class BackendClient:
     继承此类，完善所有NotImplementedError的方法。
     """
 
+    # 提交时是否向 `row_channel` 发布提交后的行内容，行订阅直接使用，不用再读取数据库。
+    # 后端不支持时忽略此项，行订阅照常收到通知后读取
+    ROW_CHANGE_PAYLOAD = False
+
+    @classmethod
+    def row_key(cls, table_ref: TableReference, row_id: str | int) -> str:
+        """返回行的key名，用于竞态诊断等需要标识行的地方"""
+        raise NotImplementedError
+
+    @classmethod
+    def index_key(cls, table_ref: TableReference, index_name: str) -> str:
+        """返回索引的key名"""
+        raise NotImplementedError
+
     def index_channel(self, table_ref: TableReference, index_name: str):
         """返回索引的频道名。如果索引有数据变动，会通知到该频道"""
         raise NotImplementedError
@@ -116,6 +167,51 @@ class BackendClient:
         """返回行数据的频道名。如果行有变动，会通知到该频道"""
         raise NotImplementedError
 
+    async def range_index_members(
+        self,
+        table_ref: TableReference,
+        index_name: str,
+        left: Any,
+        right: Any = None,
+        limit: int = 100,
+        desc: bool = False,
+    ) -> dict[int, bytes] | None:
+        """
+        同 `range` 的查询，但只返回 {row_id: 索引成员值}，成员值的bytes顺序即索引顺序。
+
+        后端提交时如果向 `index_channel` 发布了变动的索引成员（见 `parse_index_change`），
+        索引订阅就可以用成员值在本地增量维护查询结果，不用每次变动都重新查询。
+        不支持的后端返回None，索引订阅每次变动都重新查询。
+        """
+        return None
+
+    def index_bounds(
+        self,
+        table_ref: TableReference,
+        index_name: str,
+        left: Any,
+        right: Any = None,
+        desc: bool = False,
+    ) -> tuple[bytes, bytes]:
+        """返回查询范围对应的索引成员值闭区间(low, high)，支持 `range_index_members` 时才需实现"""
+        raise NotImplementedError
+
+    def parse_index_change(self, payload: bytes) -> tuple[int, bytes | None]:
+        """
+        解析 `index_channel` 收到的索引变动消息，返回 (row_id, 新的索引成员值)，
+        新成员值为None表示该行已从索引删除。支持 `range_index_members` 时才需实现
+        """
+        raise NotImplementedError
+
+    def parse_row_change(
+        self, table_ref: TableReference, payload: bytes
+    ) -> dict[str, Any] | None:
+        """
+        解析 `row_channel` 收到的行变动消息，返回提交后的行数据(RowFormat.TYPED_DICT，含_version)，
+        None表示该行已删除。后端支持 `ROW_CHANGE_PAYLOAD` 时才需实现
+        """
+        raise NotImplementedError
+
     def __init_subclass__(cls, **kwargs):
         """让继承子类自动注册alias"""
         super().__init_subclass__()
@@ -659,8 +755,22 @@ class MQClient:
     继承此类实现数据库写入通知和消息队列的结合。
     """
 
-    # todo 加入到config中去，设置服务器的通知tick
-    UPDATE_FREQUENCY = 10  # 控制客户端所有订阅的数据（如果有变动），每秒更新几次
+    # 每个连接每秒最多推送几次订阅更新，由配置SUBSCRIPTION_UPDATE_FREQUENCY设置。
+    # 1/UPDATE_FREQUENCY秒即推送的最小间隔，间隔内收到的通知合并为一次推送
+    UPDATE_FREQUENCY = 10
+    # 立即返回前，等待后续通知的静默时间（秒）。同一事务的多条通知（行、索引）要经过
+    # pubsub连接、worker分发、puller几个协程转手，陆续到达
+    BATCH_WINDOW = 0.001
+
+    _pulled_event: asyncio.Event | None = None  # get_message等待时才创建
+    _last_delivery = 0.0
+    _pulled_at: dict[str, float] | None = None  # 第一次pull到消息时才创建
+
+    def __init__(self):
+        self.pulled_deque = MultiMap()  # 可按时间查询的消息队列
+        self.pulled_set = set()  # 和pulled_deque内容保持一致的set，方便去重
+        # {channel: [消息内容, ...]} 带内容的频道（如索引变动）收到的消息，None表示有丢失
+        self.pulled_payloads: dict[str, list[bytes] | None] = {}
 
     async def close(self):
         raise NotImplementedError
@@ -671,20 +781,97 @@ class MQClient:
         该channel收到了任何消息都说明有数据更新，所以只需要保存channel名。
 
         消息存放本地时，需要用时间作为索引，并且忽略重复的消息。存放前先把2分钟前的消息丢弃，防止堆积。
+        存放后调用 `_notify_pulled()` 唤醒等待中的 `get_message()`。
         此方法需要单独的协程反复调用，防止服务器也消息堆积。如果没有消息，则堵塞到永远。
         """
         # 必须合并消息，因为index更新时大都是2条一起的(remove/add)
         raise NotImplementedError
 
+    def _notify_pulled(self) -> None:
+        """本地队列有了新消息，唤醒get_message"""
+        if self._pulled_event is not None:
+            self._pulled_event.set()
+
     async def get_message(self) -> set[str]:
         """
-        pop并返回之前pull()到本地的消息，只pop收到时间大于1/UPDATE_FREQUENCY的消息。
-        留1/UPDATE_FREQUENCY时间是为了消息的合批。
-
+        pop并返回之前pull()到本地的所有消息，如果没有消息，则堵塞到永远。
         之后SubscriptionBroker会对该消息进行分析，并重新读取数据库获数据。
-        如果没有消息，则堵塞到永远。
+
+        由pull()唤醒，不轮询，空闲连接不占CPU。有消息时立即返回，只有距上次返回不足
+        1/UPDATE_FREQUENCY秒时，才等到间隔满，期间收到的消息一起返回（合批）。
         """
-        raise NotImplementedError
+        pulled_deque = self.pulled_deque
+        if self._pulled_event is None:
+            self._pulled_event = asyncio.Event()
+        while not pulled_deque:
+            self._pulled_event.clear()
+            await self._pulled_event.wait()
+
+        now = time.monotonic()
+        wait = self._last_delivery + 1 / self.UPDATE_FREQUENCY - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+        else:
+            # 合批：同一事务的通知是分几次到达的，只返回第一条的话，剩下的会在下一个
+            # 间隔才推送，客户端会看到行和索引不一致的中间状态。所以等到BATCH_WINDOW内
+            # 没有新通知再返回，总等待不超过推送间隔
+            deadline = now + 1 / self.UPDATE_FREQUENCY
+            while (remain := min(self.BATCH_WINDOW, deadline - time.monotonic())) > 0:
+                self._pulled_event.clear()
+                try:
+                    await asyncio.wait_for(self._pulled_event.wait(), remain)
+                except TimeoutError:
+                    break
+
+        rtn = set(pulled_deque.pop(0, float("inf")))
+        self.pulled_set -= rtn
+        self._last_delivery = time.monotonic()
+        return rtn
+
+    def _mark_pulled(self, channel_name: str) -> None:
+        """pull()每收到一条消息都要调用（包括重复的），记录该频道最后收到消息的时间"""
+        if self._pulled_at is None:
+            self._pulled_at = {}
+        self._pulled_at[channel_name] = time.monotonic()
+
+    def take_pulled_times(self, channel_names: Iterable[str]) -> dict[str, float]:
+        """
+        pop并返回get_message()返回的频道最后收到消息的时间(time.monotonic)，需在get_message()后立即调用。
+        在此时间之后开始的数据库读取，一定包含了通知的变动。
+        """
+        pulled_at = self._pulled_at or {}
+        return {
+            channel_name: pulled_at.pop(channel_name)
+            for channel_name in channel_names
+            if channel_name in pulled_at
+        }
+
+    def _add_payload(self, channel_name: str, payload: bytes | None) -> None:
+        """pull()收到带内容的消息时调用，保存内容。payload为None表示内容缺失（如补发的消息）"""
+        if payload is None:
+            self.pulled_payloads[channel_name] = None
+            return
+        payloads = self.pulled_payloads.setdefault(channel_name, [])
+        if payloads is not None:
+            payloads.append(payload)
+
+    def _drop_payloads(self, channel_names: Iterable[str]) -> None:
+        """pull()丢弃积压的消息时调用，标记这些频道的内容有丢失"""
+        for channel_name in channel_names:
+            if channel_name in self.pulled_payloads:
+                self.pulled_payloads[channel_name] = None
+
+    def take_payloads(self, channel_names: Iterable[str]) -> dict[str, list[bytes]]:
+        """
+        pop并返回get_message()返回的频道上次以来收到的消息内容，需在get_message()后立即调用。
+        只包含内容完整的频道，没有内容或有丢失的频道不在返回值中，需要重新读取数据库。
+        """
+        rtn = {}
+        for channel_name in channel_names:
+            payloads = self.pulled_payloads.pop(channel_name, None)
+            if payloads is not None:
+                rtn[channel_name] = payloads
+        return rtn
 
     async def subscribe(self, channel_name: str) -> None:
         """订阅频道"""
@@ -694,6 +881,16 @@ class MQClient:
         """取消订阅频道"""
         raise NotImplementedError
 
+    async def subscribe_many(self, channel_names: Iterable[str]) -> None:
+        """批量订阅频道，子类可覆盖为一次往返完成"""
+        for channel_name in channel_names:
+            await self.subscribe(channel_name)
+
+    async def unsubscribe_many(self, channel_names: Iterable[str]) -> None:
+        """批量取消订阅频道"""
+        for channel_name in channel_names:
+            await self.unsubscribe(channel_name)
+
     @property
     def subscribed_channels(self) -> set[str]:
         """返回当前订阅的频道名"""
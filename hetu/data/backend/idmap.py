@@ -6,6 +6,7 @@
 """
 
 import logging
+from collections.abc import Callable
 from enum import Enum
 from typing import TYPE_CHECKING, cast
 
@@ -50,13 +51,54 @@ class IdentityMap:
         # 是基于“它不存在”的过期快照做的决策，应判为 RaceCondition 而非 UniqueViolation。
         self._absent: dict[TableReference, set[tuple[str, object]]] = {}
 
+        # 未读取行的原子增量操作（increment），提交时不做版本检查，由数据库原子执行。
+        # {TableReference: {row_id: {field: [delta, min, max]}}}，min/max为None表示无边界
+        self._row_deltas: dict[
+            TableReference, dict[int, dict[str, list[int | float | None]]]
+        ] = {}
+
+        # 快照读（validate=False）的行，缓存在事务中，但提交时不做版本检查
+        # {TableReference: {row_id, ...}}
+        self._row_snapshot: dict[TableReference, set[int]] = {}
+
+        # 跨事务的行缓存（见 `hetu.system.rowcache`），事务缓存未命中时先从这里取，
+        # 取到的行和从数据库读到的一样作为CLEAN行，提交时照常做版本检查，过期则冲突重试。
+        self.warm: Callable[[TableReference, int], np.record | None] | None = None
+        # {(TableReference, row_id), ...} 本事务中从warm取得的行
+        self._warm_hits: set[tuple[TableReference, int]] = set()
+
         # 范围查询缓存
         # {TableReference: {index_name: [(left, right), ...]}} - 存储已缓存的范围
         # self._range_cache: dict[TableReference, dict[str, list[tuple]]] = {}
 
+    @property
+    def has_warm_hits(self) -> bool:
+        """是否用到了跨事务缓存的行，用到的话即使是只读事务也要提交检查版本"""
+        return bool(self._warm_hits)
+
+    def get_warm_hits(self) -> set[tuple[TableReference, int]]:
+        return self._warm_hits
+
+    def take_warm(self, table_ref: TableReference, row_id: int) -> np.record | None:
+        """
+        事务缓存未命中时，从跨事务缓存中取行，并作为CLEAN行加入事务缓存。
+        没有设置warm或未命中返回None。
+        """
+        if self.warm is None:
+            return None
+        row = self.warm(table_ref, row_id)
+        if row is None:
+            return None
+        self.add_clean(table_ref, row)
+        self._warm_hits.add((table_ref, row_id))
+        row, _ = self.get(table_ref, row_id)
+        return row
+
     @property
     def is_dirty(self) -> bool:
         """检查是否有脏数据"""
+        if self._row_deltas:
+            return True
         for states in self._row_states.values():
             if any(state != RowState.CLEAN for state in states.values()):
                 return True
@@ -80,6 +122,7 @@ class IdentityMap:
             )
             self._row_clean[table_ref] = {}
             self._row_states[table_ref] = {}
+            self._row_snapshot[table_ref] = set()
         return (
             self._row_cache[table_ref],
             self._row_clean[table_ref],
@@ -87,11 +130,15 @@ class IdentityMap:
         )
 
     def add_clean(
-        self, table_ref: TableReference, row_s: np.record | np.recarray
+        self,
+        table_ref: TableReference,
+        row_s: np.record | np.recarray,
+        validate: bool = True,
     ) -> None:
         """
         添加 一个/多个 查询到的对象到row缓存中。
         如果数据行已存在，则会报错ValueError。
+        `validate` 为False时作为快照读，提交时不检查这些行的版本。
         """
         # 检测新添加数据，和之前的数据是否在同一个实例/集群下
         assert self.is_same_txn_group(table_ref), (
@@ -123,9 +170,26 @@ class IdentityMap:
             row_s = cast(np.record, row_s)
             states[row_s["id"]] = RowState.CLEAN
             clean_cache[row_s["id"]] = row_s.copy()
+            if not validate:
+                self._row_snapshot[table_ref].add(row_s["id"])
         else:
             states.update({key: RowState.CLEAN for key in row_s["id"]})
             clean_cache.update({row["id"]: row.copy() for row in row_s})
+            if not validate:
+                self._row_snapshot[table_ref].update(row_s["id"])
+
+    def validate(self, table_ref: TableReference, row_id: int) -> None:
+        """
+        取消某行的快照读标记。之前快照读过的行，之后又被正常读取时调用，
+        提交时恢复该行的版本检查。
+        """
+        if snapshot := self._row_snapshot.get(table_ref):
+            snapshot.discard(row_id)
+
+    def is_snapshot(self, table_ref: TableReference, row_id: int) -> bool:
+        """该行是否只被快照读过（提交时不检查版本）"""
+        snapshot = self._row_snapshot.get(table_ref)
+        return snapshot is not None and row_id in snapshot
 
     def get(
         self, table_ref: TableReference, row_id: int
@@ -223,6 +287,8 @@ class IdentityMap:
         # 如果是新插入的行，保持INSERT状态；否则标记为UPDATE
         if states.get(row_id) != RowState.INSERT:
             states[row_id] = RowState.UPDATE
+            # 写入的行提交时总会检查版本，不再是快照读
+            self._row_snapshot[table_ref].discard(row_id)
 
     def mark_deleted(self, table_ref: TableReference, row_id: int) -> None:
         """
@@ -240,6 +306,7 @@ class IdentityMap:
 
         # 标记为DELETE
         states[row_id] = RowState.DELETE
+        self._row_snapshot[table_ref].discard(row_id)
 
     def is_deleted(self, table_ref: TableReference, row_id: int) -> bool:
         """
@@ -251,6 +318,63 @@ class IdentityMap:
         states = self._row_states[table_ref]
         return states.get(row_id) == RowState.DELETE
 
+    def add_delta(
+        self,
+        table_ref: TableReference,
+        row_id: int,
+        field: str,
+        delta: int | float,
+        min_: int | float | None,
+        max_: int | float | None,
+    ) -> None:
+        """
+        登记一条对未读取行的原子增量操作。
+        同一行同一字段的多次增量会合并：delta累加，边界取最严格的那个。
+        """
+        assert self.is_same_txn_group(table_ref), (
+            f"{table_ref} has different transaction context"
+        )
+        # 初始化缓存，让first_reference等方法能找到该表
+        self._cache(table_ref)
+
+        fields = self._row_deltas.setdefault(table_ref, {}).setdefault(row_id, {})
+        if field not in fields:
+            fields[field] = [delta, min_, max_]
+            return
+        prev = fields[field]
+        prev[0] = prev[0] + delta  # type: ignore
+        if min_ is not None:
+            prev[1] = min_ if prev[1] is None else max(prev[1], min_)
+        if max_ is not None:
+            prev[2] = max_ if prev[2] is None else min(prev[2], max_)
+
+    def pop_deltas(
+        self, table_ref: TableReference, row_id: int
+    ) -> dict[str, list[int | float | None]] | None:
+        """
+        取出并移除某行未提交的增量操作。行被读入缓存后，增量要转为普通的本地修改。
+        """
+        row_deltas = self._row_deltas.get(table_ref)
+        if not row_deltas:
+            return None
+        deltas = row_deltas.pop(row_id, None)
+        if not row_deltas:
+            del self._row_deltas[table_ref]
+        return deltas
+
+    def get_delta_rows(
+        self,
+    ) -> dict[TableReference, dict[int, dict[str, list[int | float | None]]]]:
+        """
+        返回所有原子增量操作，用来提交给数据库。
+
+        Returns
+        -------
+        {TableReference: {row_id: {field: [delta, min, max]}}}
+        min/max为None表示该方向无边界。
+        """
+        return self._row_deltas
+
     @staticmethod
     def _norm_value(value: object) -> object:
         """把np标量归一成python原生值，保证mark/observe两侧key一致。"""
@@ -281,6 +405,7 @@ class IdentityMap:
     def get_clean_row_keys(self) -> set[str]:
         """
         获取所有源干净行数据。如果遇到事务冲突，能知道是哪些干净数据其实已经失效了。
+        快照读的行不会引起冲突，不包含在内。
         """
         from hetu.data.backend.redis.client import RedisBackendClient
 
@@ -288,13 +413,14 @@ class IdentityMap:
             RedisBackendClient.row_key(ref, row_id)
             for ref, dat in self._row_clean.items()
             for row_id in dat.keys()
+            if not self.is_snapshot(ref, row_id)
         }
 
     def get_clean_rows(self) -> dict["TableReference", dict[int, str]]:
         """
         返回当前仍处于CLEAN状态的行（被读取但未被修改/删除/重新插入），
         以及它们读取时的 `_version`。提交时用于对纯读行做严格的乐观锁检查，
-        避免事务依赖的陈旧读（stale read）。
+        避免事务依赖的陈旧读（stale read）。快照读的行不包含在内。
 
         Returns
         -------
@@ -303,9 +429,10 @@ class IdentityMap:
         ret: dict[TableReference, dict[int, str]] = {}
         for table_ref, states in self._row_states.items():
             clean_cache = self._row_clean.get(table_ref, {})
+            snapshot = self._row_snapshot.get(table_ref, ())
             row_versions: dict[int, str] = {}
             for row_id, state in states.items():
-                if state != RowState.CLEAN:
+                if state != RowState.CLEAN or row_id in snapshot:
                     continue
                 clean_row = clean_cache.get(row_id)
                 if clean_row is None:
@@ -315,6 +442,40 @@ class IdentityMap:
                 ret[table_ref] = row_versions
         return ret
 
+    def get_committed_rows(
+        self,
+    ) -> tuple[dict[TableReference, list[np.record]], dict[TableReference, set[int]]]:
+        """
+        提交成功后调用，返回数据库中各行现在的值，`_version` 已按提交结果更新；
+        以及已删除、或值未知（原子增量）的行id。用于更新跨事务的行缓存。
+
+        Returns
+        -------
+        ({TableReference: [row, ...]}, {TableReference: {row_id, ...}})
+        """
+        rows: dict[TableReference, list[np.record]] = {}
+        gone: dict[TableReference, set[int]] = {}
+        for table_ref, states in self._row_states.items():
+            cache = self._row_cache[table_ref]
+            clean_cache = self._row_clean[table_ref]
+            ref_rows = rows.setdefault(table_ref, [])
+            ref_gone = gone.setdefault(table_ref, set())
+            for row in cache:
+                row_id = int(row.id)
+                state = states.get(row_id)
+                if state == RowState.DELETE:
+                    ref_gone.add(row_id)
+                    continue
+                row = row.copy()
+                if state == RowState.INSERT:
+                    row._version = 1
+                elif state == RowState.UPDATE and row != clean_cache[row_id]:
+                    # 没有实际变更的行不会提交，版本不变
+                    row._version += 1
+                ref_rows.append(row)
+            ref_gone.update(self._row_deltas.get(table_ref, ()))
+        return rows, gone
+
     def get_dirty_rows(
         self,
     ) -> dict[
@@ -20,7 +20,7 @@ import redis
 from redis.cluster import LoadBalancingStrategy
 
 from ....i18n import _
-from ..base import BackendClient, RaceCondition, RowFormat
+from ..base import BackendClient, BoundViolation, RaceCondition, RowFormat
 
 # from .batch import RedisBatchedClient
 
@@ -35,9 +35,18 @@ if TYPE_CHECKING:
     from ..table import TableReference
     from .maint import RedisTableMaintenance
     from .mq import RedisMQClient
+    from .pubsub import PubSubMultiplexer
 
 logger = logging.getLogger("HeTu.root")
 msg_packer = msgpack.Packer(use_bin_type=False)
+# lua提交失败时各检查类型的错误信息
+_COMMIT_ERRORS = {
+    "VER": "Version mismatch {key} exp:{expected} got:{actual}",
+    "NX": "Key already exists {key}",
+    "EX": "Key does not exist {key}",
+    "UNIQ": "Constraint violation on {key} by row {actual}",
+    "BOUND": "{key}={actual} out of {expected}",
+}
 
 
 @final
@@ -133,13 +142,60 @@ class RedisBackendClient(BackendClient, alias="redis"):
 
     @override
     def index_channel(self, table_ref: TableReference, index_name: str):
-        """返回索引的频道名。如果索引有数据变动，会通知到该频道"""
-        return f"__keyspace@{self.dbi}__:{self.index_key(table_ref, index_name)}"
+        """
+        返回索引的频道名。如果索引有数据变动，会通知到该频道。
+        不是keyspace通知，而是提交时发布的频道，消息内容为变动的索引成员，见 `parse_index_change`。
+        事务之外写入索引（如维护工具重建索引）时发布空消息，订阅者收到后重新查询
+        """
+        return self.index_change_channel_(self.index_key(table_ref, index_name))
+
+    def index_change_channel_(self, idx_key: str) -> str:
+        return f"__index@{self.dbi}__:{idx_key}"
 
     @override
     def row_channel(self, table_ref: TableReference, row_id: int):
-        """返回行数据的频道名。如果行有变动，会通知到该频道"""
-        return f"__keyspace@{self.dbi}__:{self.row_key(table_ref, row_id)}"
+        """
+        返回行数据的频道名。如果行有变动，会通知到该频道。
+        开启 `ROW_CHANGE_PAYLOAD` 时，是提交时发布的频道，消息内容为提交后的行，见 `parse_row_change`，
+        否则是keyspace通知
+        """
+        return self.row_channel_of_(self.row_key(table_ref, row_id))
+
+    def row_channel_of_(self, row_key: str) -> str:
+        if self.ROW_CHANGE_PAYLOAD:
+            return self.row_change_channel_(row_key)
+        return f"__keyspace@{self.dbi}__:{row_key}"
+
+    def row_change_channel_(self, row_key: str) -> str:
+        return f"__row@{self.dbi}__:{row_key}"
+
+    @property
+    def publish_command_(self) -> str:
+        """
+        提交时发布频道用的命令。集群模式下用分片频道(SPUBLISH)，频道名带有和key相同的
+        `{CLUn}` hash tag，消息只在该分片内传播，不会经集群总线广播到所有节点
+        """
+        return "SPUBLISH" if self.raw_clustering else "PUBLISH"
+
+    @staticmethod
+    def is_change_channel_(channel: str) -> bool:
+        """是否为提交时发布的频道，不是keyspace通知"""
+        return channel.startswith(("__index@", "__row@"))
+
+    @staticmethod
+    def change_log_key(table_ref: TableReference) -> str:
+        """
+        返回变动日志(Redis Stream)的key名，每个实例的每个分片簇一个。
+        开启后每个事务提交时写入一条，内容为变动的频道名，订阅断线恢复后从中补发丢失的通知
+        """
+        return f"{table_ref.instance_name}:changelog:{{CLU{table_ref.cluster_id}}}"
+
+    @staticmethod
+    def change_log_key_of_(channel: str) -> str:
+        """返回频道所属的变动日志key名"""
+        # 频道名为 __xxx@db__:实例名:组件名:{CLUn}:...
+        instance, _comp, tag = channel.split("__:", 1)[1].split(":", 3)[:3]
+        return f"{instance}:changelog:{tag}"
 
     async def reset_async_connection_pool(self):
         """重置异步连接池，用于协程切换后，解决aio不能跨协程传递的问题"""
@@ -184,11 +240,21 @@ class RedisBackendClient(BackendClient, alias="redis"):
 
     # ============ 主要方法 ============
 
+    # 是否为集群模式，集群模式下提交时用分片频道发布，见 `publish_command_`
+    raw_clustering = False
+    # 变动日志的最大长度(近似)，0为不写入，见 `change_log_key`
+    change_log_maxlen = 0
+
     def __init__(
-        self, endpoint: str | list[str], is_servant, raw_clustering: bool = False
+        self,
+        endpoint: str | list[str],
+        is_servant,
+        raw_clustering: bool = False,
+        change_log_maxlen: int = 0,
     ):
         super().__init__(endpoint, is_servant)
         self.raw_clustering = raw_clustering
+        self.change_log_maxlen = change_log_maxlen
         # redis的endpoint配置为url, 或list of url
         self.urls = [endpoint] if type(endpoint) is str else endpoint
         assert len(self.urls) > 0, _("必须至少指定一个数据库连接URL")
@@ -215,6 +281,9 @@ class RedisBackendClient(BackendClient, alias="redis"):
                 self._ios.append(redis.Redis.from_url(url))
                 self._async_ios.append(redis.asyncio.Redis.from_url(url))
 
+        # worker共享的pubsub，第一次获取MQ客户端时创建
+        self._mux: PubSubMultiplexer | None = None
+
         # 取消，只在单机模式下有所增长
         # self._batched_aio = RedisBatchedClient(self._async_ios)
 
@@ -279,6 +348,10 @@ class RedisBackendClient(BackendClient, alias="redis"):
             raise ConnectionError(_("连接已关闭，已调用过close"))
             # 检查servants设置
 
+        if self.ROW_CHANGE_PAYLOAD:
+            # 行和索引的频道都由提交时发布，不需要keyspace通知
+            return
+
         target_keyspace = "Kghz"
         for i, io in enumerate(self._ios):
             try:
@@ -351,6 +424,10 @@ class RedisBackendClient(BackendClient, alias="redis"):
         # ya_backend_upsert结果：
         # [(1, 844), (2, 781), (3, 796), (4, 720), (5, 616), (6, 468), (7, 291), (8, 185), (9, 1)]
 
+        if self._mux is not None:
+            await self._mux.close()
+            self._mux = None
+
         for io in self._ios:
             io.close()
         self._ios = []
@@ -527,6 +604,40 @@ class RedisBackendClient(BackendClient, alias="redis"):
         b_right = b"[" + cls.to_sortable_bytes(dtype.type(right)) + rs
         return b_left, b_right
 
+    @override
+    def index_bounds(
+        self,
+        table_ref: TableReference,
+        index_name: str,
+        left: Any,
+        right: Any = None,
+        desc: bool = False,
+    ) -> tuple[bytes, bytes]:
+        b_left, b_right = self.range_normalize_(
+            table_ref.comp_cls.dtype_map_[index_name], left, right, desc
+        )
+        # 去掉开头的"["，范围的开闭已经由结尾的终止符表达
+        low, high = b_left[1:], b_right[1:]
+        return (high, low) if desc else (low, high)
+
+    @override
+    def parse_index_change(self, payload: bytes) -> tuple[int, bytes | None]:
+        """消息内容为msgpack的[旧成员, 新成员]，成员为空表示无"""
+        old, new = msgpack.unpackb(payload, raw=True)
+        row_id = int((new or old).rsplit(b"\x00", 1)[-1])
+        return row_id, new or None
+
+    @override
+    def parse_row_change(
+        self, table_ref: TableReference, payload: bytes
+    ) -> dict[str, Any] | None:
+        """消息内容为msgpack的[字段, 值, ...]，同HGETALL的结果，为空表示已删除"""
+        flat = msgpack.unpackb(payload, raw=True)
+        if not flat:
+            return None
+        row = dict(zip(flat[::2], flat[1::2]))
+        return self.row_decode_(table_ref.comp_cls, row, RowFormat.TYPED_DICT)
+
     @staticmethod
     def make_zrange_cmd_(b_left, b_right, desc, limit):
         return {
@@ -655,23 +766,12 @@ class RedisBackendClient(BackendClient, alias="redis"):
         if not self._ios:
             raise ConnectionError(_("连接已关闭，已调用过close"))
 
-        idx_key = self.index_key(table_ref, index_name)
         aio = self.aio  # self._batched_aio
-
-        # 生成zrange命令
         comp_cls = table_ref.comp_cls
-        if index_name not in comp_cls.indexes_:
-            raise ValueError(f"Component `{comp_cls.name_}` 没有索引 `{index_name}`")
-        b_left, b_right = self.range_normalize_(
-            comp_cls.dtype_map_[index_name], left, right, desc
-        )
-        if (b_left < b_right) if desc else (b_right < b_left):
-            raise ValueError(f"left必须大于等于right，你的:right={right}, left={left}")
-
-        row_ids = await aio.zrange(
-            name=idx_key, **self.make_zrange_cmd_(b_left, b_right, desc, limit)
+        members = await self._zrange_members(
+            table_ref, index_name, left, right, limit, desc
         )
-        row_ids = [int(vk.rsplit(b"\x00", 1)[-1]) for vk in row_ids]
+        row_ids = [int(vk.rsplit(b"\x00", 1)[-1]) for vk in members]
 
         if row_format == RowFormat.ID_LIST:
             return row_ids
@@ -691,6 +791,49 @@ class RedisBackendClient(BackendClient, alias="redis"):
                 record_list = cast(list[np.record], rows)
                 return np.rec.array(np.stack(record_list, dtype=comp_cls.dtypes))
 
+    async def _zrange_members(
+        self,
+        table_ref: TableReference,
+        index_name: str,
+        left: Any,
+        right: Any,
+        limit: int,
+        desc: bool,
+    ) -> list[bytes]:
+        """按range的参数查询索引，返回索引成员(value\\x00id)列表"""
+        idx_key = self.index_key(table_ref, index_name)
+
+        # 生成zrange命令
+        comp_cls = table_ref.comp_cls
+        if index_name not in comp_cls.indexes_:
+            raise ValueError(f"Component `{comp_cls.name_}` 没有索引 `{index_name}`")
+        b_left, b_right = self.range_normalize_(
+            comp_cls.dtype_map_[index_name], left, right, desc
+        )
+        if (b_left < b_right) if desc else (b_right < b_left):
+            raise ValueError(f"left必须大于等于right，你的:right={right}, left={left}")
+
+        return await self.aio.zrange(
+            name=idx_key, **self.make_zrange_cmd_(b_left, b_right, desc, limit)
+        )
+
+    @override
+    async def range_index_members(
+        self,
+        table_ref: TableReference,
+        index_name: str,
+        left: Any,
+        right: Any = None,
+        limit: int = 100,
+        desc: bool = False,
+    ) -> dict[int, bytes]:
+        if not self._ios:
+            raise ConnectionError(_("连接已关闭，已调用过close"))
+        members = await self._zrange_members(
+            table_ref, index_name, left, right, limit, desc
+        )
+        return {int(vk.rsplit(b"\x00", 1)[-1]): vk for vk in members}
+
     @override
     async def commit(self, idmap: IdentityMap) -> None:
         """
@@ -744,31 +887,87 @@ class RedisBackendClient(BackendClient, alias="redis"):
                         _dtype_map[_field].type(_values[_field])
                     )
                     _member = _sortable_value + b"\x00" + _b_row_id
+                    # 记录成员的新旧值，最后发布到索引频道
+                    _change = index_changes.setdefault(
+                        (_idx_key, _b_row_id), [b"", b""]
+                    )
                     if _add:
                         # score统一用0，因为我们不需要score排序功能
                         pushes.append(["ZADD", _idx_key, "0", _member])
+                        _change[1] = _member
                     else:
                         pushes.append(["ZREM", _idx_key, _member])
+                        _change[0] = _member
 
         def _del_key(_key):
             """添加del的push命令"""
             pushes.append(["DEL", _key])
 
+        def _row_image(_key, _old_version, _old: dict[str, str] | None, _new):
+            """记录提交后的行内容，最后发布到行频道，_new为None表示删除"""
+            if _new is None:
+                row_images[_key] = None
+                return
+            _image = dict(_old) if _old else {}
+            _image.update(_new)
+            _image["_version"] = str(int(_old_version) + 1)
+            row_images[_key] = _image
+
+        def _incr_key(_indexes, _dtype_map, _idx_prefix, _key, _row_id, _deltas):
+            """添加原子增量的边界检查和push命令，索引由lua脚本读旧值后重建"""
+            for _field, (_delta, _min, _max) in _deltas.items():
+                _dtype = _dtype_map[_field]
+                if np.issubdtype(_dtype, np.signedinteger):
+                    _kind = "i"
+                elif np.issubdtype(_dtype, np.unsignedinteger):
+                    _kind = "u"
+                else:
+                    _kind = "f"
+                _min = "" if _min is None else str(_min)
+                _max = "" if _max is None else str(_max)
+                checks.append(["BOUND", _key, _field, str(_delta), _min, _max])
+                _idx_key = _idx_prefix + _field if _field in _indexes else ""
+                _channel = self.index_change_channel_(_idx_key) if _idx_key else ""
+                pushes.append(
+                    [
+                        "INCR",
+                        _key,
+                        _field,
+                        str(_delta),
+                        _kind,
+                        _idx_key,
+                        _row_id,
+                        _channel,
+                        publish,
+                    ]
+                )
+            pushes.append(["HINCRBY", _key, "_version", "1"])
+            if publish_rows:
+                # 增量后的值只有lua脚本知道，由它读取整行后发布
+                pushes.append(["ROWPUB", _key, self.row_change_channel_(_key), publish])
+
         assert not self.is_servant, _("从节点不允许提交事务")
 
         dirties = idmap.get_dirty_rows()
-        if not dirties:
+        row_deltas = idmap.get_delta_rows()
+        if not dirties and not row_deltas:
             raise ValueError(_("没有脏数据需要提交"))
 
         first_ref = idmap.first_reference()
         assert first_ref is not None, "typing检查"
 
         # 组合成checks/pushes命令表，减少lua脚本的复杂度
-        # checks有exists/unique/version
-        # pushes有hset/zadd/zrem/del
+        # checks有exists/unique/version/bound
+        # pushes有hset/zadd/zrem/del/incr/publish/rowpub/xadd
         checks: list[list[str | bytes]] = []
         pushes: list[list[str | bytes]] = []
         deleted: dict[str, bool] = {}
+        # {(index_key, row_id): [旧成员, 新成员]}
+        index_changes: dict[tuple[str, bytes], list[bytes]] = {}
+        # {row_key: 提交后的行内容}，None为删除，开启ROW_CHANGE_PAYLOAD时才记录
+        row_images: dict[str, dict[str, str] | None] = {}
+        publish_rows = self.ROW_CHANGE_PAYLOAD
+        publish = self.publish_command_
 
         for ref, (inserts, (old_rows, new_rows), deletes) in dirties.items():
             id_prefix = self.cluster_prefix(ref) + ":id:"
@@ -785,6 +984,8 @@ class RedisBackendClient(BackendClient, alias="redis"):
                 _unique_meet(unique_fields, dtype_map, idx_prefix, insert)
                 _hset_key(key, 0, insert)
                 _exc_index(indexes, dtype_map, idx_prefix, insert, insert, _add=True)
+                if publish_rows:
+                    _row_image(key, 0, None, insert)
             # update
             for old_row, new_row in zip(old_rows, new_rows):
                 row_id = old_row["id"]
@@ -795,6 +996,8 @@ class RedisBackendClient(BackendClient, alias="redis"):
                 _hset_key(key, old_version, new_row)
                 _exc_index(indexes, dtype_map, idx_prefix, old_row, new_row, _add=False)
                 _exc_index(indexes, dtype_map, idx_prefix, old_row, new_row, _add=True)
+                if publish_rows:
+                    _row_image(key, old_version, old_row, new_row)
             # delete
             for delete in deletes:
                 # 传入deleted ids，如果之后的unique冲突查到的id在deleted里，就返回false
@@ -804,6 +1007,60 @@ class RedisBackendClient(BackendClient, alias="redis"):
                 _version_must_match(key, old_version)
                 _exc_index(indexes, dtype_map, idx_prefix, delete, delete, _add=False)
                 _del_key(key)
+                if publish_rows:
+                    _row_image(key, old_version, None, None)
+
+        # 发布索引变动，索引订阅据此增量更新，不用重新查询
+        for (idx_key, _row_id), (old, new) in index_changes.items():
+            if old != new:
+                channel = self.index_change_channel_(idx_key)
+                pushes.append([publish, channel, msg_packer.pack([old, new])])
+
+        # 发布提交后的行内容，行订阅直接使用，不用再读取
+        for key, image in row_images.items():
+            flat = list(itertools.chain.from_iterable(image.items())) if image else []
+            channel = self.row_change_channel_(key)
+            pushes.append([publish, channel, msg_packer.pack(flat)])
+
+        # 原子增量：不检查版本，只检查行存在和边界
+        for ref, deltas_by_id in row_deltas.items():
+            id_prefix = self.cluster_prefix(ref) + ":id:"
+            idx_prefix = self.cluster_prefix(ref) + ":index:"
+            comp_cls = ref.comp_cls
+            for row_id, deltas in deltas_by_id.items():
+                _incr_key(
+                    comp_cls.indexes_,
+                    comp_cls.dtype_map_,
+                    idx_prefix,
+                    id_prefix + str(row_id),
+                    str(row_id),
+                    deltas,
+                )
+
+        # 变动的频道写入变动日志，订阅断线恢复后从中补发期间丢失的通知
+        if self.change_log_maxlen > 0:
+            changed = set()
+            for cmd in pushes:
+                if cmd[0] in ("HSET", "DEL", "INCR"):
+                    changed.add(self.row_channel_of_(cast(str, cmd[1])))
+                if cmd[0] == publish:
+                    changed.add(cmd[1])
+                elif cmd[0] == "INCR" and cmd[7]:
+                    changed.add(cmd[7])
+            # 只读事务（如用到了连接行缓存的）没有变动，不写入，免得挤掉日志中有用的条目
+            if changed:
+                pushes.append(
+                    [
+                        "XADD",
+                        self.change_log_key(first_ref),
+                        "MAXLEN",
+                        "~",
+                        str(self.change_log_maxlen),
+                        "*",
+                        "ch",
+                        msg_packer.pack(sorted(changed)),
+                    ]
+                )
 
         # 对纯读行加版本检查，防止事务依赖的陈旧读：
         # 事务读到的某行，在提交前若被其他事务修改，本事务应失败重试。
@@ -821,18 +1078,37 @@ class RedisBackendClient(BackendClient, alias="redis"):
             "lua_commit脚本没有初始化，请先调用 post_configure"
         )
         resp = await self.lua_commit(keys, [payload_json])
-        resp = resp.decode("utf-8")  # type: ignore
-
-        if resp != "committed":
-            # 把事务相关的key满门抄斩
-            # self._batched_aio.invalidate_cache(idmap.get_clean_row_keys())
-            if resp.startswith("RACE"):
-                raise RaceCondition(resp)
-            elif resp.startswith("UNIQUE"):
-                # unique违反就是index的竞态原因
-                raise RaceCondition(resp)
-            else:
-                raise RuntimeError(_("未知的提交错误：{resp}").format(resp=resp))
+        if resp == b"committed":
+            return
+
+        # 失败时返回 [status, check, key, expected, actual]
+        # 把事务相关的key满门抄斩
+        # self._batched_aio.invalidate_cache(idmap.get_clean_row_keys())
+        if not isinstance(resp, list) or len(resp) != 5:
+            raise RuntimeError(_("未知的提交错误：{resp}").format(resp=resp))
+        status, check, key, expected, actual = (
+            v.decode("utf-8", "replace") if isinstance(v, bytes) else str(v)
+            for v in resp
+        )
+        msg = _COMMIT_ERRORS.get(check, "{check} check failed on {key}").format(
+            check=check, key=key, expected=expected, actual=actual
+        )
+        msg = f"{status}: {msg}"
+        diag = {
+            "key": key,
+            "check": check,
+            "expected": expected or None,
+            "actual": actual or None,
+        }
+        if status == "RACE":
+            raise RaceCondition(msg, **diag)
+        elif status == "UNIQUE":
+            # unique违反就是index的竞态原因
+            raise RaceCondition(msg, **diag)
+        elif status == "BOUND":
+            raise BoundViolation(msg)
+        else:
+            raise RuntimeError(_("未知的提交错误：{resp}").format(resp=resp))
 
     async def direct_set(
         self, table_ref: TableReference, id_: int, **kwargs: str
@@ -845,11 +1121,11 @@ class RedisBackendClient(BackendClient, alias="redis"):
         注意此方法可能导致写入数据到已删除的行，请确保逻辑。
 
         一些系统级别的临时数据，使用直接写入的方式效率会更高，但不保证数据一致性。
+        开启 `ROW_CHANGE_PAYLOAD` 时没有keyspace通知，由lua脚本写入后把整行发布到行频道。
         """
         assert "id" not in kwargs, "id不允许修改"
         assert table_ref.comp_cls.volatile_, "direct_set只能用于易失数据的Component"
 
-        aio = self.aio
         key = self.row_key(table_ref, id_)
 
         for prop in kwargs:
@@ -863,7 +1139,33 @@ class RedisBackendClient(BackendClient, alias="redis"):
                         comp_name=table_ref.comp_name, prop=prop
                     )
                 )
-        await aio.hset(key, mapping=kwargs)  # type: ignore
+        if not self.ROW_CHANGE_PAYLOAD:
+            await self.aio.hset(key, mapping=kwargs)  # type: ignore
+            return
+
+        # 写入后的整行只有lua脚本知道，同原子增量，由它读取整行后发布
+        channel = self.row_change_channel_(key)
+        pushes = [
+            ["HSET", key, *itertools.chain.from_iterable(kwargs.items())],
+            ["ROWPUB", key, channel, self.publish_command_],
+        ]
+        if self.change_log_maxlen > 0:
+            pushes.append(
+                [
+                    "XADD",
+                    self.change_log_key(table_ref),
+                    "MAXLEN",
+                    "~",
+                    str(self.change_log_maxlen),
+                    "*",
+                    "ch",
+                    msg_packer.pack([channel]),
+                ]
+            )
+        assert self.lua_commit is not None, _(
+            "lua_commit脚本没有初始化，请先调用 post_configure"
+        )
+        await self.lua_commit([key], [msg_packer.pack([[], pushes, {}])])
 
     def get_table_maintenance(self) -> RedisTableMaintenance:
         """
@@ -883,3 +1185,15 @@ class RedisBackendClient(BackendClient, alias="redis"):
         from .mq import RedisMQClient
 
         return RedisMQClient(self)
+
+    def pubsub_mux(self) -> PubSubMultiplexer:
+        """获取本worker共享的pubsub，所有MQ客户端共用"""
+        from .pubsub import PubSubMultiplexer
+
+        mux = self._mux
+        if mux is None or mux.loop is not asyncio.get_running_loop():
+            # 事件循环变了（一般只在单元测试中），旧的连接不能再用
+            change_log_of = self.change_log_key_of_ if self.change_log_maxlen else None
+            is_sharded = self.is_change_channel_ if self.raw_clustering else None
+            mux = self._mux = PubSubMultiplexer(self.aio, change_log_of, is_sharded)
+        return mux
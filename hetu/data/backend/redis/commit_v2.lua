@@ -2,8 +2,52 @@ local cmsgpack = cmsgpack
 local unpack = unpack
 local redis_call = redis.call
 local string_match = string.match
-local next = next
 local ipairs = ipairs
+local tonumber = tonumber
+local string_char = string.char
+local string_byte = string.byte
+local string_sub = string.sub
+local math_floor = math.floor
+local struct_pack = struct.pack
+local bit_bor = bit.bor
+local bit_bnot = bit.bnot
+local bit_band = bit.band
+
+-- 4字节大端无符号整数
+local function u32be(n)
+    return string_char(
+        math_floor(n / 16777216) % 256,
+        math_floor(n / 65536) % 256,
+        math_floor(n / 256) % 256,
+        n % 256
+    )
+end
+
+-- 和 RedisBackendClient.to_sortable_bytes 相同的可排序编码，用于INCR后重建索引
+-- kind: "i" 有符号整数, "u" 无符号整数, "f" 浮点
+-- 注意lua数字为double，整数超过2^53会丢精度
+local function to_sortable(kind, value)
+    if kind == "f" then
+        local b = struct_pack(">d", value)
+        if value >= 0 then
+            -- 正数让符号位变1
+            return string_char(bit_bor(string_byte(b, 1), 0x80)) .. string_sub(b, 2)
+        end
+        -- 负数全部取反
+        local out = ""
+        for i = 1, 8 do
+            out = out .. string_char(bit_band(bit_bnot(string_byte(b, i)), 0xFF))
+        end
+        return out
+    end
+    local hi = math_floor(value / 4294967296)
+    local lo = value - hi * 4294967296
+    if kind == "i" then
+        -- 加上 1<<63，即翻转符号位
+        hi = hi + 2147483648
+    end
+    return u32be(hi) .. u32be(lo)
+end
 
 -- ARGV[1] 是 msgpack 序列化的 payload
 -- 结构: [ [checks...], [pushes...] ]
@@ -27,7 +71,7 @@ if checks then
             local current = redis_call("HGET", key, "_version")
             -- 注意: HGET 返回的是 string，如果 key 不存在返回 false/nil
             if current ~= expected then
-                return "RACE: Version mismatch " .. key .. " exp:" .. tostring(expected) .. " got:" .. tostring(current)
+                return { "RACE", "VER", key, expected, current or "" }
             end
 
             -- 检查 Key 不存在 (用于 Insert)
@@ -35,7 +79,7 @@ if checks then
         elseif op == "NX" then
             local key = check[2]
             if redis_call("EXISTS", key) == 1 then
-                return "RACE: Key already exists " .. key
+                return { "RACE", "NX", key, "", "" }
             end
 
             -- 检查 Key 存在 (用于 Update/Delete)
@@ -43,7 +87,7 @@ if checks then
         elseif op == "EX" then
             local key = check[2]
             if redis_call("EXISTS", key) == 0 then
-                return "RACE: Key does not exist " .. key
+                return { "RACE", "EX", key, "", "" }
             end
 
             -- 检查唯一索引 (字符串型)
@@ -55,18 +99,31 @@ if checks then
             -- ZRANGE key [val\x00 [val\x00\xff BYLEX LIMIT 0 1
             local res = redis_call("ZRANGE", idx_key, start_val, end_val, "BYLEX", "LIMIT", 0, 1)
             if #res > 0 then
-                if next(deleted) ~= nil then
-                    -- member 是 value\x00row_id，row_id 不含 0x00，故最后一个 0x00 即终止符
-                    local row_key = string_match(res[1], ".*%z(.*)$")
-                    if deleted[row_key] then
-                        -- 唯一索引指向的 key 在本次事务中被删除了，则不算冲突
-                    else
-                        return "UNIQUE: Constraint violation (str) on " .. idx_key
-                    end
+                -- member 是 value\x00row_id，row_id 不含 0x00，故最后一个 0x00 即终止符
+                local row_key = string_match(res[1], ".*%z(.*)$")
+                if deleted[row_key] then
+                    -- 唯一索引指向的 key 在本次事务中被删除了，则不算冲突
                 else
-                    return "UNIQUE: Constraint violation (str) on " .. idx_key
+                    -- actual 为占用该唯一值的行id
+                    return { "UNIQUE", "UNIQ", idx_key, "", row_key }
                 end
             end
+
+            -- 检查增量后的值在边界内，同时要求 Key 存在 (用于 Increment)
+            -- 格式: ["BOUND", key, field, delta, min, max]，min/max为""表示无边界
+        elseif op == "BOUND" then
+            local key = check[2]
+            local field = check[3]
+            local current = redis_call("HGET", key, field)
+            if not current then
+                return { "RACE", "EX", key, "", "" }
+            end
+            local value = tonumber(current) + tonumber(check[4])
+            local min_val = tonumber(check[5])
+            local max_val = tonumber(check[6])
+            if (min_val and value < min_val) or (max_val and value > max_val) then
+                return { "BOUND", "BOUND", key .. ":" .. field, "[" .. check[5] .. ", " .. check[6] .. "]", tostring(value) }
+            end
         end
     end
 end
@@ -76,8 +133,43 @@ end
 -- ============================================================================
 if pushes then
     for _, cmd in ipairs(pushes) do
-        -- cmd 格式: ["HMSET", key, field, val, ...]
-        redis_call(unpack(cmd))
+        if cmd[1] == "INCR" then
+            -- 原子增量，并重建该字段的索引，发布索引变动
+            -- 格式: ["INCR", key, field, delta, kind, idx_key, row_id, channel, publish]，idx_key为""表示无索引
+            -- publish为发布命令，PUBLISH或集群模式下的SPUBLISH
+            local key = cmd[2]
+            local field = cmd[3]
+            local kind = cmd[5]
+            local idx_key = cmd[6]
+            local old_val
+            if idx_key ~= "" then
+                old_val = redis_call("HGET", key, field)
+            end
+            local new_val
+            if kind == "f" then
+                new_val = redis_call("HINCRBYFLOAT", key, field, cmd[4])
+            else
+                new_val = redis_call("HINCRBY", key, field, cmd[4])
+            end
+            if idx_key ~= "" then
+                local tail = "\0" .. cmd[7]
+                local old_member = to_sortable(kind, tonumber(old_val)) .. tail
+                local new_member = to_sortable(kind, tonumber(new_val)) .. tail
+                redis_call("ZREM", idx_key, old_member)
+                redis_call("ZADD", idx_key, 0, new_member)
+                if old_member ~= new_member then
+                    redis_call(cmd[9], cmd[8], cmsgpack.pack({ old_member, new_member }))
+                end
+            end
+        elseif cmd[1] == "ROWPUB" then
+            -- 发布原子增量后的整行内容，格式同HGETALL的结果
+            -- 格式: ["ROWPUB", key, channel, publish]
+            redis_call(cmd[4], cmd[3], cmsgpack.pack(redis_call("HGETALL", cmd[2])))
+        else
+            -- cmd 格式: ["HMSET", key, field, val, ...] 或 ["PUBLISH"/"SPUBLISH", channel, message]
+            -- 或 ["XADD", stream_key, "MAXLEN", "~", maxlen, "*", "ch", channels]
+            redis_call(unpack(cmd))
+        end
     end
 end
 
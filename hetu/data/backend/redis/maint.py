@@ -218,8 +218,19 @@ class RedisTableMaintenance(TableMaintenance):
                 pipe.execute()
         # 删除meta
         io.delete(self.meta_key(table_ref))
+        self._notify_index_requery(table_ref)
         return len(del_keys)
 
+    def _notify_index_requery(self, table_ref: TableReference) -> None:
+        """
+        索引订阅只监听提交时发布的索引变动，不在事务里的索引写入不会通知到。
+        向该表所有索引的频道发布空消息，让在线的索引订阅重新查询
+        """
+        client = self.client
+        for idx_name in table_ref.comp_cls.indexes_:
+            channel = client.index_channel(table_ref, idx_name)
+            client.io.execute_command(client.publish_command_, channel, b"")
+
     @override
     def do_rebuild_index_(self, table_ref: TableReference) -> int:
         """重建组件表的索引数据"""
@@ -273,4 +284,5 @@ class RedisTableMaintenance(TableMaintenance):
                         f"组件{table_ref.comp_name}的unique索引`{idx_name}`在重建时发现违反unique约束，"
                         f"可能是迁移时缩短了值类型、或新增了Unique标记导致。"
                     )
+        self._notify_index_requery(table_ref)
         return len(keys)
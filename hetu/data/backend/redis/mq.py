@@ -5,15 +5,13 @@
 @email: heeroz@gmail.com
 """
 
-import asyncio
 import logging
 import time
+from collections.abc import Iterable
 from typing import TYPE_CHECKING, final, override
 
-from ....common.multimap import MultiMap
 from ....i18n import _
 from ..base import MQClient
-from .pubsub import AsyncKeyspacePubSub
 
 if TYPE_CHECKING:
     from .client import RedisBackendClient
@@ -26,22 +24,20 @@ MAX_SUBSCRIBED = 5000
 class RedisMQClient(MQClient):
     """
     连接到消息队列的客户端，每个用户连接一个实例。
-    本客户端使用AsyncKeyspacePubSub，以redis的pubsub功能作为消息队列，redis的notify功能作为写入通知。
+    本客户端使用worker共享的PubSubMultiplexer，以redis的pubsub功能作为消息队列，redis的notify功能作为写入通知。
     """
 
     def __init__(self, client: RedisBackendClient):
         # 2种模式：
-        # a. 每个ws连接一个pubsub连接，分发交给servants，结构清晰，目前的模式，但网络占用高
-        # b. 每个worker一个pubsub连接，分发交给worker来做，这样连接数较少，但等于2套分发系统结构复杂
-        #    且这个方式如果redis维护变更了ip/集群规模等，整个服务会瘫痪，而a方式只要用户重连
-        # 这里采用a方式
+        # a. 每个ws连接一个pubsub连接，分发交给servants，结构清晰，但连接数和redis输出缓冲随用户数增长
+        # b. 每个worker一个pubsub连接，分发交给worker来做，连接数只和redis节点数有关
+        # 这里采用b方式，redis拓扑变更由AsyncKeyspacePubSub自动重新订阅
+        super().__init__()
         self._client = client
         # redis-py库 cluster模式的pubsub不支持异步，不支持gather消息，用自己写的
-        self._mq = AsyncKeyspacePubSub(client.aio)
+        self._mq = client.pubsub_mux().handle()
 
         self.subscribed = set()
-        self.pulled_deque = MultiMap()  # 可按时间查询的消息队列
-        self.pulled_set = set()  # 和pulled_deque内容保持一致的set，方便去重
 
     @override
     async def close(self):
@@ -50,8 +46,14 @@ class RedisMQClient(MQClient):
     @override
     async def subscribe(self, channel_name) -> None:
         """订阅频道，频道名通过 client.xxx_channel(table_ref) 获得"""
-        await self._mq.subscribe(channel_name)
-        self.subscribed.add(channel_name)
+        await self.subscribe_many([channel_name])
+
+    @override
+    async def subscribe_many(self, channel_names: Iterable[str]) -> None:
+        """批量订阅频道，同一Redis节点的频道合并为一条SUBSCRIBE命令，只等待一次确认"""
+        channel_names = list(channel_names)
+        await self._mq.subscribe_many(channel_names)
+        self.subscribed.update(channel_names)
         if len(self.subscribed) > MAX_SUBSCRIBED:
             # 抑制此警告可通过修改hetu.backend.redis.MAX_SUBSCRIBED参数
             logger.warning(
@@ -62,7 +64,14 @@ class RedisMQClient(MQClient):
     async def unsubscribe(self, channel_name) -> None:
         """取消订阅频道，频道名通过 client.xxx_channel(table_ref) 获得"""
         await self._mq.unsubscribe(channel_name)
-        self.subscribed.remove(channel_name)
+        self.subscribed.discard(channel_name)
+
+    @override
+    async def unsubscribe_many(self, channel_names: Iterable[str]) -> None:
+        """批量取消订阅频道"""
+        channel_names = list(channel_names)
+        await self._mq.unsubscribe_many(channel_names)
+        self.subscribed.difference_update(channel_names)
 
     @override
     async def pull(self) -> None:
@@ -89,41 +98,23 @@ class RedisMQClient(MQClient):
             dropped = set(self.pulled_deque.pop(0, time.time() - 120))
             if dropped:
                 self.pulled_set -= dropped
+                self._drop_payloads(dropped)
                 logger.warning(
                     _("⚠️ [💾Redis] 订阅更新通知来不及处理，"
                     "丢弃了2分钟前的消息共{count}条").format(count=len(dropped))
                 )
 
-            # 判断是否已在deque中了，去重用。self.get_message也会自动去重，
-            # 但get_message一次只取部分(interval)消息，不能完全去重
+            # keyspace通知只说明有变动，其他频道（如索引变动）的消息带有内容，要保存下来。
+            # 从变动日志补发的消息没有内容，维护工具发布的是空消息，该频道都要重新读取
+            if not channel_name.startswith("__keyspace@"):
+                self._add_payload(channel_name, msg["data"] or None)
+
+            self._mark_pulled(channel_name)
+            # 判断是否已在deque中了，去重用。get_message合批等待期间的重复消息在此合并
             if channel_name not in self.pulled_set:
                 self.pulled_deque.add(time.time(), channel_name)
                 self.pulled_set.add(channel_name)
-
-    @override
-    async def get_message(self) -> set[str]:
-        """
-        pop并返回之前pull()到本地的消息，只pop收到时间大于1/UPDATE_FREQUENCY的消息。
-        留1/UPDATE_FREQUENCY时间是为了消息的合批。
-
-        之后SubscriptionBroker会对该消息进行分析，并重新读取数据库获数据。
-        如果没有消息，则堵塞到永远。
-        """
-        pulled_deque = self.pulled_deque
-
-        interval = 1 / self.UPDATE_FREQUENCY
-        # 如果没数据，等待直到有数据
-        while not pulled_deque:
-            await asyncio.sleep(interval)
-
-        while True:
-            # 只取超过interval的数据，这样可以减少频繁更新。set一下可以合并相同消息
-            rtn = set(pulled_deque.pop(0, time.time() - interval))
-            if rtn:
-                self.pulled_set -= rtn
-                # logger.debug(f"🔔 [💾Redis] 发送通知给客户端: {str(rtn)[0:100]}...")
-                return rtn
-            await asyncio.sleep(interval)
+                self._notify_pulled()
 
     @property
     @override
@@ -8,15 +8,66 @@
 import asyncio
 import logging
 from asyncio.queues import Queue
+from collections.abc import Callable, Iterable
 from functools import partial
 
+import msgpack
 from redis.asyncio.client import PubSub, Redis
 from redis.asyncio.cluster import ClusterNode, RedisCluster
 from redis.cluster import LoadBalancingStrategy
-from redis.exceptions import SlotNotCoveredError
+from redis.crc import key_slot
+from redis.exceptions import RedisError, ResponseError, SlotNotCoveredError
 
 logger = logging.getLogger(__name__)
 
+# 记录变动日志读取位置的间隔（秒）
+CHANGE_LOG_CHECKPOINT_INTERVAL = 1.0
+# 补发时每次读取变动日志的条数
+CHANGE_LOG_REPLAY_BATCH = 1000
+
+
+def _stream_id(entry_id: bytes) -> tuple[int, int]:
+    ms, seq = entry_id.split(b"-")
+    return int(ms), int(seq)
+
+
+class ShardedPubSub(PubSub):
+    """
+    redis-py的异步PubSub没有分片频道(SSUBSCRIBE)的接口，这里补上。
+    分片频道记录在 `shard_channels`，断线重连时和普通频道一起重新订阅。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_channels: set[str] = set()
+
+    @property
+    def subscribed(self):
+        return bool(self.shard_channels) or super().subscribed
+
+    async def ssubscribe(self, *channels: str):
+        """订阅分片频道，所有频道必须在同一个slot"""
+        ret_val = await self.execute_command("SSUBSCRIBE", *channels)
+        self.shard_channels.update(channels)
+        return ret_val
+
+    async def sunsubscribe(self, *channels: str):
+        """取消订阅分片频道，所有频道必须在同一个slot"""
+        self.shard_channels.difference_update(channels)
+        return await self.execute_command("SUNSUBSCRIBE", *channels)
+
+    async def on_connect(self, connection):
+        await super().on_connect(connection)
+        for slot_channels in _group_by_slot(self.shard_channels).values():
+            await self.ssubscribe(*slot_channels)
+
+
+def _group_by_slot(channels: Iterable[str]) -> dict[int, list[str]]:
+    by_slot: dict[int, list[str]] = {}
+    for channel in channels:
+        by_slot.setdefault(key_slot(channel.encode()), []).append(channel)
+    return by_slot
+
 
 class AsyncKeyspacePubSub:
     """
@@ -25,17 +76,30 @@ class AsyncKeyspacePubSub:
     * 自动总集所有Node的消息
     * 支持拓扑更新，自动跟随cluster的更改，不过有几秒延迟。
     * 支持任何精确频道，但不支持pattern订阅
+    * 指定change_log_of时，断线重新订阅后，从变动日志补发断线期间丢失的消息
+    * 集群模式下，指定is_sharded的频道用分片频道(SSUBSCRIBE)订阅，
+      消息只在该slot所在的分片内传播，不会广播到整个集群
     """
 
-    def __init__(self, client: Redis | RedisCluster):
+    def __init__(
+        self,
+        client: Redis | RedisCluster,
+        change_log_of: Callable[[str], str] | None = None,
+        is_sharded: Callable[[str], bool] | None = None,
+    ):
         """
         Parameters
         ----------
         client: redis.asyncio.Redis or redis.asyncio.cluster.RedisCluster
             redis.asyncio.Redis 或 redis.asyncio.cluster.RedisCluster 实例
+        change_log_of: Callable[[str], str] | None
+            返回频道所属的变动日志(Redis Stream)的key名，None为不使用变动日志
+        is_sharded: Callable[[str], bool] | None
+            返回频道是否为分片频道(由SPUBLISH发布)，只在集群模式下使用，None为都不是
         """
         self.main_client = client
         self.is_cluster = isinstance(client, RedisCluster)
+        self._is_sharded = is_sharded if self.is_cluster else None
 
         # 存储每个节点的独立 Client 和 PubSub
         # Key: 节点标识 (f"host:port" 或 "standalone"), Value: {'client': Redis, 'pubsub': PubSub}
@@ -54,6 +118,11 @@ class AsyncKeyspacePubSub:
         # 订阅通知
         self._subscribe_notify = asyncio.Condition()
 
+        # 变动日志的读取位置 {stream_key: (上上次检查点, 上次检查点)}
+        self._change_log_of = change_log_of
+        self._log_cursors: dict[str, tuple[bytes, bytes]] = {}
+        self._checkpoint_task = None
+
     def standalone_connect(self):
         """
         获取standalone的独立连接和pubsub
@@ -74,6 +143,7 @@ class AsyncKeyspacePubSub:
         task.add_done_callback(partial(self._on_node_listener_done, "standalone"))
         # 如果不保存task，task不会执行会被gc
         self._tasks.add(task)
+        self._start_checkpoint()
 
     def cluster_connect(self, node: ClusterNode):
         """
@@ -91,7 +161,10 @@ class AsyncKeyspacePubSub:
 
         # 这会导致每个mq client拥有自己独立的连接pool，问题不大因为订阅就是每个用户一个连接
         r_client = Redis(**connection_kwargs)
-        pubsub = r_client.pubsub()
+        # 参数同 Redis.pubsub()，不然会丢掉client的event_dispatcher（重新认证等事件）
+        pubsub = ShardedPubSub(
+            r_client.connection_pool, event_dispatcher=r_client._event_dispatcher
+        )
 
         self.node_resources[node_key] = {
             "client": r_client,
@@ -103,70 +176,123 @@ class AsyncKeyspacePubSub:
         task.add_done_callback(partial(self._on_node_listener_done, node_key))
         # 如果不保存task，task不会执行会被gc
         self._tasks.add(task)
+        self._start_checkpoint()
 
-    async def subscribe(self, channel: str):
+    async def _node_key_for(self, channel: str) -> str:
         """
-        精确订阅。根据 Channel 中的 Key 计算 Slot，路由到指定 Node 的 PubSub。
-        Channel 格式预期: __keyspace@<db>__:<keyname>
+        根据 Channel 中的 Key 计算 Slot，返回对应 Node 的标识，没有连接的话建立连接。
         """
-        target_node_key = "standalone"
+        if not self.is_cluster:
+            if "standalone" not in self.node_resources:
+                self.standalone_connect()
+            return "standalone"
 
-        if self.is_cluster:
-            assert isinstance(self.main_client, RedisCluster)
-            # 计算 Slot 和目标节点，如果找不到，说明node变更了，需要刷新拓扑
-            slot = self.main_client.keyslot(channel)
-            try:
-                node = self.main_client.nodes_manager.get_node_from_slot(
-                    slot,
-                    load_balancing_strategy=LoadBalancingStrategy.ROUND_ROBIN_REPLICAS,
-                )
-            # 加KeyError是因为redis-py库的bug，没捕捉这个
-            except (KeyError, SlotNotCoveredError):
-                # 如果slot不在覆盖范围内，强制刷新一次拓扑
-                await asyncio.sleep(0.25)
-                await self.main_client.nodes_manager.initialize()
-                node = self.main_client.nodes_manager.get_node_from_slot(
-                    slot,
-                    load_balancing_strategy=LoadBalancingStrategy.ROUND_ROBIN_REPLICAS,
-                )
+        assert isinstance(self.main_client, RedisCluster)
+        # 计算 Slot 和目标节点，如果找不到，说明node变更了，需要刷新拓扑
+        slot = self.main_client.keyslot(channel)
+        try:
+            node = self.main_client.nodes_manager.get_node_from_slot(
+                slot,
+                load_balancing_strategy=LoadBalancingStrategy.ROUND_ROBIN_REPLICAS,
+            )
+        # 加KeyError是因为redis-py库的bug，没捕捉这个
+        except (KeyError, SlotNotCoveredError):
+            # 如果slot不在覆盖范围内，强制刷新一次拓扑
+            await asyncio.sleep(0.25)
+            await self.main_client.nodes_manager.initialize()
+            node = self.main_client.nodes_manager.get_node_from_slot(
+                slot,
+                load_balancing_strategy=LoadBalancingStrategy.ROUND_ROBIN_REPLICAS,
+            )
 
-            if not node:
-                raise RuntimeError(f"Could not find node for channel: {channel}")
+        if not node:
+            raise RuntimeError(f"Could not find node for channel: {channel}")
 
-            target_node_key = node.name
+        # 检查我们是否已经建立了到该节点的连接
+        if node.name not in self.node_resources:
+            self.cluster_connect(node)
+        return node.name
 
-            # 检查我们是否已经建立了到该节点的连接
-            if target_node_key not in self.node_resources:
-                self.cluster_connect(node)
-        else:
-            if target_node_key not in self.node_resources:
-                self.standalone_connect()
+    async def subscribe(self, channel: str):
+        """
+        精确订阅。根据 Channel 中的 Key 计算 Slot，路由到指定 Node 的 PubSub。
+        Channel 格式预期: __keyspace@<db>__:<keyname>
+        """
+        await self.subscribe_many([channel])
+
+    async def subscribe_many(self, channels: Iterable[str]):
+        """
+        批量订阅。按 Node 分组，每个 Node 只发送一条 SUBSCRIBE 命令，
+        然后一起等待所有频道的订阅确认，总共只需一次往返。
+        """
+        by_node: dict[str, list[str]] = {}
+        for channel in channels:
+            node_key = await self._node_key_for(channel)
+            by_node.setdefault(node_key, []).append(channel)
+        if not by_node:
+            return
 
-        # 3. 执行订阅
-        ps = self.node_resources[target_node_key]["pubsub"]
-        await ps.subscribe(channel)
-        self._pending_subscribe.add(channel)
+        pending = set()
+        for node_key, node_channels in by_node.items():
+            # 先登记再发送，发送下一个Node时，前面Node的确认可能已经到了
+            pending.update(node_channels)
+            self._pending_subscribe.update(node_channels)
+            ps = self.node_resources[node_key]["pubsub"]
+            channels, shard_channels = self._split_sharded(node_channels)
+            if channels:
+                await ps.subscribe(*channels)
+            # 分片频道一条SSUBSCRIBE只能订阅同一slot的频道
+            for slot_channels in _group_by_slot(shard_channels).values():
+                await ps.ssubscribe(*slot_channels)
 
         # 等message返回了才能算订阅成功
         async with self._subscribe_notify:
             await self._subscribe_notify.wait_for(
-                lambda: channel not in self._pending_subscribe
+                lambda: pending.isdisjoint(self._pending_subscribe)
             )
 
-    async def unsubscribe(self, channel: str):
-        """
-        取消订阅，逻辑同 subscribe
-        """
-        target_node_key = "standalone"
+    def _split_sharded(self, channels: list[str]) -> tuple[list[str], list[str]]:
+        """把频道分为普通频道和分片频道"""
+        if self._is_sharded is None:
+            return channels, []
+        normal, sharded = [], []
+        for channel in channels:
+            (sharded if self._is_sharded(channel) else normal).append(channel)
+        return normal, sharded
+
+    def _node_key_of_subscribed(self, channel: str) -> str:
         if self.is_cluster:
             assert isinstance(self.main_client, RedisCluster)
             node = self.main_client.get_node_from_key(channel, replica=True)
             if node:
-                target_node_key = f"{node.host}:{node.port}"
+                return f"{node.host}:{node.port}"
+        return "standalone"
 
-        if target_node_key in self.node_resources:
-            await self.node_resources[target_node_key]["pubsub"].unsubscribe(channel)
-        self._subscribed.discard(channel)
+    async def unsubscribe(self, channel: str):
+        """
+        取消订阅，逻辑同 subscribe
+        """
+        await self.unsubscribe_many([channel])
+
+    async def unsubscribe_many(self, channels: Iterable[str]):
+        """
+        批量取消订阅，每个 Node 只发送一条 UNSUBSCRIBE 命令，不等待确认。
+        分片频道每个slot一条 SUNSUBSCRIBE 命令
+        """
+        by_node: dict[str, list[str]] = {}
+        for channel in channels:
+            by_node.setdefault(self._node_key_of_subscribed(channel), []).append(
+                channel
+            )
+            self._subscribed.discard(channel)
+        for node_key, node_channels in by_node.items():
+            if node_key in self.node_resources:
+                ps = self.node_resources[node_key]["pubsub"]
+                channels, shard_channels = self._split_sharded(node_channels)
+                if channels:
+                    await ps.unsubscribe(*channels)
+                for slot_channels in _group_by_slot(shard_channels).values():
+                    await ps.sunsubscribe(*slot_channels)
 
     async def resubscribe_all(self):
         """
@@ -175,8 +301,90 @@ class AsyncKeyspacePubSub:
         current_subscriptions = list(self._subscribed)
         self._subscribed.clear()
         self._pending_subscribe.clear()
-        for channel in current_subscriptions:
-            await self.subscribe(channel)
+        await self.subscribe_many(current_subscriptions)
+        await self.replay_change_logs()
+
+    def _start_checkpoint(self):
+        if self._change_log_of is not None and self._checkpoint_task is None:
+            self._checkpoint_task = asyncio.create_task(self._checkpoint_loop())
+            self._tasks.add(self._checkpoint_task)
+
+    async def _checkpoint_loop(self):
+        """定期记录各变动日志的最新位置"""
+        while True:
+            await asyncio.sleep(CHANGE_LOG_CHECKPOINT_INTERVAL)
+            task = self._resubscribe_task
+            if task is not None and not task.done():
+                continue  # 恢复中，位置要等补发完成后再前进
+            try:
+                await self.checkpoint()
+            except RedisError as e:
+                logger.warning(f"Change log checkpoint failed: {e}")
+
+    async def checkpoint(self):
+        """记录当前订阅频道所属的变动日志的最新位置"""
+        assert self._change_log_of is not None
+        streams = {self._change_log_of(channel) for channel in self._subscribed}
+        for stream in streams:
+            resp = await self.main_client.xrevrange(stream, count=1)
+            last = resp[0][0] if resp else b"0-0"
+            prev = self._log_cursors.get(stream)
+            # 补发时从上上次的检查点开始，因为连接可能在被发现断开前就已经静默断了一段时间
+            self._log_cursors[stream] = (prev[1] if prev else last, last)
+
+    async def replay_change_logs(self):
+        """
+        从变动日志补发检查点之后的消息，补发的消息没有内容(data为None)。
+        没有检查点，或检查点已被日志淘汰的，补发该日志下所有订阅的频道，让订阅者重新读取。
+        """
+        if self._change_log_of is None:
+            return
+        by_stream: dict[str, set[str]] = {}
+        for channel in self.subscribed:
+            by_stream.setdefault(self._change_log_of(channel), set()).add(channel)
+        for stream, channels in by_stream.items():
+            try:
+                replay = await self._read_change_log(stream, channels)
+            except RedisError as e:
+                logger.warning(f"Change log replay failed on {stream}: {e}")
+                replay = channels
+            for channel in replay:
+                await self.message_queue.put(
+                    {
+                        "type": "message",
+                        "pattern": None,
+                        "channel": channel.encode(),
+                        "data": None,
+                    }
+                )
+
+    async def _read_change_log(self, stream: str, channels: set[str]) -> set[str]:
+        """读取检查点之后变动过的频道，并把检查点推进到日志末尾"""
+        cursor = self._log_cursors.get(stream)
+        if cursor is None:
+            return channels
+        start = cursor[0]
+        try:
+            info = await self.main_client.xinfo_stream(stream)
+        except ResponseError:
+            return set()  # 日志不存在，没有任何变动
+        deleted = info.get("max-deleted-entry-id") or b"0-0"
+        if _stream_id(deleted) > _stream_id(start):
+            # 检查点之后的日志已被淘汰，不知道丢了哪些
+            return channels
+        replay = set()
+        while True:
+            entries = await self.main_client.xrange(
+                stream, min=b"(" + start, count=CHANGE_LOG_REPLAY_BATCH
+            )
+            for entry_id, fields in entries:
+                changed = msgpack.unpackb(fields[b"ch"], raw=False)
+                replay.update(channels.intersection(changed))
+                start = entry_id
+            if len(entries) < CHANGE_LOG_REPLAY_BATCH:
+                break
+        self._log_cursors[stream] = (start, start)
+        return replay
 
     async def _node_listener(self, pubsub: PubSub):
         """
@@ -187,8 +395,9 @@ class AsyncKeyspacePubSub:
                 if message:
                     # 可以在这里注入任意信息到message
                     mtype = message["type"]
-                    if mtype != "message":  # ignore_subscribe_messages
-                        if mtype == "subscribe":
+                    if mtype not in ("message", "smessage"):
+                        # ignore_subscribe_messages
+                        if mtype in ("subscribe", "ssubscribe"):
                             channel = message["channel"].decode()
                             self._subscribed.add(channel)
                             self._pending_subscribe.discard(channel)
@@ -247,3 +456,179 @@ class AsyncKeyspacePubSub:
         self.node_resources = {}
 
         logger.info("Resources closed.")
+
+
+class PubSubMultiplexer:
+    """
+    worker级共享的pubsub。整个worker只用一个 `AsyncKeyspacePubSub`（每个Redis节点一个连接），
+    按频道引用计数，收到的消息在进程内分发给订阅了该频道的各个 `PubSubHandle`。
+
+    相比每个用户连接各自一个pubsub连接，Redis连接数从用户数降为节点数，
+    同一条通知Redis也只需发送一次，大幅降低Redis的输出缓冲内存。
+    """
+
+    def __init__(
+        self,
+        client: Redis | RedisCluster,
+        change_log_of: Callable[[str], str] | None = None,
+        is_sharded: Callable[[str], bool] | None = None,
+    ):
+        self.loop = asyncio.get_running_loop()
+        self._pubsub = AsyncKeyspacePubSub(client, change_log_of, is_sharded)
+        # {channel: {handle, ...}} 订阅了该频道的handle
+        self._listeners: dict[str, set[PubSubHandle]] = {}
+        # {channel: task} 正在向Redis订阅中的频道，后来的handle等待同一个task
+        self._pending: dict[str, asyncio.Task] = {}
+        self._dispatch_task: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def handle(self) -> PubSubHandle:
+        """创建一个订阅句柄，每个用户连接一个"""
+        if self._dispatch_task is None:
+            self._dispatch_task = asyncio.create_task(self._dispatch())
+        return PubSubHandle(self)
+
+    @property
+    def channels(self) -> set[str]:
+        """当前worker向Redis订阅的所有频道"""
+        return set(self._listeners)
+
+    async def subscribe_many_(
+        self, handle: PubSubHandle, channels: Iterable[str]
+    ) -> None:
+        channels = list(channels)
+        new = []
+        for channel in channels:
+            listeners = self._listeners.get(channel)
+            if listeners is None:
+                listeners = self._listeners[channel] = set()
+                new.append(channel)
+            listeners.add(handle)
+        if new:
+            # 本批新频道合并为一次订阅
+            task = asyncio.create_task(self._pubsub.subscribe_many(new))
+            task.add_done_callback(partial(self._on_subscribed, new))
+            for channel in new:
+                self._pending[channel] = task
+
+        tasks = {task for ch in channels if (task := self._pending.get(ch))}
+        if not tasks:
+            return
+        try:
+            # shield防止某个连接取消时，把其他连接也在等的订阅一起取消了
+            await asyncio.shield(asyncio.gather(*tasks))
+        except BaseException:
+            if drop := self._release(handle, channels):
+                self._spawn(self._pubsub.unsubscribe_many(drop))
+            raise
+
+    def _on_subscribed(self, channels: list[str], task: asyncio.Task) -> None:
+        for channel in channels:
+            if self._pending.get(channel) is task:
+                del self._pending[channel]
+                if task.cancelled() or task.exception() is not None:
+                    # Redis订阅失败，清除登记，下次订阅时重新向Redis订阅。
+                    # 等待中的handle会收到异常并自行撤销
+                    self._listeners.pop(channel, None)
+
+    def _release(self, handle: PubSubHandle, channels: Iterable[str]) -> list[str]:
+        """撤销handle对这些频道的登记，返回已没人订阅、需要向Redis取消订阅的频道"""
+        drop = []
+        for channel in channels:
+            listeners = self._listeners.get(channel)
+            if listeners is None:
+                continue
+            listeners.discard(handle)
+            if listeners:
+                continue
+            task = self._pending.get(channel)
+            if task is not None and not task.done():
+                # 订阅还没完成，完成后再取消，否则取消命令可能先于订阅命令发出
+                task.add_done_callback(partial(self._drop_unused, [channel]))
+                continue
+            del self._listeners[channel]
+            drop.append(channel)
+        return drop
+
+    def _drop_unused(self, channels: list[str], _task: asyncio.Task) -> None:
+        drop = []
+        for channel in channels:
+            if self._listeners.get(channel) == set():
+                del self._listeners[channel]
+                drop.append(channel)
+        if drop:
+            self._spawn(self._pubsub.unsubscribe_many(drop))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def unsubscribe_many_(
+        self, handle: PubSubHandle, channels: Iterable[str]
+    ) -> None:
+        if drop := self._release(handle, channels):
+            await self._pubsub.unsubscribe_many(drop)
+
+    async def _dispatch(self):
+        """把收到的消息分发给订阅了该频道的handle"""
+        while True:
+            message = await self._pubsub.get_message()
+            channel = message["channel"].decode()
+            for handle in self._listeners.get(channel, ()):
+                handle.message_queue.put_nowait(message)
+
+    async def close(self):
+        if self._dispatch_task is not None:
+            self._dispatch_task.cancel()
+            self._dispatch_task = None
+        for task in (*self._pending.values(), *self._tasks):
+            task.cancel()
+        self._pending.clear()
+        self._tasks.clear()
+        self._listeners.clear()
+        await self._pubsub.close()
+
+
+class PubSubHandle:
+    """
+    `PubSubMultiplexer` 的订阅句柄，接口和 `AsyncKeyspacePubSub` 一致，
+    每个用户连接一个，只收到自己订阅的频道的消息。
+    """
+
+    def __init__(self, mux: PubSubMultiplexer):
+        self._mux = mux
+        self._channels: set[str] = set()
+        self.message_queue: Queue[dict] = asyncio.Queue()
+
+    async def subscribe(self, channel: str):
+        await self.subscribe_many([channel])
+
+    async def subscribe_many(self, channels: Iterable[str]):
+        channels = list(channels)
+        self._channels.update(channels)
+        try:
+            await self._mux.subscribe_many_(self, channels)
+        except BaseException:
+            self._channels.difference_update(channels)
+            raise
+
+    async def unsubscribe(self, channel: str):
+        await self.unsubscribe_many([channel])
+
+    async def unsubscribe_many(self, channels: Iterable[str]):
+        channels = list(channels)
+        self._channels.difference_update(channels)
+        await self._mux.unsubscribe_many_(self, channels)
+
+    async def get_message(self):
+        """从本连接的队列获取消息，如果没有消息则堵塞等待。"""
+        return await self.message_queue.get()
+
+    @property
+    def subscribed(self):
+        return set(self._channels)
+
+    async def close(self):
+        """取消本连接的所有订阅，共享的pubsub连接不关闭"""
+        await self.unsubscribe_many(list(self._channels))
@@ -10,7 +10,8 @@ from typing import TYPE_CHECKING, cast
 import numpy as np
 
 from ...i18n import _
-from .base import RaceCondition, RowFormat, UniqueViolation
+from ..spatial import CELL_FIELD
+from .base import BoundViolation, RaceCondition, RowFormat, UniqueViolation
 from .idmap import RowState
 from .table import TableReference
 
@@ -157,10 +158,11 @@ class SessionRepository:
 
         return None, False
 
-    async def get_by_id(self, row_id: Int64) -> np.record | None:
+    async def get_by_id(self, row_id: Int64, validate: bool = True) -> np.record | None:
         """
         从数据库获取单行数据，并放入`Session`缓存。
         本指令如果命中缓存，不会去数据库查询。
+        `validate` 参数见 `get`。
         """
         idmap = self._session.idmap
         ref = self.ref
@@ -170,19 +172,32 @@ class SessionRepository:
         if row_stat is not None:
             if row_stat == RowState.DELETE:
                 return None
-            else:
-                return row
+            if validate:
+                idmap.validate(ref, row_id)
+            return row
 
-        # 缓存未命中，查询数据库
-        row = await self._session.master_or_servant.get(ref, row_id, RowFormat.STRUCT)
+        # 跨事务缓存的行可能已过期，只用于需要版本检查的读取
+        if not validate or (row := idmap.take_warm(ref, row_id)) is None:
+            # 缓存未命中，查询数据库
+            row = await self._session.master_or_servant.get(
+                ref, row_id, RowFormat.STRUCT
+            )
+            if row is not None:
+                idmap.add_clean(ref, row, validate)
         if row is not None:
-            idmap.add_clean(ref, row)
+            # 之前对该行的原子增量，读取后转为普通的本地修改（随update做版本检查）
+            if deltas := idmap.pop_deltas(ref, row_id):
+                for field, (delta, min_, max_) in deltas.items():
+                    self._increment_cached(row, field, delta, min_, max_)  # type: ignore
+                row, _stat = idmap.get(ref, row_id)
         return row
 
     async def get(
         self,
         index_name: str | None = None,
         query_value: IndexScalar | None = None,
+        *,
+        validate: bool = True,
         **kwargs: IndexScalar,
     ) -> np.record | None:
         """
@@ -195,6 +210,11 @@ class SessionRepository:
             辅助参数，如果不便使用kwargs参数时使用。
         query_value: IndexScalar | None
             辅助参数，如果不便使用kwargs参数时使用。
+        validate: bool
+            默认True，提交时会检查读到的行是否已被其他事务修改，修改了则事务冲突重试。
+            设为False表示快照读：行照常缓存在事务中，但提交时不检查其版本。
+            适合读取很少变化的配置类数据，减少无关修改引起的冲突。
+            之后若用默认方式再次读取、或修改了该行，则恢复版本检查。
         kwargs: IndexScalar
             查询字段和值，例如 `id=1234567890`。只能查询一个字段，且该字段必须有索引。
 
@@ -230,10 +250,14 @@ class SessionRepository:
             idmap = self._session.idmap
             rows = idmap.filter(self.ref, **{index_name: query_value})
             if len(rows) > 0:
+                if validate:
+                    idmap.validate(self.ref, int(rows[0].id))
                 return rows[0]
 
             # cache未命中，去数据库查询
-            rows = await self.range(index_name, query_value, limit=1, desc=False)
+            rows = await self.range(
+                index_name, query_value, limit=1, desc=False, validate=validate
+            )
             if rows.shape[0] > 0:
                 return rows[0]
             # 等值查询unique列读空：登记negative observation，供insert/update判定竞态。
@@ -242,7 +266,7 @@ class SessionRepository:
                 idmap.mark_absent(self.ref, index_name, query_value)
             return None
         else:
-            row = await self.get_by_id(int(query_value))
+            row = await self.get_by_id(int(query_value), validate)
             if row is None:
                 # 主键id恒为unique，登记“本事务观察到该id不存在”
                 self._session.idmap.mark_absent(self.ref, "id", int(query_value))
@@ -255,6 +279,7 @@ class SessionRepository:
         _right: IndexScalar | None = None,
         limit: int = 10,
         desc: bool = False,
+        validate: bool = True,
         **kwargs: tuple[IndexScalar, IndexScalar],
     ) -> np.recarray:
         """
@@ -281,6 +306,8 @@ class SessionRepository:
             限制返回的行数，越少越快。负数表示不限制行数。
         desc: bool
             是否降序排列
+        validate: bool
+            为False时作为快照读，提交时不检查这些行的版本，见 `get`。
 
         Returns
         -------
@@ -336,7 +363,7 @@ class SessionRepository:
         # 再根据 id 列表查询数据行，可以命中缓存
         rows = []
         for _id in row_ids:
-            if row := await self.get_by_id(_id):
+            if row := await self.get_by_id(_id, validate):
                 rows.append(row)
 
         # 转换成 np.recarray 返回
@@ -345,8 +372,55 @@ class SessionRepository:
         else:
             return np.rec.array(np.stack(rows, dtype=comp_cls.dtypes))
 
-    @staticmethod
-    def _raise_unique_conflict(conflict: str, is_race: bool, op: str) -> None:
+    async def range_box(
+        self,
+        x0: float,
+        y0: float,
+        x1: float,
+        y1: float,
+        limit: int = 100,
+        validate: bool = True,
+    ) -> np.recarray:
+        """
+        框选查询，返回坐标在矩形 `[x0, x1] × [y0, y1]` （闭区间）内的数据，限制 `limit` 条。
+        Component需要用 `define_component(spatial=...)` 开启空间索引。
+
+        矩形覆盖的每行格子各查询一次 `_cell` 索引，再按精确坐标筛选，
+        矩形越接近格子边长，多查询出的行越少。其他同 `range`。
+
+        每行格子不限制查询行数（格子内矩形外的行会占用名额），筛选后凑够 `limit`
+        条就不再查询后面的格子行。
+
+        Parameters
+        ----------
+        x0, y0, x1, y1: float
+            矩形的左下和右上坐标。
+        limit: int
+            限制返回的行数，负数表示不限制行数。
+        validate: bool
+            为False时作为快照读，提交时不检查这些行的版本，见 `get`。
+        """
+        comp_cls = self.ref.comp_cls
+        grid = comp_cls.spatial_
+        if grid is None:
+            raise ValueError(
+                _("{comp_name} 组件没有开启空间索引").format(comp_name=comp_cls.name_)
+            )
+        ranges = grid.box_ranges(x0, y0, x1, y1)
+        predicate = grid.box_predicate(comp_cls, x0, y0, x1, y1)
+        parts = []
+        count = 0
+        for left, right in ranges:
+            rows = await self.range(CELL_FIELD, left, right, -1, validate=validate)
+            rows = rows[predicate.mask(rows)]
+            parts.append(rows)
+            count += len(rows)
+            if 0 <= limit <= count:
+                break
+        rows = np.rec.array(np.concatenate(parts))
+        return rows[:limit] if limit >= 0 else rows
+
+    def _raise_unique_conflict(self, conflict: str, is_race: bool, op: str) -> None:
         """
         根据 `is_unique_conflicts` 的判定抛出合适的异常：
 
@@ -359,7 +433,9 @@ class SessionRepository:
             raise RaceCondition(
                 _(
                     "{op} race: row.{field} 被并发事务抢占（本事务曾观察其不存在）"
-                ).format(op=op, field=conflict)
+                ).format(op=op, field=conflict),
+                key=self._session.master.index_key(self.ref, conflict),
+                check="UNIQ",
             )
         raise UniqueViolation(f"{op} failed: row.{conflict} violates a unique index.")
 
@@ -377,6 +453,9 @@ class SessionRepository:
         """
         assert row["_version"] == 0, "Insert row's _version must be 0."
 
+        if grid := self.ref.comp_cls.spatial_:
+            grid.fill(row)
+
         # unique check
         conflict, is_race = await self.is_unique_conflicts(row, insert=True)
         if conflict:
@@ -406,6 +485,9 @@ class SessionRepository:
         if len(changed_fields) == 0:
             raise ValueError("No fields changed, cannot update.")
 
+        if grid := self.ref.comp_cls.spatial_:
+            grid.fill(row)
+
         # unique check
         conflict, is_race = await self.is_unique_conflicts(row)
         if conflict:
@@ -413,6 +495,142 @@ class SessionRepository:
 
         self._session.idmap.update(self.ref, row)
 
+    def _check_incrementable(self, field: str, delta: int | float) -> np.dtype:
+        """检查字段能否原子增量，返回字段的dtype"""
+        comp_cls = self.ref.comp_cls
+        if field not in comp_cls.prop_idx_map_ or field in ("id", "_version"):
+            raise ValueError(
+                _("Component `{comp_name}` 没有可增量的字段`{field}`").format(
+                    comp_name=comp_cls.name_, field=field
+                )
+            )
+        dtype = comp_cls.dtype_map_[field]
+        is_int = np.issubdtype(dtype, np.integer)
+        if not (is_int or np.issubdtype(dtype, np.floating)):
+            raise ValueError(
+                _("increment只支持整数和浮点字段，`{field}`的类型为`{dtype}`").format(
+                    field=field, dtype=dtype
+                )
+            )
+        if is_int and not isinstance(delta, (int, np.integer)):
+            raise ValueError(
+                _("整数字段`{field}`的增量必须是整数，传入了`{delta}`").format(
+                    field=field, delta=delta
+                )
+            )
+        if field in comp_cls.uniques_:
+            raise ValueError(
+                _("unique字段`{field}`不支持increment，请用get+update").format(
+                    field=field
+                )
+            )
+        # 空间索引要按新坐标重算格子，数据库侧做不到
+        grid = comp_cls.spatial_
+        if grid and field in (grid.x, grid.y, CELL_FIELD):
+            raise ValueError(
+                _("空间索引的字段`{field}`不支持increment，请用get+update").format(
+                    field=field
+                )
+            )
+        # 数据库侧用double重算索引值，float32会和本地编码出的索引值不一致
+        if field in comp_cls.indexes_ and not is_int and dtype != np.float64:
+            raise ValueError(
+                _("索引字段`{field}`只有float64类型支持increment").format(field=field)
+            )
+        return dtype
+
+    @staticmethod
+    def _clamp_bounds(
+        dtype: np.dtype, min_: int | float | None, max_: int | float | None
+    ) -> tuple[int | float | None, int | float | None]:
+        """整数字段的边界要再受类型本身的取值范围限制，防止溢出"""
+        if not np.issubdtype(dtype, np.integer):
+            return min_, max_
+        info = np.iinfo(dtype)
+        lo = int(info.min) if min_ is None else max(int(info.min), min_)
+        hi = int(info.max) if max_ is None else min(int(info.max), max_)
+        return lo, hi
+
+    def _increment_cached(
+        self,
+        row: np.record,
+        field: str,
+        delta: int | float,
+        min_: int | float | None,
+        max_: int | float | None,
+    ) -> None:
+        """对已在Session缓存中的行做增量：本地检查边界，然后当作普通update"""
+        dtype = self.ref.comp_cls.dtype_map_[field]
+        min_, max_ = self._clamp_bounds(dtype, min_, max_)
+        new_value = row[field].item() + delta
+        if (min_ is not None and new_value < min_) or (
+            max_ is not None and new_value > max_
+        ):
+            raise BoundViolation(
+                _("increment失败：row.{field}={value}超出边界[{min}, {max}]").format(
+                    field=field, value=new_value, min=min_, max=max_
+                )
+            )
+        new_row = row.copy()
+        new_row[field] = new_value
+        self._session.idmap.update(self.ref, new_row)
+
+    def increment(
+        self,
+        row_id: Int64,
+        field: str,
+        delta: int | float,
+        min: int | float | None = None,
+        max: int | float | None = None,
+    ) -> None:
+        """
+        向Session中添加一个原子增量操作：`row.field += delta`。
+
+        如果该行没有在本事务中读取过，提交时由数据库原子执行（Redis为`HINCRBY`，
+        SQL为`SET x = x + ?`），**不需要**先`get`，也不会对该行做版本检查，所以并发的
+        增量之间不会互相冲突，适合金币、击杀数、全服活动进度等热点计数器。
+        索引和订阅会照常更新。
+
+        如果该行已在本事务中读取过，则等价于修改缓存中的行再`update`，依然会做版本检查。
+        之后再`get`该行，会读到增量后的值，并转为普通的`update`。
+
+        Parameters
+        ----------
+        row_id: int
+            行的主键ID。行不存在时，提交会抛出 `RaceCondition`。
+        field: str
+            要增量的字段名，只支持整数和浮点字段，不支持unique字段。
+        delta: int | float
+            增量，可以为负数。整数字段的增量必须是整数。
+        min: int | float | None
+            增量后的值不得小于此值，否则抛出 `BoundViolation`。
+        max: int | float | None
+            增量后的值不得大于此值，否则抛出 `BoundViolation`。
+            整数字段的边界还会受字段类型本身的取值范围限制。
+
+        Examples
+        --------
+        ::
+
+            # 扣100金币，不够则抛出BoundViolation
+            session.using(Wallet).increment(wallet_id, "gold", -100, min=0)
+        """
+        dtype = self._check_incrementable(field, delta)
+        if isinstance(delta, np.generic):
+            delta = delta.item()
+        row_id = int(row_id)
+
+        idmap = self._session.idmap
+        row, row_stat = idmap.get(self.ref, row_id)
+        if row_stat == RowState.DELETE:
+            raise LookupError("Cannot increment: row already deleted.")
+        if row is not None:
+            self._increment_cached(row, field, delta, min, max)
+            return
+
+        min_, max_ = self._clamp_bounds(dtype, min, max)
+        idmap.add_delta(self.ref, row_id, field, delta, min_, max_)
+
     def upsert(self, **kwargs: IndexScalar) -> UpsertContext:
         """
         使用async with语法，根据Unique索引，查询并返回一行数据，如果不存在则返回新行数据。
@@ -92,7 +92,8 @@ class Session(AbstractAsyncContextManager):
             当提交数据时，发现数据已被其他事务修改，抛出此异常
         """
         # 如果数据库不具备写入通知功能，要在此手动往MQ推送数据变动消息。
-        if self._idmap.is_dirty:
+        # 用到了跨事务缓存的行时，只读事务也要提交，以检查这些行是否过期
+        if self._idmap.is_dirty or self._idmap.has_warm_hits:
             await self._master.commit(self._idmap)
         self.clean()
 
@@ -18,7 +18,7 @@ from sqlalchemy import exc as sa_exc
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
 from ....i18n import _
-from ..base import BackendClient, RaceCondition, RowFormat
+from ..base import BackendClient, BoundViolation, RaceCondition, RowFormat
 
 if TYPE_CHECKING:
     from ...component import BaseComponent
@@ -776,7 +776,8 @@ class SQLBackendClient(BackendClient, alias="sql"):
         assert not self.is_servant, _("从节点不允许提交事务")
 
         dirties = idmap.get_dirty_rows()
-        if not dirties:
+        row_deltas = idmap.get_delta_rows()
+        if not dirties and not row_deltas:
             raise ValueError(_("没有脏数据需要提交"))
 
         notify_table = self.notify_table()
@@ -805,7 +806,11 @@ class SQLBackendClient(BackendClient, alias="sql"):
                             if actual is None or actual != int(expected_version):
                                 raise RaceCondition(
                                     f"Version mismatch on read row id={int(row_id)} "
-                                    f"exp:{expected_version} got:{actual}"
+                                    f"exp:{expected_version} got:{actual}",
+                                    key=self.row_key(ref, row_id),
+                                    check="VER",
+                                    expected=str(expected_version),
+                                    actual=None if actual is None else str(actual),
                                 )
 
                     # 先删除，避免insert/update遇到本事务中将被删除数据导致unique冲突。
@@ -824,7 +829,10 @@ class SQLBackendClient(BackendClient, alias="sql"):
                             result = await conn.execute(stmt)
                             if result.rowcount != 1:
                                 raise RaceCondition(
-                                    f"Version mismatch when deleting row id={row_id}"
+                                    f"Version mismatch when deleting row id={row_id}",
+                                    key=self.row_key(ref, row_id),
+                                    check="VER",
+                                    expected=str(old_version),
                                 )
                             channels.add(self.row_channel(ref, row_id))
                             for index_name in ref.comp_cls.indexes_:
@@ -859,18 +867,59 @@ class SQLBackendClient(BackendClient, alias="sql"):
                             except sa_exc.IntegrityError as exc:
                                 if self._is_unique_violation(exc):
                                     raise RaceCondition(
-                                        f"UNIQUE violation: {exc}"
+                                        f"UNIQUE violation: {exc}",
+                                        key=self.row_key(ref, row_id),
+                                        check="UNIQ",
                                     ) from exc
                                 raise
                             if result.rowcount != 1:
                                 raise RaceCondition(
-                                    f"Version mismatch when updating row id={row_id}"
+                                    f"Version mismatch when updating row id={row_id}",
+                                    key=self.row_key(ref, row_id),
+                                    check="VER",
+                                    expected=str(old_version),
                                 )
                             channels.add(self.row_channel(ref, row_id))
                             for index_name in updates:
                                 if index_name in indexes:
                                     channels.add(self.index_channel(ref, index_name))
 
+                    # 原子增量：SET x = x + ?，不检查版本，边界放在where里原子检查
+                    for ref, deltas_by_id in row_deltas.items():
+                        table = self.component_table(ref)
+                        indexes = ref.comp_cls.indexes_
+                        for row_id, deltas in deltas_by_id.items():
+                            conditions = [table.c.id == row_id]
+                            values: dict[str, Any] = {"_version": table.c._version + 1}
+                            for field, (delta, min_, max_) in deltas.items():
+                                new_value = table.c[field] + delta
+                                values[field] = new_value
+                                if min_ is not None:
+                                    conditions.append(new_value >= min_)
+                                if max_ is not None:
+                                    conditions.append(new_value <= max_)
+                            stmt = sa.update(table).where(*conditions).values(**values)
+                            result = await conn.execute(stmt)
+                            if result.rowcount != 1:
+                                exists = await conn.execute(
+                                    sa.select(table.c.id).where(table.c.id == row_id)
+                                )
+                                if exists.first() is None:
+                                    raise RaceCondition(
+                                        f"Row does not exist when incrementing "
+                                        f"row id={row_id}",
+                                        key=self.row_key(ref, row_id),
+                                        check="EX",
+                                    )
+                                raise BoundViolation(
+                                    f"Increment out of bounds on row id={row_id}: "
+                                    f"{deltas}"
+                                )
+                            channels.add(self.row_channel(ref, row_id))
+                            for index_name in deltas:
+                                if index_name in indexes:
+                                    channels.add(self.index_channel(ref, index_name))
+
                     for ref, (
                         inserts,
                         (_old_rows, _new_rows),
@@ -885,7 +934,9 @@ class SQLBackendClient(BackendClient, alias="sql"):
                             except sa_exc.IntegrityError as exc:
                                 if self._is_unique_violation(exc):
                                     raise RaceCondition(
-                                        f"UNIQUE violation: {exc}"
+                                        f"UNIQUE violation: {exc}",
+                                        key=self.row_key(ref, row_id),
+                                        check="UNIQ",
                                     ) from exc
                                 raise
                             channels.add(self.row_channel(ref, row_id))
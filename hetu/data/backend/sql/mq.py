@@ -12,7 +12,6 @@ from typing import TYPE_CHECKING, final, override
 
 import sqlalchemy as sa
 
-from ....common.multimap import MultiMap
 from ....i18n import _
 from ..base import MQClient
 
@@ -34,10 +33,9 @@ class SQLMQClient(MQClient):
     """
 
     def __init__(self, client: SQLBackendClient):
+        super().__init__()
         self._client = client
         self.subscribed = set()
-        self.pulled_deque = MultiMap()
-        self.pulled_set = set()
         self._last_notify_id = self._get_current_notify_id_sync()
         self._large_sub_warned = False
 
@@ -134,9 +132,11 @@ class SQLMQClient(MQClient):
                             ).format(count=len(dropped))
                         )
 
+                    self._mark_pulled(channel_name)
                     if channel_name not in self.pulled_set:
                         self.pulled_deque.add(time.time(), channel_name)
                         self.pulled_set.add(channel_name)
+                        self._notify_pulled()
 
                 if has_subscribed_updates:
                     break
@@ -150,21 +150,6 @@ class SQLMQClient(MQClient):
     def _should_use_channel_in_filter(subscribed_count: int) -> bool:
         return subscribed_count <= MAX_CHANNELS_IN_FILTER
 
-    @override
-    async def get_message(self) -> set[str]:
-        pulled_deque = self.pulled_deque
-        interval = 1 / self.UPDATE_FREQUENCY
-
-        while not pulled_deque:
-            await asyncio.sleep(interval)
-
-        while True:
-            rtn = set(pulled_deque.pop(0, time.time() - interval))
-            if rtn:
-                self.pulled_set -= rtn
-                return rtn
-            await asyncio.sleep(interval)
-
     @property
     @override
     def subscribed_channels(self) -> set[str]:
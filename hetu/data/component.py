@@ -19,6 +19,7 @@ from ..common import Singleton, csharp_keyword
 from ..common.permission import Permission
 from ..common.snowflake_id import SnowflakeID
 from ..i18n import _
+from .spatial import CELL_FIELD, SpatialGrid
 
 logger = logging.getLogger("HeTu.root")
 SNOWFLAKE_ID = SnowflakeID()
@@ -124,6 +125,7 @@ class BaseComponent:
     volatile_: bool = False  # 易失标记，此标记的Component每次维护会清空数据
     readonly_: bool = False  # 只读标记，暂无作用
     backend_: str  # 自定义该Component由哪个后端(数据库)负责储存和查询
+    spatial_: SpatialGrid | None = None  # 平面网格空间索引
     # ------------------------------内部变量-------------------------------
     dtypes: np.dtype  # np structured dtype
     """组件的numpy格式的dtype信息"""
@@ -146,31 +148,34 @@ class BaseComponent:
         readonly,
         backend,
         rls_compare,
+        spatial=None,
     ):
-        return json.dumps(
-            {
-                "namespace": str(namespace),
-                "name": str(name),
-                "permission": permission.name,
-                "rls_compare": rls_compare,
-                "volatile": bool(volatile),
-                "readonly": bool(readonly),
-                "backend": str(backend),
-                "properties": {
-                    name: {
-                        "default": (
-                            prop.default.decode("utf8")
-                            if type(prop.default) is bytes
-                            else prop.default
-                        ),
-                        "unique": bool(prop.unique),
-                        "index": bool(prop.index),
-                        "dtype": np.dtype(prop.dtype).str,
-                    }
-                    for name, prop in properties.items()
-                },
-            }
-        )
+        data = {
+            "namespace": str(namespace),
+            "name": str(name),
+            "permission": permission.name,
+            "rls_compare": rls_compare,
+            "volatile": bool(volatile),
+            "readonly": bool(readonly),
+            "backend": str(backend),
+            "properties": {
+                name: {
+                    "default": (
+                        prop.default.decode("utf8")
+                        if type(prop.default) is bytes
+                        else prop.default
+                    ),
+                    "unique": bool(prop.unique),
+                    "index": bool(prop.index),
+                    "dtype": np.dtype(prop.dtype).str,
+                }
+                for name, prop in properties.items()
+            },
+        }
+        # 只在开启时写入，不改变其他Component的json(版本号)
+        if spatial is not None:
+            data["spatial"] = spatial.to_json()
+        return json.dumps(data)
 
     @classmethod
     def load_json(cls, json_str: str, suffix: str = "") -> type[BaseComponent]:
@@ -198,6 +203,8 @@ class BaseComponent:
         if rls := data["rls_compare"]:
             rls = (getattr(operator, rls[0]), *rls[1:])
         comp.rls_compare_ = rls
+        spatial = data.get("spatial")
+        comp.spatial_ = SpatialGrid(*spatial) if spatial else None
         # 成员变量初始化
         # 从properties生成np structured dtype，align为True更慢，arm服务器会好些
         comp.dtypes = np.dtype(
@@ -354,6 +361,7 @@ def define_component(
     # readonly: bool = False,
     backend: str = "default",
     rls_compare: tuple[str, str, str] | None = None,
+    spatial: tuple[str, str, float] | None = None,
 ) -> type[BaseComponent]: ...
 @overload
 def define_component(
@@ -367,6 +375,7 @@ def define_component(
     # readonly: bool = False,
     backend: str = "default",
     rls_compare: tuple[str, str, str] | None = None,
+    spatial: tuple[str, str, float] | None = None,
 ) -> Callable[[type[BaseComponent]], type[BaseComponent]]: ...
 def define_component(
     _cls=None,
@@ -379,6 +388,7 @@ def define_component(
     # readonly=False,
     backend: str = "default",
     rls_compare: tuple[str, str, str] | None = None,
+    spatial: tuple[str, str, float] | None = None,
 ) -> Callable[[type[BaseComponent]], type[BaseComponent]] | type[BaseComponent]:
     """
     定义Component组件的schema模型
@@ -422,6 +432,11 @@ def define_component(
         - rls_compare[2]: Context属性名字符串，或Context.user_data的key名
 
         只有operator比较后返回True时允许读取此行。如果属性不存在，按nan处理（无法和任何值比较）。
+    spatial: tuple[str, str, float] | None
+        开启平面网格空间索引，格式为(x属性名, y属性名, 格子边长)。
+        开启后自动添加带索引的 `_cell` 属性，insert/update时按坐标自动计算，
+        可用 `Repository.range_box` 框选查询，客户端可订阅跟随移动的AOI（视野）范围。
+        格子边长一般取视野半径左右，太小框选要查询的格子行数多，太大要筛掉的行多。
     force: bool
         强制覆盖同名Component，单元测试用。
     _cls: class
@@ -593,6 +608,23 @@ def define_component(
         # 增加version属性，该属性只读（只能lua修改）
         properties["_version"] = Property(0, False, False, np.int32)
 
+        grid = None
+        if spatial is not None:
+            grid = SpatialGrid(*spatial)
+            for axis in (grid.x, grid.y):
+                assert axis in properties and np.issubdtype(
+                    properties[axis].dtype, np.number
+                ), _("{cls_name}.spatial的坐标属性{axis}必须是数字类型").format(
+                    cls_name=cls.__name__, axis=axis
+                )
+            assert grid.cell_size > 0, _(
+                "{cls_name}.spatial的格子边长必须大于0"
+            ).format(cls_name=cls.__name__)
+            assert CELL_FIELD not in properties, _(
+                "{cls_name}.{name}是空间索引的保留属性，外部不能重定义"
+            ).format(cls_name=cls.__name__, name=CELL_FIELD)
+            properties[CELL_FIELD] = Property(0, False, True, np.int64)
+
         # 检查class必须继承于BaseComponent
         assert issubclass(cls, BaseComponent), _(
             "{cls_name}必须继承于BaseComponent"
@@ -615,6 +647,7 @@ def define_component(
             False,
             backend,
             rls_compare,
+            grid,
         )
         cls.load_json(json_str)
 
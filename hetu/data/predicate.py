@@ -0,0 +1,104 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2024, Heerozh. All rights reserved.
+@license: Apache2.0 可用作商业项目，再随便找个角落提及用到了此项目 :D
+@email: heeroz@gmail.com
+"""
+
+import operator
+from collections.abc import Callable, Sequence
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+
+from ..i18n import _
+
+if TYPE_CHECKING:
+    from .component import BaseComponent
+
+# 一个筛选条件最多的子条件数，防止客户端提交过于复杂的条件
+MAX_PREDICATE_TERMS = 8
+
+_OPERATORS: dict[str, Callable[[np.ndarray, Any], np.ndarray]] = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": np.isin,
+}
+
+
+class RowPredicate:
+    """
+    订阅的声明式筛选条件，由客户端提交，格式为子条件的列表，所有子条件AND：
+    `[[属性名, 操作符, 值], ...]`，操作符为 `== != < <= > >= in`，`in` 的值为列表。
+
+    条件按列向量化计算，一次判断一批行，不执行任何客户端代码。
+    """
+
+    def __init__(self, comp_cls: type[BaseComponent], where: Sequence):
+        if not isinstance(where, (list, tuple)) or not where:
+            raise ValueError(_("筛选条件必须是非空的列表：{where}").format(where=where))
+        if len(where) > MAX_PREDICATE_TERMS:
+            raise ValueError(
+                _("筛选条件最多{max}个，实际{num}个").format(
+                    max=MAX_PREDICATE_TERMS, num=len(where)
+                )
+            )
+        self.comp_cls = comp_cls
+        self.terms: list[tuple[str, str, np.ndarray]] = []
+        for term in where:
+            if not isinstance(term, (list, tuple)) or len(term) != 3:
+                raise ValueError(_("无效的筛选条件：{term}").format(term=term))
+            field, op, value = term
+            dtype = comp_cls.dtype_map_.get(field) if type(field) is str else None
+            if dtype is None:
+                raise ValueError(
+                    _("筛选条件的属性不存在：{comp}.{field}").format(
+                        comp=comp_cls.name_, field=field
+                    )
+                )
+            if op not in _OPERATORS:
+                raise ValueError(_("未知的筛选操作符：{op}").format(op=op))
+            if (op == "in") != isinstance(value, (list, tuple)):
+                raise ValueError(_("无效的筛选条件：{term}").format(term=term))
+            try:
+                cast = np.asarray(value, dtype=dtype)
+                # 转换不能丢失信息，比如int属性的0.5截断为0，超长字符串被截短，
+                # 否则条件的含义会变。float属性的精度损失不算
+                lossy = dtype.kind != "f" and not np.array_equal(
+                    cast, np.asarray(value)
+                )
+            except (TypeError, ValueError, OverflowError) as e:
+                raise ValueError(
+                    _("筛选条件的值和属性类型不符：{term}").format(term=term)
+                ) from e
+            if lossy:
+                raise ValueError(
+                    _("筛选条件的值和属性类型不符：{term}").format(term=term)
+                )
+            value = cast
+            self.terms.append((field, op, value))
+
+    def __str__(self):
+        return " & ".join(f"{f} {op} {v.tolist()!r}" for f, op, v in self.terms)
+
+    def _evaluate(self, column: Callable[[str], np.ndarray], size: int) -> np.ndarray:
+        mask = np.ones(size, dtype=np.bool_)
+        for field, op, value in self.terms:
+            mask &= _OPERATORS[op](column(field), value)
+        return mask
+
+    def mask(self, rows: np.recarray) -> np.ndarray:
+        """返回rows中每行是否符合条件的bool数组"""
+        return self._evaluate(lambda field: rows[field], len(rows))
+
+    def mask_dicts(self, rows: Sequence[dict[str, Any]]) -> np.ndarray:
+        """同 `mask`，行为TYPED_DICT格式，只把用到的属性组成列"""
+        dtype_map = self.comp_cls.dtype_map_
+        return self._evaluate(
+            lambda field: np.array([row[field] for row in rows], dtype_map[field]),
+            len(rows),
+        )
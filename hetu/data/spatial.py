@@ -0,0 +1,96 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2024, Heerozh. All rights reserved.
+@license: Apache2.0 可用作商业项目，再随便找个角落提及用到了此项目 :D
+@email: heeroz@gmail.com
+"""
+
+import math
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from ..i18n import _
+from .predicate import RowPredicate
+
+if TYPE_CHECKING:
+    from .component import BaseComponent
+
+# 空间索引的属性名，define_component(spatial=...)时自动添加
+CELL_FIELD = "_cell"
+# 一次框选最多覆盖的格子行数，每行格子是一次索引范围查询
+MAX_BOX_CELL_ROWS = 64
+
+_CELL_X_BIAS = 1 << 31
+_CELL_ROW = 1 << 32
+
+
+class SpatialGrid:
+    """
+    平面网格空间索引。把(x, y)所在的格子编码为int64，存入 `_cell` 属性并建立普通索引，
+    提交前由Repository自动计算，不需要手动维护。
+
+    格子编码为 `cy * 2^32 + (cx + 2^31)`，同一行格子的编码连续，
+    所以框选一个矩形，只需每行格子各一次索引范围查询，再按精确坐标筛选。
+    """
+
+    def __init__(self, x: str, y: str, cell_size: float):
+        self.x = x
+        self.y = y
+        self.cell_size = float(cell_size)
+
+    def to_json(self) -> list:
+        return [self.x, self.y, self.cell_size]
+
+    def _cell_xy(self, x: float, y: float) -> tuple[int, int]:
+        size = self.cell_size
+        return math.floor(x / size), math.floor(y / size)
+
+    def cell_of(self, x: float, y: float) -> int:
+        """返回坐标所在格子的编码"""
+        cx, cy = self._cell_xy(x, y)
+        return cy * _CELL_ROW + cx + _CELL_X_BIAS
+
+    def fill(self, row: np.record) -> None:
+        """按行的坐标填写 `_cell` 属性"""
+        row[CELL_FIELD] = self.cell_of(float(row[self.x]), float(row[self.y]))
+
+    def box_ranges(
+        self, x0: float, y0: float, x1: float, y1: float
+    ) -> list[tuple[int, int]]:
+        """返回覆盖矩形的格子编码区间（闭区间），每行格子一个"""
+        if x0 > x1 or y0 > y1:
+            raise ValueError(
+                _("无效的矩形范围：({x0}, {y0}) - ({x1}, {y1})").format(
+                    x0=x0, y0=y0, x1=x1, y1=y1
+                )
+            )
+        cx0, cy0 = self._cell_xy(x0, y0)
+        cx1, cy1 = self._cell_xy(x1, y1)
+        if cy1 - cy0 + 1 > MAX_BOX_CELL_ROWS:
+            raise ValueError(
+                _("矩形范围太大，最多覆盖{max}行格子").format(max=MAX_BOX_CELL_ROWS)
+            )
+        return [
+            (cy * _CELL_ROW + cx0 + _CELL_X_BIAS, cy * _CELL_ROW + cx1 + _CELL_X_BIAS)
+            for cy in range(cy0, cy1 + 1)
+        ]
+
+    def box_predicate(
+        self,
+        comp_cls: type[BaseComponent],
+        x0: float,
+        y0: float,
+        x1: float,
+        y1: float,
+    ) -> RowPredicate:
+        """返回按精确坐标筛选矩形内的行的条件（闭区间）"""
+        return RowPredicate(
+            comp_cls,
+            [
+                [self.x, ">=", x0],
+                [self.x, "<=", x1],
+                [self.y, ">=", y0],
+                [self.y, "<=", y1],
+            ],
+        )
@@ -7,6 +7,7 @@
 
 import asyncio
 import logging
+import time
 from contextvars import ContextVar
 from typing import TYPE_CHECKING, Any, Mapping
 
@@ -14,21 +15,109 @@ import numpy as np
 
 from hetu.data.backend import BackendClient, RowFormat
 from hetu.data.component import Permission
+from hetu.data.predicate import RowPredicate
+from hetu.data.spatial import CELL_FIELD
+from hetu.data.subcache import SharedQueryCache
 from hetu.i18n import _
 
 if TYPE_CHECKING:
     from hetu.data.backend import Backend, TableReference
     from hetu.endpoint import Context
+    from hetu.system.rowcache import ConnectionRowCache
 
 logger = logging.getLogger("HeTu.root")
 
+# worker内所有连接共享的订阅查询结果
+SHARED_QUERIES = SharedQueryCache()
+
+
+async def shared_get(
+    servant: BackendClient,
+    table_ref: TableReference,
+    row_id: int,
+    since: float | None = None,
+) -> dict[str, Any] | None:
+    """
+    读取行的TYPED_DICT格式(不含_version)，同一worker内在since之后已读取过的话，直接共享其结果。
+    返回的行是共享的，不能修改，推送时不同连接也是同一个行对象，见 `SharedMessage`。
+    since为None表示必须重新读取
+    """
+
+    async def load():
+        row = await servant.get(table_ref, row_id, RowFormat.TYPED_DICT)
+        return None if row is None else _strip_version(row)
+
+    if since is None:
+        since = time.monotonic()
+    return await SHARED_QUERIES.fetch((table_ref, row_id), since, load)
+
+
+async def shared_row_change(
+    servant: BackendClient, table_ref: TableReference, payload: bytes
+) -> dict[str, Any] | None:
+    """
+    解析行变动消息，返回行的TYPED_DICT格式(不含_version)。
+    同一条消息会通知到worker内所有订阅了该行的连接，只解析一次，返回的行是共享的，不能修改
+    """
+
+    async def parse():
+        row = servant.parse_row_change(table_ref, payload)
+        return None if row is None else _strip_version(row)
+
+    # 消息内容决定了结果，不用考虑读取时间
+    return await SHARED_QUERIES.fetch((table_ref, payload), 0.0, parse)
+
+
+def _strip_version(row: dict[str, Any]) -> dict[str, Any]:
+    """返回去掉_version的行副本，共享的行不能直接修改"""
+    return {k: v for k, v in row.items() if k != "_version"}
+
 
 class BaseSubscription:
+    table_ref: TableReference
+    # {row_id: 行数据} 已推送给客户端的行，开启差量推送时由 `make_delta` 维护
+    sent: dict[int, dict[str, Any]] | None = None
+
+    def remember_sent(self, rows: list[dict[str, Any]]) -> None:
+        """记下订阅时返回给客户端的行，之后的推送只发送变化的属性"""
+        self.sent = {int(row["id"]): row for row in rows}
+
+    def make_delta(
+        self, updates: Mapping[int, dict[str, Any] | None]
+    ) -> dict[int, dict[str, Any] | None]:
+        """
+        把要推送的行转换为差量：客户端已有的行只保留变化的属性，没有变化的行不推送，
+        新的行发送整行，None表示删除。行数据可能是共享的，只记录引用，不修改。
+        """
+        sent = self.sent
+        if sent is None:
+            sent = self.sent = {}
+        rtn: dict[int, dict[str, Any] | None] = {}
+        for row_id, row in updates.items():
+            if row is None:
+                sent.pop(row_id, None)
+                rtn[row_id] = None
+                continue
+            old = sent.get(row_id)
+            sent[row_id] = row
+            if old is None:
+                rtn[row_id] = row
+                continue
+            patch = {k: v for k, v in row.items() if k not in old or old[k] != v}
+            if patch:
+                rtn[row_id] = patch
+        return rtn
+
     async def get_updated(
-        self, channel
+        self,
+        channel,
+        payloads: list[bytes] | None = None,
+        since: float | None = None,
     ) -> tuple[set[str], set[str], Mapping[int, dict[str, Any] | None]]:
         """
         channel收到通知后，前来调用此get_updated方法。
+        payloads为该channel上次以来收到的消息内容，None表示没有内容或有丢失。
+        since为收到通知的时间(time.monotonic)，之后worker内其他连接读取过的结果可以直接共享。
         返回 {需要新订阅的频道}, {需要取消订阅的频道}, {变更的row_id: 行数据，None表示删除}
         """
         raise NotImplementedError
@@ -73,10 +162,15 @@ class RowSubscription(BaseSubscription):
             cls.__cache.set({})
 
     async def get_updated(
-        self, channel
+        self,
+        channel,
+        payloads: list[bytes] | None = None,
+        since: float | None = None,
     ) -> tuple[set[str], set[str], Mapping[int, dict[str, Any] | None]]:
         """
         channel收到通知后，前来调用此get_updated方法。
+        payloads带有提交后的行内容时（见 `BackendClient.ROW_CHANGE_PAYLOAD`），直接使用最后一条，
+        否则读取数据库。
         返回 {空}, {空}, {变更的row_id: 行数据，None表示删除}
         """
         # 如果订阅有交叉，这里会重复被调用，需要一个class级别的cache，但外部每次收到channel消息时要清空该cache
@@ -84,13 +178,16 @@ class RowSubscription(BaseSubscription):
         if (cached := cache.get(channel, None)) is not None:
             return set(), set(), cached
 
-        row = await self.servant.get(self.table_ref, self.row_id, RowFormat.TYPED_DICT)
+        if payloads:
+            row = await shared_row_change(self.servant, self.table_ref, payloads[-1])
+        else:
+            # 其他连接也订阅了该行的话，共享读取结果，RLS各自判断
+            row = await shared_get(self.servant, self.table_ref, self.row_id, since)
         if row is None:
             rtn = {self.row_id: None}
         else:
             ctx = self.rls_ctx
             if ctx is None or ctx.rls_check(self.table_ref.comp_cls, row):
-                del row["_version"]
                 rtn = {self.row_id: row}
             else:
                 rtn = {self.row_id: None}
@@ -123,14 +220,94 @@ class IndexSubscription(BaseSubscription):
         self.query_param = query_param
         self.row_subs: dict[str, RowSubscription] = {}
         self.last_range_result = last_range_result
+        # {row_id: 索引成员值} 查询结果（RLS筛选前）的索引成员值，用于增量更新。
+        # None表示还没有，或后端不支持，第一次收到变动时通过重新查询获得
+        self.members: dict[int, bytes] | None = None
+        self.bounds: tuple[bytes, bytes] | None = None
 
     def add_row_subscriber(self, channel, row_id):
         self.row_subs[channel] = RowSubscription(
             self.table_ref, self.servant, self.rls_ctx, channel, row_id
         )
 
+    async def _query_range(self, since: float | None) -> set[int]:
+        """
+        重新查询范围，后端支持的话同时记下索引成员值，之后可以增量更新。
+        worker内其他连接有相同的查询，且在since之后查询过的话，直接共享其结果
+        """
+        servant = self.servant
+        ref = self.table_ref
+        qp = self.query_param
+
+        async def query():
+            members = await servant.range_index_members(ref, **qp)
+            if members is None:
+                return await servant.range(ref, **qp, row_format=RowFormat.ID_LIST)
+            return members
+
+        key = (ref, SubscriptionBroker.make_query_id_(ref, **qp))
+        if since is None:
+            since = time.monotonic()
+        result = await SHARED_QUERIES.fetch(key, since, query)
+        if isinstance(result, dict):
+            self.members = dict(result)
+        return set(result)
+
+    def _apply_index_changes(self, payloads: list[bytes]) -> set[int] | None:
+        """
+        用索引变动消息在本地更新查询结果，返回新的row_id集合。
+        变动影响到结果已满(limit)时的边界，需要重新查询时，返回None。
+        """
+        members = self.members
+        if members is None:
+            return None
+        if self.bounds is None:
+            qp = self.query_param
+            self.bounds = self.servant.index_bounds(
+                self.table_ref, qp["index_name"], qp["left"], qp["right"], qp["desc"]
+            )
+        low, high = self.bounds
+        limit = self.query_param["limit"]
+        desc = self.query_param["desc"]
+
+        def last_of(exclude=None) -> tuple[int, bytes] | None:
+            """结果中排在最后的成员"""
+            others = ((k, v) for k, v in members.items() if k != exclude)
+            pick = min if desc else max
+            return pick(others, key=lambda kv: kv[1], default=None)
+
+        def before(a: bytes, b: bytes) -> bool:
+            return a > b if desc else a < b
+
+        for payload in payloads:
+            row_id, new = self.servant.parse_index_change(payload)
+            in_range = new is not None and low <= new <= high
+            full = 0 < limit <= len(members)
+            if row_id in members:
+                if not in_range:
+                    # 移出范围，结果已满的话空出的位置要从数据库补
+                    del members[row_id]
+                    if full:
+                        return None
+                    continue
+                if full and (last := last_of(row_id)) and before(last[1], new):
+                    # 移到了原边界之后，可能被结果外的行超过
+                    return None
+                members[row_id] = new
+            elif in_range:
+                if not full:
+                    members[row_id] = new
+                elif (last := last_of()) and before(new, last[1]):
+                    # 挤进结果，原边界行被挤出
+                    del members[last[0]]
+                    members[row_id] = new
+        return set(members)
+
     async def get_updated(
-        self, channel
+        self,
+        channel,
+        payloads: list[bytes] | None = None,
+        since: float | None = None,
     ) -> tuple[set[str], set[str], Mapping[int, dict[str, Any] | None]]:
         """
         channel收到通知后，前来调用此get_updated方法。
@@ -139,11 +316,12 @@ class IndexSubscription(BaseSubscription):
         servant = self.servant
         ref = self.table_ref
         if channel == self.index_channel:
-            # 查询index更新，比较row_id是否有变化
-            row_ids = await servant.range(
-                ref, **self.query_param, row_format=RowFormat.ID_LIST
-            )
-            row_ids = set(row_ids)
+            # 优先用索引变动消息增量更新，不行再重新查询，然后比较row_id是否有变化
+            row_ids = None
+            if payloads is not None:
+                row_ids = self._apply_index_changes(payloads)
+            if row_ids is None:
+                row_ids = await self._query_range(since)
             inserts = row_ids - self.last_range_result
             deletes = self.last_range_result - row_ids
             self.last_range_result = row_ids
@@ -151,14 +329,14 @@ class IndexSubscription(BaseSubscription):
             rem_chans = set()
             rtn: dict[int, dict[str, Any] | None] = {}
             for row_id in inserts:
-                row = await servant.get(ref, row_id, row_format=RowFormat.TYPED_DICT)
+                # 行在索引通知前就已写入，since之后的读取结果都可以共享
+                row = await shared_get(servant, ref, row_id, since)
                 if row is None:
                     self.last_range_result.remove(row_id)
                     continue  # 可能是刚添加就删了
                 else:
                     ctx = self.rls_ctx
                     if ctx is None or ctx.rls_check(ref.comp_cls, row):
-                        del row["_version"]
                         rtn[row_id] = row
                     new_chan_name = servant.row_channel(ref, row_id)
                     new_chans.add(new_chan_name)
@@ -173,7 +351,7 @@ class IndexSubscription(BaseSubscription):
 
             return new_chans, rem_chans, rtn
         elif channel in self.row_subs:
-            return await self.row_subs[channel].get_updated(channel)
+            return await self.row_subs[channel].get_updated(channel, payloads, since)
         else:
             raise RuntimeError(
                 _("IndexSubscription收到了未知的channel消息: {channel}").format(
@@ -187,18 +365,207 @@ class IndexSubscription(BaseSubscription):
         return {self.index_channel, *self.row_subs.keys()}
 
 
+class FilteredIndexSubscription(IndexSubscription):
+    """
+    带筛选条件的索引订阅。范围内的行照常订阅，但只推送符合条件的行：
+    行变得符合条件时推送该行，不再符合时推送删除，一直不符合的行不推送。
+    """
+
+    def __init__(
+        self,
+        table_ref: TableReference,
+        servant: BackendClient,
+        ctx: Context,
+        index_channel: str,
+        last_range_result,
+        query_param: dict,
+        predicate: RowPredicate,
+        visible: set[int],
+    ):
+        super().__init__(
+            table_ref, servant, ctx, index_channel, last_range_result, query_param
+        )
+        self.predicate = predicate
+        # 已推送给客户端的行，也就是客户端认为存在的行
+        self.visible = visible
+
+    async def get_updated(
+        self,
+        channel,
+        payloads: list[bytes] | None = None,
+        since: float | None = None,
+    ) -> tuple[set[str], set[str], Mapping[int, dict[str, Any] | None]]:
+        new_chans, rem_chans, updates = await super().get_updated(
+            channel, payloads, since
+        )
+        return new_chans, rem_chans, self._filter(updates)
+
+    def _filter(
+        self, updates: Mapping[int, dict[str, Any] | None]
+    ) -> dict[int, dict[str, Any] | None]:
+        rows = {row_id: row for row_id, row in updates.items() if row is not None}
+        matched = set()
+        if rows:
+            mask = self.predicate.mask_dicts(list(rows.values()))
+            matched = {row_id for row_id, hit in zip(rows, mask) if hit}
+        rtn: dict[int, dict[str, Any] | None] = {}
+        for row_id in updates:
+            if row_id in matched:
+                self.visible.add(row_id)
+                rtn[row_id] = rows[row_id]
+            elif row_id in self.visible:
+                self.visible.discard(row_id)
+                rtn[row_id] = None
+        return rtn
+
+
+class AOISubscription(FilteredIndexSubscription):
+    """
+    AOI（视野）订阅，订阅空间索引上的一个矩形，矩形可以随订阅者移动，见 `move`。
+    矩形覆盖的格子内的行都订阅，只推送精确坐标在矩形内的行：进入矩形时推送该行，离开时推送删除。
+    """
+
+    def __init__(
+        self,
+        table_ref: TableReference,
+        servant: BackendClient,
+        ctx: Context,
+        index_channel: str,
+        box: tuple[float, float, float, float],
+        limit: int,
+    ):
+        grid = table_ref.comp_cls.spatial_
+        assert grid is not None
+        self.grid = grid
+        super().__init__(
+            table_ref,
+            servant,
+            ctx,
+            index_channel,
+            set(),
+            dict(index_name=CELL_FIELD, limit=limit),
+            grid.box_predicate(table_ref.comp_cls, *box),
+            set(),
+        )
+        # 矩形覆盖的格子编码区间，和对应的索引成员值区间
+        self.ranges = grid.box_ranges(*box)
+        self._cell_bounds: list[tuple[bytes, bytes]] | None = None
+
+    async def _query_range(self, since: float | None) -> set[int]:
+        """查询矩形覆盖的每行格子，worker内相同的查询共享结果"""
+        servant = self.servant
+        ref = self.table_ref
+        limit = self.query_param["limit"]
+        if since is None:
+            since = time.monotonic()
+        row_ids = set()
+        for left, right in self.ranges:
+            qp = dict(
+                index_name=CELL_FIELD, left=left, right=right, limit=limit, desc=False
+            )
+            key = (ref, SubscriptionBroker.make_query_id_(ref, **qp))
+            result = await SHARED_QUERIES.fetch(
+                key,
+                since,
+                lambda qp=qp: servant.range(ref, **qp, row_format=RowFormat.ID_LIST),
+            )
+            row_ids.update(result)
+        return row_ids
+
+    def _apply_index_changes(self, payloads: list[bytes]) -> set[int] | None:
+        """
+        整个表的格子变动都会通知到索引频道，都不涉及本订阅的格子时，结果不变，不用重新查询。
+        否则返回None，重新查询
+        """
+        if self._cell_bounds is None:
+            self._cell_bounds = [
+                self.servant.index_bounds(self.table_ref, CELL_FIELD, left, right)
+                for left, right in self.ranges
+            ]
+        current = self.last_range_result
+        for payload in payloads:
+            row_id, new = self.servant.parse_index_change(payload)
+            if row_id in current:
+                return None
+            if new is not None and any(lo <= new <= hi for lo, hi in self._cell_bounds):
+                return None
+        return set(current)
+
+    async def move(
+        self, x0: float, y0: float, x1: float, y1: float
+    ) -> tuple[set[str], set[str], dict[int, dict[str, Any] | None]]:
+        """
+        把矩形移动到新位置，重新查询覆盖的格子。
+        返回 {需要新订阅的频道}, {需要取消订阅的频道}, {进出矩形的row_id: 行数据，None表示离开}
+        """
+        servant = self.servant
+        ref = self.table_ref
+        # 先检查矩形，不合法时不改变状态
+        ranges = self.grid.box_ranges(x0, y0, x1, y1)
+        predicate = self.grid.box_predicate(ref.comp_cls, x0, y0, x1, y1)
+        self.ranges = ranges
+        self._cell_bounds = None
+        self.predicate = predicate
+
+        limit = self.query_param["limit"]
+        rows: dict[int, dict[str, Any]] = {}
+        for left, right in ranges:
+            for row in await servant.range(
+                ref, CELL_FIELD, left, right, limit, False, RowFormat.TYPED_DICT
+            ):
+                rows[int(row["id"])] = row
+
+        row_ids = set(rows)
+        new_chans = set()
+        rem_chans = set()
+        for row_id in row_ids - self.last_range_result:
+            new_chan_name = servant.row_channel(ref, row_id)
+            new_chans.add(new_chan_name)
+            self.add_row_subscriber(new_chan_name, row_id)
+        for row_id in self.last_range_result - row_ids:
+            rem_chan_name = servant.row_channel(ref, row_id)
+            rem_chans.add(rem_chan_name)
+            self.row_subs.pop(rem_chan_name)
+        self.last_range_result = row_ids
+
+        ctx = self.rls_ctx
+        candidates = [
+            row
+            for row in rows.values()
+            if ctx is None or ctx.rls_check(ref.comp_cls, row)
+        ]
+        mask = self.predicate.mask_dicts(candidates)
+        inside = {int(row["id"]): row for row, hit in zip(candidates, mask) if hit}
+        # 只推送进出矩形的行，一直在矩形内的行客户端已有
+        rtn: dict[int, dict[str, Any] | None] = {
+            row_id: _strip_version(row)
+            for row_id, row in inside.items()
+            if row_id not in self.visible
+        }
+        rtn.update({row_id: None for row_id in self.visible - inside.keys()})
+        self.visible = set(inside)
+        return new_chans, rem_chans, rtn
+
+
 class SubscriptionBroker:
     """
     Component的数据订阅和查询接口
     """
 
-    def __init__(self, backend: Backend):
+    # 差量推送：行更新时只推送变化的属性，由配置SUBSCRIPTION_DELTA_UPDATES设置。
+    # 开启后推送的消息为 ["delt", sub_id, {row_id: 变化的属性 | 整行 | None}]，需要客户端SDK支持
+    DELTA_UPDATES = False
+
+    def __init__(self, backend: Backend, row_cache: ConnectionRowCache | None = None):
         self._backend = backend
         self._mq_client = backend.get_mq_client()
+        # 同一连接的行缓存，收到行变动通知时清除对应的缓存行
+        self._row_cache = row_cache
 
         self._subs: dict[str, BaseSubscription] = {}  # key是sub_id
         self._channel_subs: dict[str, set[str]] = {}  # key是频道名， value是set[sub_id]
         self._index_sub_count = 0
+        self._aoi_seq = 0
 
     async def close(self):
         return await self._mq_client.close()
@@ -295,6 +662,7 @@ class SubscriptionBroker:
                     sub_id=sub_id
                 )
             )
+            self._remember_sent(sub_id, [row])
             return sub_id, row
 
         channel_name = servant.row_channel(table_ref, row["id"])
@@ -309,6 +677,7 @@ class SubscriptionBroker:
             table_ref, servant, ctx, channel_name, row["id"]
         )
         self._channel_subs.setdefault(channel_name, set()).add(sub_id)
+        self._remember_sent(sub_id, [row])
         return sub_id, row
 
     async def subscribe_range(
@@ -352,6 +721,48 @@ class SubscriptionBroker:
         define_component : 组件定义
 
         """
+        return await self._subscribe_index(
+            table_ref, ctx, index_name, left, right, limit, desc, force
+        )
+
+    async def subscribe_query(
+        self,
+        table_ref: TableReference,
+        ctx: Context,
+        where: list,
+        index_name: str,
+        left: Any,
+        right: Any | None = None,
+        limit: int = 10,
+        desc: bool = False,
+        force: bool = True,
+    ) -> tuple[str | None, list[dict]]:
+        """
+        获取并订阅多行数据，只返回和推送符合where筛选条件的行。
+        例如"我所在区域内hp>0的敌人"：索引范围查询区域，where为 `[["hp", ">", 0]]`。
+
+        参数和返回值同 `subscribe_range`，where格式见 `RowPredicate`，条件不合法时抛出ValueError。
+        limit为筛选前的行数，可能会获得少于limit行数据。
+
+        范围内不符合条件的行也会订阅，行变得符合条件时推送该行，不再符合时推送删除。
+        """
+        predicate = RowPredicate(table_ref.comp_cls, where)
+        return await self._subscribe_index(
+            table_ref, ctx, index_name, left, right, limit, desc, force, predicate
+        )
+
+    async def _subscribe_index(
+        self,
+        table_ref: TableReference,
+        ctx: Context,
+        index_name: str,
+        left: Any,
+        right: Any | None,
+        limit: int,
+        desc: bool,
+        force: bool,
+        predicate: RowPredicate | None = None,
+    ) -> tuple[str | None, list[dict]]:
         # 首先caller要对整个表有权限，不然就算force也不给订阅
         if not self._has_table_permission(table_ref, ctx):
             logger.warning(
@@ -376,64 +787,187 @@ class SubscriptionBroker:
                 row for row in rows if self._has_row_permission(table_ref, ctx, row)
             ]
 
+        row_ids = {int(row["id"]) for row in rows}
+        if predicate is not None:
+            # 范围内的行都要订阅，但只返回符合条件的
+            rows = [row for row, hit in zip(rows, predicate.mask_dicts(rows)) if hit]
+
         if not force and len(rows) == 0:
             return None, rows
 
         sub_id = self.make_query_id_(table_ref, index_name, left, right, limit, desc)
+        if predicate is not None:
+            sub_id += f"?{predicate}"
         if sub_id in self._subs:
             logger.warning(
                 _("⚠️ [📡Subscription] {sub_id} 数据重复订阅，检查客户端代码").format(
                     sub_id=sub_id
                 )
             )
+            self._remember_sent(sub_id, rows)
             return sub_id, rows
 
         index_channel = servant.index_channel(table_ref, index_name)
-        await self._mq_client.subscribe(index_channel)
+        row_channels = {
+            row_id: servant.row_channel(table_ref, row_id) for row_id in row_ids
+        }
+        # 索引频道和每行的频道（每行数据变更时才能收到消息）一次批量订阅
+        await self._mq_client.subscribe_many([index_channel, *row_channels.values()])
         logger.debug(
             _("🆕 [📡Subscription] 订阅了索引: {sub_id} {index_channel}").format(
                 sub_id=sub_id, index_channel=index_channel
             )
         )
 
-        row_ids = {int(row["id"]) for row in rows}
-        idx_sub = IndexSubscription(
-            table_ref,
-            servant,
-            ctx,
-            index_channel,
-            row_ids,
-            dict(index_name=index_name, left=left, right=right, limit=limit, desc=desc),
+        query_param = dict(
+            index_name=index_name, left=left, right=right, limit=limit, desc=desc
         )
+        if predicate is None:
+            idx_sub = IndexSubscription(
+                table_ref, servant, ctx, index_channel, row_ids, query_param
+            )
+        else:
+            visible = {int(row["id"]) for row in rows}
+            idx_sub = FilteredIndexSubscription(
+                table_ref,
+                servant,
+                ctx,
+                index_channel,
+                row_ids,
+                query_param,
+                predicate,
+                visible,
+            )
         self._subs[sub_id] = idx_sub
         self._channel_subs.setdefault(index_channel, set()).add(sub_id)
-        self._index_sub_count = list(map(type, self._subs.values())).count(
-            IndexSubscription
-        )
+        self._index_sub_count = self._count_index_subs()
 
-        # 还要订阅每行的信息，这样每行数据变更时才能收到消息
-        for row_id in row_ids:
-            row_channel = servant.row_channel(table_ref, row_id)
-            await self._mq_client.subscribe(row_channel)
+        for row_id, row_channel in row_channels.items():
             idx_sub.add_row_subscriber(row_channel, row_id)
             self._channel_subs.setdefault(row_channel, set()).add(sub_id)
 
+        self._remember_sent(sub_id, rows)
+        return sub_id, rows
+
+    async def subscribe_aoi(
+        self,
+        table_ref: TableReference,
+        ctx: Context,
+        x0: float,
+        y0: float,
+        x1: float,
+        y1: float,
+        limit: int = 100,
+    ) -> tuple[str | None, list[dict]]:
+        """
+        订阅AOI（视野）范围，返回坐标在矩形 `[x0, x1] × [y0, y1]` 内的行。
+        Component需要用 `define_component(spatial=...)` 开启空间索引，否则抛出ValueError。
+
+        订阅者移动时，调用 `move_aoi` 移动矩形，只返回进出矩形的行。
+        limit为每行格子查询的最大行数，RLS权限的处理同 `subscribe_range`。
+
+        Returns
+        --------
+        sub_id: str | None
+            订阅id，每次调用都是新的订阅。如果无整表权限，返回None。
+        rows: list[dict[str, Any]]
+            矩形内的行数据。
+        """
+        if table_ref.comp_cls.spatial_ is None:
+            raise ValueError(
+                _("{comp_name} 组件没有开启空间索引").format(
+                    comp_name=table_ref.comp_name
+                )
+            )
+        if not self._has_table_permission(table_ref, ctx):
+            logger.warning(
+                _(
+                    "⚠️ [📡Subscription] {comp_name}无调用权限，"
+                    "检查是否非法调用，caller：{caller}"
+                ).format(comp_name=table_ref.comp_name, caller=ctx.caller)
+            )
+            return None, []
+
+        servant = self._backend.servant
+        index_channel = servant.index_channel(table_ref, CELL_FIELD)
+        aoi = AOISubscription(
+            table_ref, servant, ctx, index_channel, (x0, y0, x1, y1), limit
+        )
+        new_chans, _rem_chans, rows = await aoi.move(x0, y0, x1, y1)
+
+        self._aoi_seq += 1
+        sub_id = f"{table_ref.comp_name}.aoi[{self._aoi_seq}]"
+        await self._mq_client.subscribe_many([index_channel, *new_chans])
+        logger.debug(
+            _("🆕 [📡Subscription] 订阅了AOI: {sub_id} {index_channel}").format(
+                sub_id=sub_id, index_channel=index_channel
+            )
+        )
+        self._subs[sub_id] = aoi
+        for channel in (index_channel, *new_chans):
+            self._channel_subs.setdefault(channel, set()).add(sub_id)
+        self._index_sub_count = self._count_index_subs()
+        rows = [row for row in rows.values() if row is not None]
+        self._remember_sent(sub_id, rows)
         return sub_id, rows
 
+    async def move_aoi(
+        self, sub_id: str, x0: float, y0: float, x1: float, y1: float
+    ) -> dict[int, dict[str, Any] | None]:
+        """
+        移动AOI订阅的矩形，返回进出矩形的行 {row_id: 行数据，None表示离开}
+        """
+        sub = self._subs.get(sub_id)
+        if not isinstance(sub, AOISubscription):
+            raise ValueError(_("不存在的AOI订阅：{sub_id}").format(sub_id=sub_id))
+        new_chans, rem_chans, updates = await sub.move(x0, y0, x1, y1)
+        await self._update_channels(sub_id, new_chans, rem_chans)
+        if self.DELTA_UPDATES:
+            return sub.make_delta(updates)
+        return updates
+
+    def _remember_sent(self, sub_id: str, rows: list[dict[str, Any]]) -> None:
+        """差量推送开启时，记下订阅返回给客户端的行"""
+        if self.DELTA_UPDATES:
+            self._subs[sub_id].remember_sent(rows)
+
+    async def _update_channels(
+        self, sub_id: str, new_chans: set[str], rem_chans: set[str]
+    ) -> None:
+        """订阅的行有添加或删除时，批量订阅或取消订阅"""
+        mq = self._mq_client
+        channel_subs = self._channel_subs
+        if new_chans:
+            await mq.subscribe_many(new_chans)
+            for new_chan in new_chans:
+                channel_subs.setdefault(new_chan, set()).add(sub_id)
+        unused = []
+        for rem_chan in rem_chans:
+            channel_subs[rem_chan].remove(sub_id)
+            if len(channel_subs[rem_chan]) == 0:
+                unused.append(rem_chan)
+                del channel_subs[rem_chan]
+        if unused:
+            await mq.unsubscribe_many(unused)
+
     async def unsubscribe(self, sub_id) -> None:
         """取消该sub_id的订阅"""
         if sub_id not in self._subs:
             return
 
+        unused = []
         for channel in self._subs[sub_id].channels:
             self._channel_subs[channel].remove(sub_id)
             if len(self._channel_subs[channel]) == 0:
-                await self._mq_client.unsubscribe(channel)
+                unused.append(channel)
                 del self._channel_subs[channel]
+        if unused:
+            await self._mq_client.unsubscribe_many(unused)
         self._subs.pop(sub_id)
-        self._index_sub_count = list(map(type, self._subs.values())).count(
-            IndexSubscription
-        )
+        self._index_sub_count = self._count_index_subs()
+
+    def _count_index_subs(self) -> int:
+        return sum(isinstance(sub, IndexSubscription) for sub in self._subs.values())
 
     async def get_updates(self, timeout=None) -> dict[str, dict[str, dict]]:
         """
@@ -466,23 +1000,34 @@ class SubscriptionBroker:
                 return rtn
         else:
             updated_channels = await mq.get_message()
+        payloads = mq.take_payloads(updated_channels)
+        pulled_at = mq.take_pulled_times(updated_channels)
         for channel in updated_channels:
             RowSubscription.clear_cache(channel)
             sub_ids = channel_subs.get(channel, [])
             for sub_id in sub_ids:
                 sub = self._subs[sub_id]
                 # 获取sub更新的行数据
-                new_chans, rem_chans, sub_updates = await sub.get_updated(channel)
-                # 如果有行添加或删除，订阅或取消订阅
-                for new_chan in new_chans:
-                    await mq.subscribe(new_chan)
-                    channel_subs.setdefault(new_chan, set()).add(sub_id)
-                for rem_chan in rem_chans:
-                    channel_subs[rem_chan].remove(sub_id)
-                    if len(channel_subs[rem_chan]) == 0:
-                        await mq.unsubscribe(rem_chan)
-                        del channel_subs[rem_chan]
+                new_chans, rem_chans, sub_updates = await sub.get_updated(
+                    channel, payloads.get(channel), pulled_at.get(channel)
+                )
+                # 如果有行添加或删除，批量订阅或取消订阅
+                await self._update_channels(sub_id, new_chans, rem_chans)
+                if len(sub_updates) == 0:
+                    continue
+                if self._row_cache is not None:
+                    self._row_cache.invalidate(sub.table_ref, sub_updates.keys())
                 # 添加行数据到返回值
-                if len(sub_updates) > 0:
-                    rtn.setdefault(sub_id, dict()).update(sub_updates)
+                merged = rtn.setdefault(sub_id, dict())
+                if not self.DELTA_UPDATES:
+                    merged.update(sub_updates)
+                    continue
+                # 同一行本次可能从多个频道更新，差量要和之前的合并，不能覆盖
+                for row_id, patch in sub.make_delta(sub_updates).items():
+                    prev = merged.get(row_id)
+                    if prev is not None and patch is not None:
+                        patch = prev | patch
+                    merged[row_id] = patch
+                if not merged:
+                    del rtn[sub_id]
         return rtn
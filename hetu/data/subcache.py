@@ -0,0 +1,84 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2024, Heerozh. All rights reserved.
+@license: Apache2.0 可用作商业项目，再随便找个角落提及用到了此项目 :D
+@email: heeroz@gmail.com
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+# worker内共享的订阅查询结果的最大条数，0为关闭
+SUBSCRIPTION_SHARED_CACHE_SIZE = 10000
+
+
+class SharedQueryCache:
+    """
+    worker级的订阅查询结果缓存。每个worker进程一个，由所有连接的 `SubscriptionBroker` 共享。
+
+    同一worker上大量连接订阅同一行（公会、世界事件等）时，数据变动会通知到所有连接，
+    每个连接都要重新读取一次。本缓存按查询key合并这些读取：同一变动只读取一次，
+    结果交给所有连接，RLS权限由各连接拿到结果后自己判断。
+
+    结果是否可用，看读取的开始时间：晚于连接收到变动通知的时间，说明读到的已包含该变动。
+    读取还没完成时，后来的连接等待它完成，而不是自己再读一次。
+    结果由多个连接共享，使用者不能修改。
+    """
+
+    def __init__(self):
+        # {key: (读取开始时间, 结果)}
+        self._results: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        # {key: (读取开始时间, 完成事件)} 正在进行中的读取
+        self._inflight: dict[Hashable, tuple[float, asyncio.Event]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    async def fetch(
+        self, key: Hashable, since: float, loader: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        返回key的查询结果。since为连接收到变动通知的时间(time.monotonic)，
+        有在此之后开始的读取结果就直接使用，否则调用loader读取。
+        """
+        if SUBSCRIPTION_SHARED_CACHE_SIZE <= 0:
+            return await loader()
+
+        while True:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] >= since:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            flight = self._inflight.get(key)
+            if flight is None or flight[0] < since:
+                break
+            # 等待进行中的读取，它失败的话再循环一次，自己读取
+            await flight[1].wait()
+
+        self.misses += 1
+        started = time.monotonic()
+        done = asyncio.Event()
+        self._inflight[key] = (started, done)
+        try:
+            value = await loader()
+            entry = self._results.get(key)
+            # 并发的读取可能先完成，只保留开始时间最新的
+            if entry is None or entry[0] <= started:
+                self._results[key] = (started, value)
+                self._results.move_to_end(key)
+                while len(self._results) > SUBSCRIPTION_SHARED_CACHE_SIZE:
+                    self._results.popitem(last=False)
+            return value
+        finally:
+            if self._inflight.get(key, (None, None))[1] is done:
+                del self._inflight[key]
+            done.set()
+
+    def clear(self) -> None:
+        self._results.clear()
@@ -5,6 +5,7 @@
 @email: heeroz@gmail.com
 """
 
+import copy
 import inspect
 import logging
 from time import time as now
@@ -52,6 +53,22 @@ class EndpointExecutor:
         self.context.address = address
         ContextFilter.set_log_context(str(self.context))
 
+    def fork(self) -> EndpointExecutor:
+        """
+        返回使用Context副本的执行器，用于同一连接上并发执行的调用。
+        System调用会改写Context上的事务属性（repo等），并发的调用不能共用一个Context。
+        副本和原Context共用user_data等可变属性和行缓存，但caller等属性的修改（如elevate登录）
+        不会传回原Context，所以修改连接状态的调用不能在副本上执行。
+        """
+        context = copy.copy(self.context)
+        systems = self.context.systems
+        if systems is not None:
+            context.systems = type(systems)(systems.namespace, systems.tbl_mgr, context)
+            context.systems.row_cache = systems.row_cache
+        forked = copy.copy(self)
+        forked.context = context
+        return forked
+
     async def terminate(self):
         """删除连接，失败不抛出异常"""
         if self.context.connection_id == 0:
@@ -16,16 +16,18 @@ from redis.exceptions import ConnectionError as RedisConnectionError
 from sanic import Sanic
 
 from ..common.snowflake_id import SnowflakeID
-from ..data.backend import Backend
+from ..data import subcache
+from ..data.backend import Backend, BackendClient, MQClient
 from ..data.backend.worker_keeper import GeneralWorkerKeeper, WorkerLease
+from ..data.sub import SubscriptionBroker
 from ..endpoint import connection
 from ..i18n import _
 from ..manager import ComponentTableManager
 from ..safelogging.default import DEFAULT_LOGGING_CONFIG
-from ..system import SystemClusters
+from ..system import SystemClusters, hotkey, rowcache
 from ..system.future import future_call_task
-from . import pipeline
-from . import websocket as _ws  # noqa: F401 (防止未使用警告)
+from . import pipeline, receiver
+from . import websocket as _ws
 from .web import HETU_BLUEPRINT
 
 logger = logging.getLogger("HeTu.root")
@@ -169,6 +171,7 @@ async def worker_start(app: Sanic):
 async def worker_close(app):
     # ctrl+c并不会触发此函数，sanic会直接退出进程
     await close_backends(app)
+    pipeline.MessagePipeline.shutdown_offload()
 
 
 async def worker_keeper_renewal(app: Sanic):
@@ -227,6 +230,23 @@ def worker_main(app_name, config) -> Sanic:
     connection.ENDPOINT_CALL_IDLE_TIMEOUT = config.get(
         "ENDPOINT_CALL_IDLE_TIMEOUT", 60 * 2
     )
+    hotkey.HOT_KEY_CONFLICT_RATE = config.get("HOT_KEY_CONFLICT_RATE", 0.3)
+    hotkey.HOT_KEY_MIN_CONFLICTS = config.get("HOT_KEY_MIN_CONFLICTS", 5)
+    rowcache.CONNECTION_ROW_CACHE_SIZE = config.get("CONNECTION_ROW_CACHE_SIZE", 0)
+    MQClient.UPDATE_FREQUENCY = config.get("SUBSCRIPTION_UPDATE_FREQUENCY", 10)
+    BackendClient.ROW_CHANGE_PAYLOAD = config.get("SUBSCRIPTION_ROW_PAYLOAD", False)
+    subcache.SUBSCRIPTION_SHARED_CACHE_SIZE = config.get(
+        "SUBSCRIPTION_SHARED_CACHE_SIZE", 10000
+    )
+    SubscriptionBroker.DELTA_UPDATES = config.get("SUBSCRIPTION_DELTA_UPDATES", False)
+    _ws.PUSH_COALESCE_WINDOW = config.get("PUSH_COALESCE_WINDOW", 0)
+    _ws.PUSH_COALESCE_MAX = config.get("PUSH_COALESCE_MAX", 64)
+    receiver.SHARED_PUSH_CACHE_SIZE = config.get("SHARED_PUSH_CACHE_SIZE", 1024)
+    receiver.RPC_CONCURRENCY = config.get("RPC_CONCURRENCY", 0)
+    pipeline.MessagePipeline.OFFLOAD_THRESHOLD = config.get(
+        "PIPELINE_OFFLOAD_THRESHOLD", 65536
+    )
+    pipeline.MessagePipeline.OFFLOAD_WORKERS = config.get("PIPELINE_OFFLOAD_WORKERS", 2)
 
     # 加载web服务器
     app = Sanic(app_name, log_config=config.get("LOGGING", DEFAULT_LOGGING_CONFIG))
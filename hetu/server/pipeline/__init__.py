@@ -5,6 +5,7 @@
 @email: heeroz@gmail.com
 """
 
+from .columnar import ColumnarLayer
 from .crypto import CryptoLayer
 from .jsonb import JSONBinaryLayer
 from .pipeline import (
@@ -12,6 +13,7 @@ from .pipeline import (
     ServerMessagePipeline,
     MessageProcessLayer,
     MessageProcessLayerFactory,
+    SharedMessage,
 )
 from .zstd import ZstdLayer
 from .zlib import ZlibLayer
@@ -22,8 +24,10 @@ __all__ = [
     "ServerMessagePipeline",
     "MessageProcessLayer",
     "MessageProcessLayerFactory",
+    "SharedMessage",
     "ZstdLayer",
     "JSONBinaryLayer",
+    "ColumnarLayer",
     "CryptoLayer",
     "ZlibLayer",
     "BrotliLayer",
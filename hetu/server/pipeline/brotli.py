@@ -6,12 +6,13 @@
 """
 
 import logging
+import threading
 from dataclasses import dataclass
 from typing import Any, override
 
 import brotli
 
-from .pipeline import JSONType, MessageProcessLayer
+from .pipeline import Buffer, ContextBudget, JSONType, MessageProcessLayer
 
 logger = logging.getLogger("HeTu.root")
 replay = logging.getLogger("HeTu.replay")
@@ -20,6 +21,9 @@ replay = logging.getLogger("HeTu.replay")
 class BrotliLayer(MessageProcessLayer, alias="brotli"):
     """
     使用 Brotli 进行消息的流式压缩和解压缩。
+
+    压缩器的内存主要是滑动窗口，默认lgwin=22时每个连接可达数MB。设置 `memory_budget` 后，
+    超出预算的新连接使用 `reduced_lgwin` 的窗口，窗口大小写在流头中，客户端无需改动。
     """
 
     @dataclass
@@ -33,6 +37,8 @@ class BrotliLayer(MessageProcessLayer, alias="brotli"):
         lgwin: int = 22,
         lgblock: int = 0,
         mode: int = brotli.MODE_GENERIC,
+        memory_budget: int = 0,
+        reduced_lgwin: int = 16,
     ):
         """
         Parameters
@@ -45,14 +51,22 @@ class BrotliLayer(MessageProcessLayer, alias="brotli"):
                 最大输入块大小（log2），0 表示自动。
         mode
                 压缩模式：MODE_GENERIC / MODE_TEXT / MODE_FONT。
+        memory_budget
+                本worker所有连接的压缩上下文的内存预算（字节），0为不限制。
+        reduced_lgwin
+                超出预算时，新连接使用的滑动窗口大小（log2）。
         """
         super().__init__()
         self.quality = quality
         self.lgwin = lgwin
         self.lgblock = lgblock
         self.mode = mode
+        self.reduced_lgwin = reduced_lgwin
+        self.budget = ContextBudget(memory_budget)
         self.encode_count = 0
         self.encode_ratio = 0.0
+        # 大消息在线程池中编码（见 `MessagePipeline.encode_async`），统计要加锁
+        self._stats_lock = threading.Lock()
 
     @override
     def handshake(self, message: bytes) -> tuple[Any, bytes]:
@@ -60,45 +74,56 @@ class BrotliLayer(MessageProcessLayer, alias="brotli"):
         连接前握手工作。
         Brotli 不做字典协商。
         """
+        # 估计值：环形缓冲区加同等量级的hash表
+        lgwin = self.lgwin
+        reduced = not self.budget.fits(2 << lgwin)
+        if reduced:
+            lgwin = min(lgwin, self.reduced_lgwin)
 
         ctx = self.BrotliContext(
             compressor=brotli.Compressor(
                 mode=self.mode,
                 quality=self.quality,
-                lgwin=self.lgwin,
+                lgwin=lgwin,
                 lgblock=self.lgblock,
             ),
             decompressor=brotli.Decompressor(),
         )
+        self.budget.track(ctx, 2 << lgwin, reduced)
         return ctx, b""
 
     @override
-    def encode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def encode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
         对消息进行正向处理（流式压缩）
         """
         if not layer_ctx:
             return message
 
-        assert type(message) is bytes, "BrotliCompressor 只能压缩 bytes 类型的消息"
+        assert isinstance(message, Buffer), "BrotliCompressor 只能压缩 bytes 类型的消息"
 
-        chunk = layer_ctx.compressor.process(message)
-        chunk += layer_ctx.compressor.flush()
+        head = layer_ctx.compressor.process(message)
+        chunk = layer_ctx.compressor.flush()
+        if head:
+            chunk = head + chunk
 
         ratio = len(chunk) / len(message) if len(message) > 0 else 1.0
-        self.encode_count += 1
-        self.encode_ratio += (ratio - self.encode_ratio) / self.encode_count
+        with self._stats_lock:
+            self.encode_count += 1
+            self.encode_ratio += (ratio - self.encode_ratio) / self.encode_count
         return chunk
 
     @override
-    def decode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def decode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
         对消息进行逆向处理（流式解压）
         """
         if not layer_ctx:
             return message
 
-        assert type(message) is bytes, "BrotliDecompressor 只能解压 bytes 类型的消息"
+        assert isinstance(message, Buffer), (
+            "BrotliDecompressor 只能解压 bytes 类型的消息"
+        )
 
         try:
             return layer_ctx.decompressor.process(message)
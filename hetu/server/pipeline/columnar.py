@@ -0,0 +1,197 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2024, Heerozh. All rights reserved.
+@license: Apache2.0 可用作商业项目，再随便找个角落提及用到了此项目 :D
+@email: heeroz@gmail.com
+"""
+
+import logging
+import struct
+from typing import TYPE_CHECKING, Any, override
+
+import msgspec
+import numpy as np
+
+from .pipeline import Buffer, JSONType, MessageProcessLayer
+
+if TYPE_CHECKING:
+    from ...data import BaseComponent
+
+logger = logging.getLogger("HeTu.root")
+replay = logging.getLogger("HeTu.replay")
+
+# 单行的msgpack Ext类型码，数据为 uint16 schema id + 一行
+ROW_EXT = 1
+# 多行的msgpack Ext类型码，数据为 uint16 schema id + 连续的多行
+ROWS_EXT = 2
+
+_SCHEMA_ID = struct.Struct("<H")
+
+
+def row_dtype(comp_cls: type[BaseComponent]) -> np.dtype:
+    """
+    返回Component在列式格式中的行结构：去掉 `_version` 的packed小端结构，
+    属性顺序同 `properties_`。客户端的struct布局（见 `hetu build`）必须与此一致。
+    """
+    return np.dtype(
+        [
+            (name, np.dtype(prop.dtype).newbyteorder("<"))
+            for name, prop in comp_cls.properties_
+            if name != "_version"
+        ],
+        align=False,
+    )
+
+
+class ColumnarLayer(MessageProcessLayer, alias="columnar"):
+    """
+    列式二进制格式。把订阅消息（sub/updt/delt）中的行（TYPED_DICT），按Component的dtype
+    打包成二进制，放入msgpack的Ext类型，不再每行重复属性名。必须放在jsonb层之前。
+
+    握手时客户端发送非空消息表示支持，服务器回复所有Component的schema表
+    `[[component名, [[属性名, dtype], ...]], ...]`，schema id即表中的下标；
+    客户端发送空消息则本层对该连接不生效，兼容旧客户端。
+
+    属性不全的行（如差量推送的变化属性）保持原样，客户端按类型区分。
+    """
+
+    ROW_MESSAGES = ("sub", "updt", "delt")
+
+    def __init__(self):
+        super().__init__()
+        self.schema_ids: dict[str, int] = {}
+        self.dtypes: list[np.dtype] = []
+        schemas = []
+        for comp_cls in self._components():
+            dtype = row_dtype(comp_cls)
+            self.schema_ids[comp_cls.name_] = len(self.dtypes)
+            self.dtypes.append(dtype)
+            assert dtype.names
+            schemas.append(
+                [comp_cls.name_, [[name, dtype[name].str] for name in dtype.names]]
+            )
+        self.schema_message = msgspec.msgpack.encode(schemas)
+
+    @staticmethod
+    def _components() -> list[type[BaseComponent]]:
+        from ...common import Permission
+        from ...system import SystemClusters
+
+        # 副本和master的schema相同，只收录master，按名字排序保证各worker的id一致
+        masters = {
+            comp.master_ or comp
+            for comp in SystemClusters().get_components()
+            if comp.permission_ != Permission.ADMIN
+        }
+        return sorted(masters, key=lambda c: c.name_)
+
+    @override
+    def is_shareable(self) -> bool:
+        return True
+
+    @override
+    def handshake(self, message: bytes) -> tuple[Any, bytes]:
+        """
+        客户端发送非空消息表示支持列式格式，回复schema表，否则回复空字节
+        """
+        if not message:
+            return None, b""
+        return True, self.schema_message
+
+    def _schema_id(self, sub_id: str) -> int | None:
+        # sub_id以component名开头，副本名为 `master名:后缀`
+        name = sub_id.split(".", 1)[0].split(":", 1)[0]
+        return self.schema_ids.get(name)
+
+    def _pack(self, schema_id: int, rows: list[dict[str, Any]]) -> bytes | None:
+        """把行打包为连续的struct，有行属性不全时返回None"""
+        dtype = self.dtypes[schema_id]
+        names = dtype.names
+        assert names
+        num_fields = len(names)
+        try:
+            values = [
+                tuple([row[name] for name in names])
+                for row in rows
+                if len(row) == num_fields
+            ]
+            if len(values) != len(rows):
+                return None
+            packed = np.array(values, dtype=dtype)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            return None
+        return _SCHEMA_ID.pack(schema_id) + packed.tobytes()
+
+    def _pack_row(self, schema_id: int, row: Any) -> Any:
+        if type(row) is not dict:
+            return row
+        packed = self._pack(schema_id, [row])
+        return row if packed is None else msgspec.msgpack.Ext(ROW_EXT, packed)
+
+    def _pack_message(self, message: list) -> list:
+        kind = message[0] if message else None
+        if kind == "bat":
+            return ["bat", [self._pack_message(m) for m in message[1]]]
+        if kind not in self.ROW_MESSAGES or len(message) != 3:
+            return message
+        if type(message[1]) is not str:
+            return message
+        schema_id = self._schema_id(message[1])
+        if schema_id is None:
+            return message
+
+        # 消息可能由多个连接共享，不能原地修改
+        data = message[2]
+        if kind != "sub":
+            if type(data) is dict:
+                data = {
+                    row_id: self._pack_row(schema_id, row)
+                    for row_id, row in data.items()
+                }
+        elif type(data) is list:
+            if data and all(type(row) is dict for row in data):
+                packed = self._pack(schema_id, data)
+                if packed is not None:
+                    data = msgspec.msgpack.Ext(ROWS_EXT, packed)
+        else:
+            data = self._pack_row(schema_id, data)
+        return [kind, message[1], data]
+
+    def unpack(self, ext: msgspec.msgpack.Ext) -> dict[str, Any] | list[dict]:
+        """把Ext还原为TYPED_DICT的行，单行返回dict，多行返回list"""
+        (schema_id,) = _SCHEMA_ID.unpack_from(ext.data)
+        dtype = self.dtypes[schema_id]
+        names = dtype.names
+        assert names
+        rows = np.frombuffer(ext.data, dtype=dtype, offset=_SCHEMA_ID.size)
+        dicts = [dict(zip(names, values)) for values in rows.tolist()]
+        return dicts[0] if ext.code == ROW_EXT else dicts
+
+    def _unpack_value(self, value: Any) -> Any:
+        if type(value) is msgspec.msgpack.Ext:
+            return self.unpack(value)
+        if type(value) is dict:
+            return {k: self._unpack_value(v) for k, v in value.items()}
+        if type(value) is list:
+            return [self._unpack_value(v) for v in value]
+        return value
+
+    @override
+    def encode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
+        """
+        对消息进行正向处理，把订阅消息中的行打包为Ext
+        """
+        if not layer_ctx or type(message) is not list:
+            return message
+        return self._pack_message(message)
+
+    @override
+    def decode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
+        """
+        对消息进行逆向处理，把其中的Ext还原为行。客户端发来的消息不含Ext，原样返回
+        """
+        if not layer_ctx or type(message) is not list:
+            return message
+        if message and message[0] not in (*self.ROW_MESSAGES, "bat"):
+            return message
+        return self._unpack_value(message)
@@ -18,7 +18,7 @@ import nacl.utils
 from nacl.public import PrivateKey, PublicKey
 
 from ...i18n import _
-from .pipeline import JSONType, MessageProcessLayer
+from .pipeline import Buffer, JSONType, MessageProcessLayer
 
 logger = logging.getLogger("HeTu.root")
 replay = logging.getLogger("HeTu.replay")
@@ -146,8 +146,8 @@ class CryptoLayer(MessageProcessLayer, alias="crypto"):
 
     @override
     def encode(
-        self, layer_ctx: CryptoContext | None, message: JSONType | bytes
-    ) -> JSONType | bytes:
+        self, layer_ctx: CryptoContext | None, message: JSONType | Buffer
+    ) -> JSONType | Buffer:
         """
         发送消息时调用：加密
         输入: 明文 bytes (通常是 zstd 压缩后的数据)
@@ -157,7 +157,10 @@ class CryptoLayer(MessageProcessLayer, alias="crypto"):
         if not layer_ctx:
             return message
 
-        assert isinstance(message, bytes), "CryptoLayer只能加密bytes类型数据"
+        assert isinstance(message, Buffer), "CryptoLayer只能加密bytes类型数据"
+        # nacl只接受bytes，前一层返回其他buffer时（比如未压缩的jsonb）才需要复制
+        if type(message) is not bytes:
+            message = bytes(message)
 
         # 1. 生成随机 Nonce
         # 对于 ChaCha20-Poly1305，Nonce 必须对每个 key 唯一。
@@ -186,8 +189,8 @@ class CryptoLayer(MessageProcessLayer, alias="crypto"):
 
     @override
     def decode(
-        self, layer_ctx: CryptoContext | None, message: JSONType | bytes
-    ) -> JSONType | bytes:
+        self, layer_ctx: CryptoContext | None, message: JSONType | Buffer
+    ) -> JSONType | Buffer:
         """
         接收消息时调用：解密
         输入: [Nonce(12)] + [Ciphertext + Tag]
@@ -196,7 +199,9 @@ class CryptoLayer(MessageProcessLayer, alias="crypto"):
         if not layer_ctx:
             return message
 
-        assert isinstance(message, bytes), "CryptoLayer只能解密bytes类型数据"
+        assert isinstance(message, Buffer), "CryptoLayer只能解密bytes类型数据"
+        if type(message) is not bytes:
+            message = bytes(message)
 
         # 检查最小长度: Nonce(12) + Tag(16) = 28 bytes
         # 实际上空消息加密后也有 Tag，所以长度至少是 NONCE_SIZE + 16
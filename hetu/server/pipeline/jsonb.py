@@ -10,7 +10,7 @@ from typing import Any, override
 
 import msgspec
 
-from .pipeline import JSONType, MessageProcessLayer
+from .pipeline import Buffer, JSONType, MessageProcessLayer
 
 logger = logging.getLogger("HeTu.root")
 replay = logging.getLogger("HeTu.replay")
@@ -42,18 +42,35 @@ class JSONBinaryLayer(MessageProcessLayer, alias="jsonb"):
         """
         return None, b""
 
+    def _writable_buffer(self) -> bytearray:
+        """
+        返回可以覆盖写入的缓冲区。上次返回的memoryview还被引用时（比如调用者保存了结果），
+        缓冲区不能覆盖，否则会改掉对方的数据，此时换一个新的缓冲区，旧的留给对方
+        """
+        buffer = self.buffer
+        try:
+            # 有memoryview引用时，bytearray不能改变大小
+            buffer.append(0)
+        except BufferError:
+            buffer = self.buffer = bytearray()
+        else:
+            buffer.pop()
+        return buffer
+
     @override
-    def encode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def encode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
-        对消息进行正向处理
+        对消息进行正向处理，返回指向内部缓冲区的memoryview，下次encode时会被复用
         """
         assert type(message) in (list, dict), (
             "jsonb正向处理的message必须是list或dict类型"
         )
 
         try:
-            self.msg_encoder.encode_into(message, self.buffer)
-            return bytes(self.buffer)
+            buffer = self._writable_buffer()
+            self.msg_encoder.encode_into(message, buffer)
+            # 不复制，下一层直接读取缓冲区
+            return memoryview(buffer)
         except Exception as e:
             logger.exception(
                 f"❌ [📡Pipeline] [JsonB层]  JSONB序列化失败，消息：{message}，异常：{type(e).__name__}:{e}"
@@ -61,11 +78,11 @@ class JSONBinaryLayer(MessageProcessLayer, alias="jsonb"):
             raise
 
     @override
-    def decode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def decode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
         对消息进行逆向处理
         """
-        assert type(message) is bytes, "jsonb逆向处理的message必须是bytes类型"
+        assert isinstance(message, Buffer), "jsonb逆向处理的message必须是bytes类型"
 
         try:
             return self.msg_decoder.decode(message)
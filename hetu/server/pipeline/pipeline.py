@@ -5,7 +5,11 @@
 @email: heeroz@gmail.com
 """
 
+import asyncio
 import logging
+import weakref
+from collections.abc import Buffer
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 from ...common.singleton import Singleton
@@ -56,6 +60,14 @@ class MessageProcessLayer:
         """
         return True
 
+    def is_shareable(self) -> bool:
+        """
+        编码结果是否只取决于握手结果（layer_ctx），而与连接的流状态无关。
+        是的话，发给多个连接的同一条消息，握手结果相同的连接可以共用本层的编码结果。
+        此时layer_ctx必须可以hash。
+        """
+        return not self.is_handshake_required()
+
     def handshake(self, message: bytes) -> tuple[Any, bytes]:
         """
         连接前握手工作，例如协商参数等。
@@ -64,19 +76,70 @@ class MessageProcessLayer:
         """
         raise NotImplementedError()
 
-    def encode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def encode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
-        对消息进行正向处理
+        对消息进行正向处理。
+        二进制的输入输出可以是任意buffer对象（bytes/bytearray/memoryview），层之间直接传递不复制。
+        返回的memoryview可以指向层内复用的缓冲区，只保证在下一层处理完之前有效。
         """
         raise NotImplementedError()
 
-    def decode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def decode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
-        对消息进行逆向处理
+        对消息进行逆向处理，输入可以是任意buffer对象
         """
         raise NotImplementedError()
 
 
+class ContextBudget:
+    """
+    层的连接上下文（压缩器等）的内存预算，每个worker每层一个。
+    记录所有连接上下文的估计内存，超出预算时，新连接改用省内存的参数（较小的窗口），
+    连接断开、上下文被回收后自动释放。budget为0表示不限制。
+    """
+
+    def __init__(self, budget: int = 0):
+        self.budget = budget
+        self.used = 0
+        # 使用省内存参数的连接数
+        self.reduced = 0
+
+    def fits(self, size: int) -> bool:
+        """预算内是否还能放下size字节的上下文"""
+        return self.budget <= 0 or self.used + size <= self.budget
+
+    def track(self, ctx: Any, size: int, reduced: bool = False) -> None:
+        """记录上下文占用的内存，ctx被回收时释放"""
+        self.used += size
+        if reduced:
+            self.reduced += 1
+        weakref.finalize(ctx, self._release, size, reduced)
+
+    def _release(self, size: int, reduced: bool) -> None:
+        self.used -= size
+        if reduced:
+            self.reduced -= 1
+
+
+class SharedMessage:
+    """
+    发给多个连接的同一条消息。管道中前面无连接状态的层（如jsonb序列化）的结果，
+    第一次编码时保存在本对象上，其他连接直接复用，只执行后面有连接状态的层（压缩、加密）。
+    这些层的握手结果不同时（如有的连接协商了列式格式），按握手结果分别保存。
+    消息内容由多个连接共享，创建后不能修改。
+    """
+
+    __slots__ = ("encoded", "message")
+
+    def __init__(self, message: JSONType):
+        self.message = message
+        # {前面共享层的握手结果: 编码结果}
+        self.encoded: dict[tuple, bytes] = {}
+
+    def __repr__(self) -> str:
+        return repr(self.message)
+
+
 class MessagePipeline:
     """
     消息流层叠处理类。
@@ -86,10 +149,19 @@ class MessagePipeline:
     ecdh的密钥交换是连接初始化
     """
 
+    # 消息在前面可共享的层（序列化）之后超过此字节数时，后面的层（压缩、加密）放到线程池执行，
+    # 避免大消息阻塞事件循环，0为关闭。这些编解码库执行时都会释放GIL
+    OFFLOAD_THRESHOLD = 65536
+    # 线程池的线程数
+    OFFLOAD_WORKERS = 2
+    _offload_pool: ThreadPoolExecutor | None = None
+
     def __init__(self) -> None:
         self._layers: list[MessageProcessLayer] = []
         self._disabled: list[bool] = []
         self._handshake_layers_count = 0
+        # 前面连续的可共享层数，这些层没有连接状态，握手结果相同的连接编码结果相同
+        self._shared_layers_count = 0
 
     def add_layer(self, layer: MessageProcessLayer):
         """
@@ -100,6 +172,8 @@ class MessagePipeline:
         layer.on_attach(self, len(self._layers) - 1)
         if layer.is_handshake_required():
             self._handshake_layers_count += 1
+        if layer.is_shareable() and self._shared_layers_count == len(self._layers) - 1:
+            self._shared_layers_count += 1
 
     def disable_layer(self, idx: int):
         """
@@ -112,7 +186,9 @@ class MessagePipeline:
         清除所有层，重置管道
         """
         self._layers.clear()
+        self._disabled.clear()
         self._handshake_layers_count = 0
+        self._shared_layers_count = 0
 
     @property
     def num_layers(self) -> int:
@@ -145,31 +221,140 @@ class MessagePipeline:
         logger.info(_("🔧 [📡Pipeline] 握手完成 {pipe_ctx}").format(pipe_ctx=pipe_ctx))
         return pipe_ctx, self.encode(None, reply_messages)
 
-    def encode(
-        self, pipe_ctx: PipeContext | None, message: JSONType, until=-1
+    def encode_shared(
+        self, pipe_ctx: PipeContext | None, message: SharedMessage
     ) -> bytes:
         """
-        对消息进行正向处理，可以传入until参数表示只处理到哪层
+        执行前面可共享的层，结果按这些层的握手结果保存在message上，
+        之后握手结果相同的调用直接返回
         """
+        count = self._shared_layers_count
+        key = tuple(pipe_ctx[:count]) if pipe_ctx is not None else (None,) * count
+        cached = message.encoded.get(key)
+        if cached is None:
+            encoded: JSONType | Buffer = message.message
+            for i in range(count):
+                if not self._disabled[i]:
+                    encoded = self._layers[i].encode(key[i], encoded)
+            assert isinstance(encoded, Buffer)
+            # 要给多个连接使用，不能引用层内的缓冲区
+            cached = message.encoded[key] = bytes(encoded)
+        return cached
+
+    def _encode_layers(
+        self,
+        pipe_ctx: PipeContext | None,
+        encoded: JSONType | Buffer,
+        start: int,
+        stop: int,
+        until=-1,
+    ) -> JSONType | Buffer:
+        """依次执行第start到stop-1层"""
         ctx = None
-        encoded: JSONType | bytes = message
-        for i, layer in enumerate(self._layers):
+        for i in range(start, stop):
             if self._disabled[i]:
                 continue
             if 0 < until < i:
                 break
             if pipe_ctx is not None:
                 ctx = pipe_ctx[i]
-            encoded = layer.encode(ctx, encoded)
-        assert type(encoded) is bytes
+            encoded = self._layers[i].encode(ctx, encoded)
         return encoded
 
-    def decode(self, pipe_ctx: PipeContext | None, message: bytes) -> JSONType:
+    def _encode_head(
+        self,
+        pipe_ctx: PipeContext | None,
+        message: JSONType | SharedMessage,
+        until=-1,
+    ) -> JSONType | Buffer:
+        """执行前面可共享的层"""
+        count = self._shared_layers_count
+        if not isinstance(message, SharedMessage):
+            return self._encode_layers(pipe_ctx, message, 0, count, until)
+        elif 0 < until < count - 1:
+            # 只处理到共享层中间某层时，结果和缓存的不同，不使用缓存
+            return self._encode_layers(pipe_ctx, message.message, 0, count, until)
+        elif count > 0:
+            return self.encode_shared(pipe_ctx, message)
+        else:
+            return message.message
+
+    @staticmethod
+    def _to_bytes(encoded: JSONType | Buffer) -> bytes:
+        assert isinstance(encoded, Buffer)
+        # 中间结果直接传给下一层，只有最后一层返回的是层内缓冲区时才需要复制
+        return encoded if type(encoded) is bytes else bytes(encoded)
+
+    def encode(
+        self,
+        pipe_ctx: PipeContext | None,
+        message: JSONType | SharedMessage,
+        until=-1,
+    ) -> bytes:
+        """
+        对消息进行正向处理，可以传入until参数表示只处理到哪层。
+        message为 `SharedMessage` 时，前面可共享的层对握手结果相同的连接只执行一次。
+        """
+        encoded = self._encode_head(pipe_ctx, message, until)
+        encoded = self._encode_layers(
+            pipe_ctx, encoded, self._shared_layers_count, len(self._layers), until
+        )
+        return self._to_bytes(encoded)
+
+    @staticmethod
+    def _offload_executor() -> ThreadPoolExecutor:
+        """worker内所有管道共用的线程池"""
+        if MessagePipeline._offload_pool is None:
+            MessagePipeline._offload_pool = ThreadPoolExecutor(
+                max_workers=MessagePipeline.OFFLOAD_WORKERS,
+                thread_name_prefix="HeTuPipeline",
+            )
+        return MessagePipeline._offload_pool
+
+    @staticmethod
+    def shutdown_offload() -> None:
+        """关闭线程池，worker退出时调用，之后再用会重新创建"""
+        pool, MessagePipeline._offload_pool = MessagePipeline._offload_pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    async def encode_async(
+        self, pipe_ctx: PipeContext | None, message: JSONType | SharedMessage
+    ) -> bytes:
+        """
+        同 `encode`，但序列化后的消息超过 `OFFLOAD_THRESHOLD` 时，
+        后面有连接状态的层（压缩、加密）放到线程池执行，不阻塞事件循环中的其他连接。
+        同一连接必须等上一条消息编码完成再编码下一条，以保证流式压缩和加密的顺序。
+        """
+        encoded = self._encode_head(pipe_ctx, message)
+        start = self._shared_layers_count
+        if (
+            isinstance(encoded, Buffer)
+            and start < len(self._layers)
+            and 0 < self.OFFLOAD_THRESHOLD <= len(encoded)
+        ):
+            # 前面的层可能返回层内复用的缓冲区，交给线程前要复制，
+            # 并且不能在await期间继续引用它：其他连接会复用并改写该缓冲区
+            data = self._to_bytes(encoded)
+            del encoded
+            encoded = await asyncio.get_running_loop().run_in_executor(
+                self._offload_executor(),
+                self._encode_layers,
+                pipe_ctx,
+                data,
+                start,
+                len(self._layers),
+            )
+        else:
+            encoded = self._encode_layers(pipe_ctx, encoded, start, len(self._layers))
+        return self._to_bytes(encoded)
+
+    def decode(self, pipe_ctx: PipeContext | None, message: Buffer) -> JSONType:
         """
         对消息进行逆向处理
         """
         ctx = None
-        decoded: JSONType | bytes = message
+        decoded: JSONType | Buffer = message
         for i, layer in enumerate(reversed(self._layers)):
             if self._disabled[i]:
                 continue
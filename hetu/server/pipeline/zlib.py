@@ -6,12 +6,13 @@
 """
 
 import logging
+import threading
 from dataclasses import dataclass
 from typing import Any, override
 
 import zlib
 
-from .pipeline import JSONType, MessageProcessLayer
+from .pipeline import Buffer, ContextBudget, JSONType, MessageProcessLayer
 
 logger = logging.getLogger("HeTu.root")
 replay = logging.getLogger("HeTu.replay")
@@ -22,8 +23,14 @@ class ZlibLayer(MessageProcessLayer, alias="zlib"):
     使用 zlib 进行消息的流式压缩和解压缩。
 
     注意：zlib 的字典功能依赖预共享字典，当前实现不做字典训练/协商。
+
+    每个连接一对压缩/解压上下文，压缩器默认约256KB。设置 `memory_budget` 后，
+    超出预算的新连接使用较小的压缩窗口，客户端解压不受影响。
     """
 
+    # 省内存参数的memLevel，默认为8
+    REDUCED_MEM_LEVEL = 4
+
     @dataclass
     class ZlibContext:
         compressor: zlib._Compress
@@ -32,7 +39,13 @@ class ZlibLayer(MessageProcessLayer, alias="zlib"):
         def __repr__(self) -> str:
             return "ZlibContext()"
 
-    def __init__(self, level: int = 1, wbits: int = zlib.MAX_WBITS):
+    def __init__(
+        self,
+        level: int = 1,
+        wbits: int = zlib.MAX_WBITS,
+        memory_budget: int = 0,
+        reduced_wbits: int = 10,
+    ):
         """
         Parameters
         ----------
@@ -40,13 +53,47 @@ class ZlibLayer(MessageProcessLayer, alias="zlib"):
                 zlib 压缩级别，范围 0-9，zlib标准6, 但较慢。
         wbits
                 窗口大小/数据格式控制，默认 zlib.MAX_WBITS。
+        memory_budget
+                本worker所有连接的压缩上下文的内存预算（字节），0为不限制。
+        reduced_wbits
+                超出预算时，新连接压缩使用的窗口大小（log2），范围 9-15。
         """
         super().__init__()
         self.level = level
         self.wbits = wbits
+        self.reduced_wbits = reduced_wbits
+        self.budget = ContextBudget(memory_budget)
         self.encode_count = 0
         self.encode_ratio = 0.0
+        # 大消息在线程池中编码（见 `MessagePipeline.encode_async`），统计要加锁
+        self._stats_lock = threading.Lock()
         self.dict_message: bytes = self._build_dict_from_keys()
+        # 预先载入字典的上下文，握手时复制，字典不用每个连接重新处理
+        zdict = self.dict_message
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, wbits, zlib.DEF_MEM_LEVEL, zdict=zdict
+        )
+        self._reduced_compressor = zlib.compressobj(
+            level,
+            zlib.DEFLATED,
+            self._with_window(reduced_wbits),
+            self.REDUCED_MEM_LEVEL,
+            zdict=zdict,
+        )
+        self._decompressor = zlib.decompressobj(wbits, zdict=zdict)
+
+    def _with_window(self, bits: int) -> int:
+        """返回和wbits相同数据格式（raw/zlib/gzip），窗口为bits的wbits"""
+        if self.wbits < 0:
+            return -bits
+        if self.wbits > zlib.MAX_WBITS:
+            return bits + 16
+        return bits
+
+    @staticmethod
+    def _compressor_size(wbits: int, mem_level: int) -> int:
+        """zlib文档给出的压缩上下文内存"""
+        return (1 << ((abs(wbits) & 15) + 2)) + (1 << (mem_level + 9))
 
     @staticmethod
     def _build_dict_from_keys() -> bytes:
@@ -74,46 +121,55 @@ class ZlibLayer(MessageProcessLayer, alias="zlib"):
     def handshake(self, message: bytes) -> tuple[Any, bytes]:
         """
         连接前握手工作。
-        zlib 不做字典协商，忽略 message 并返回空字节。
+        zlib 不做字典协商，忽略 message 并返回字典内容。
         """
-        zdict = self.dict_message
+        size = self._compressor_size(self.wbits, zlib.DEF_MEM_LEVEL)
+        reduced = not self.budget.fits(size)
+        if reduced:
+            size = self._compressor_size(self.reduced_wbits, self.REDUCED_MEM_LEVEL)
+            compressor = self._reduced_compressor.copy()
+        else:
+            compressor = self._compressor.copy()
 
         ctx = self.ZlibContext(
-            compressor=zlib.compressobj(
-                self.level, zlib.DEFLATED, self.wbits, zdict=zdict
-            ),
-            decompressor=zlib.decompressobj(self.wbits, zdict=zdict),
+            compressor=compressor,
+            decompressor=self._decompressor.copy(),
         )
+        self.budget.track(ctx, size, reduced)
         return ctx, self.dict_message or b""
 
     @override
-    def encode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def encode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
         对消息进行正向处理（流式压缩）
         """
         if not layer_ctx:
             return message
 
-        assert type(message) is bytes, "ZlibCompressor 只能压缩 bytes 类型的消息"
+        assert isinstance(message, Buffer), "ZlibCompressor 只能压缩 bytes 类型的消息"
 
         # Z_SYNC_FLUSH 保持流式语义，确保对端及时解压
-        chunk = layer_ctx.compressor.compress(message)
-        chunk += layer_ctx.compressor.flush(zlib.Z_SYNC_FLUSH)
+        # 小消息compress一般全部缓存在内部，输出都在flush中，这时不用拼接复制
+        head = layer_ctx.compressor.compress(message)
+        chunk = layer_ctx.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if head:
+            chunk = head + chunk
 
         ratio = len(chunk) / len(message) if len(message) > 0 else 1.0
-        self.encode_count += 1
-        self.encode_ratio += (ratio - self.encode_ratio) / self.encode_count
+        with self._stats_lock:
+            self.encode_count += 1
+            self.encode_ratio += (ratio - self.encode_ratio) / self.encode_count
         return chunk
 
     @override
-    def decode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def decode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
         对消息进行逆向处理（流式解压）
         """
         if not layer_ctx:
             return message
 
-        assert type(message) is bytes, "ZlibDecompressor 只能解压 bytes 类型的消息"
+        assert isinstance(message, Buffer), "ZlibDecompressor 只能解压 bytes 类型的消息"
 
         try:
             return layer_ctx.decompressor.decompress(message)
@@ -5,31 +5,63 @@
 @email: heeroz@gmail.com
 """
 
+import asyncio
 import compression.zstd as zstd  # 仅在 Python 3.14+ 可用
 import logging
+import random
+import struct
+import threading
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import Any, override
 
 import numpy as np
 
-from .pipeline import JSONType, MessageProcessLayer
+from .pipeline import Buffer, ContextBudget, JSONType, MessageProcessLayer
 
 logger = logging.getLogger("HeTu.root")
 replay = logging.getLogger("HeTu.replay")
 
+_DICT_ID = struct.Struct("<I")
+
 
 class ZstdLayer(MessageProcessLayer, alias="zstd"):
     """
     使用python 3.14内置的 compression/zstd 模块进行消息的压缩和解压缩。
+
+    字典一开始用随机生成的样本训练，之后按比例采样实际发出的消息，
+    每隔 `retrain_interval` 秒在线程中用真实样本重新训练，不阻塞事件循环。
+    字典按dict_id区分版本，保留最近几个：握手时客户端可以发送缓存的字典的dict_id（4字节），
+    服务器还保留该版本的话就继续使用，只回复dict_id；否则回复最新字典的完整内容。
+
+    字典只消化（digest）一次，所有连接的压缩、解压上下文共用。压缩上下文的内存主要是窗口，
+    设置 `memory_budget` 后，超出预算的新连接使用 `reduced_window_log` 的窗口。
     """
 
+    # 未指定window_log时，估算内存用的窗口大小，为level 3左右的默认值
+    DEFAULT_WINDOW_LOG = 21
+
     @dataclass
     class ZstdContext:
         compressor: zstd.ZstdCompressor
         decompressor: zstd.ZstdDecompressor
 
-    def __init__(self, level: int = 3, dict_size: int = 1024):
+    # 用真实样本训练至少需要的样本数
+    MIN_SAMPLES = 1000
+
+    def __init__(
+        self,
+        level: int = 3,
+        dict_size: int = 1024,
+        sample_rate: float = 0.01,
+        max_samples: int = 5000,
+        retrain_interval: float = 86400,
+        max_dicts: int = 3,
+        window_log: int = 0,
+        memory_budget: int = 0,
+        reduced_window_log: int = 17,
+    ):
         """
 
         Parameters
@@ -40,16 +72,44 @@ class ZstdLayer(MessageProcessLayer, alias="zstd"):
         dict_size
             Zstd字典的大小，单位为字节。字典保存常用字符串，比如Component的属性名，极大增加压缩率。
             较大的字典会增加连接时的网络开销，一般推荐使用1024字节（1KB）。
+        sample_rate
+            采样实际发出的消息作为训练样本的比例，0为不采样，只用随机样本训练一次。
+        max_samples
+            每个worker最多保存的样本数，训练后清空重新采样。
+        retrain_interval
+            重新训练字典的间隔秒数，到期后有新连接握手时，在线程中训练。
+        max_dicts
+            保留的字典版本数，客户端缓存的旧版本字典在此范围内仍可使用。
+        window_log
+            压缩窗口大小（log2），范围10-31，0为压缩级别的默认值。
+        memory_budget
+            本worker所有连接的压缩上下文的内存预算（字节），0为不限制。
+        reduced_window_log
+            超出预算时，新连接使用的压缩窗口大小（log2）。
         """
         super().__init__()
         self.level = level
         self.dict_size = dict_size
-        self.samples: list[Any] = []
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        self.retrain_interval = retrain_interval
+        self.max_dicts = max_dicts
+        self.window_log = window_log
+        self.reduced_window_log = reduced_window_log
+        self.budget = ContextBudget(memory_budget)
+        self.samples: list[bytes] = []
         self.zstd_dict: zstd.ZstdDict | None = None
+        # {dict_id: 字典} 最近训练的字典版本，最后一个为最新
+        self.dicts: OrderedDict[int, zstd.ZstdDict] = OrderedDict()
         self.dict_message: bytes = b""
         self.last_trained_at: float = 0.0
+        self._training: asyncio.Task | None = None
         self.encode_count = 0
         self.encode_ratio = 0.0
+        # 每条消息的平均压缩耗时（秒）
+        self.encode_time = 0.0
+        # 大消息在线程池中编码（见 `MessagePipeline.encode_async`），统计和采样要加锁
+        self._stats_lock = threading.Lock()
 
     def initial_samples(self) -> list[bytes]:
         """
@@ -125,51 +185,127 @@ class ZstdLayer(MessageProcessLayer, alias="zstd"):
         然后用它们作为样本。
         """
         # 如果有运行期间收集的数据，用它们训练
-        if len(self.samples) > 1000:
-            samples = self.samples
+        if len(self.samples) >= self.MIN_SAMPLES:
+            with self._stats_lock:
+                samples, self.samples = self.samples, []
         else:
             # 否则使用初始样本
             samples = self.initial_samples()
         # 训练Zstd字典
         return zstd.train_dict(samples, self.dict_size)
 
+    def install_dict(self, zstd_dict: zstd.ZstdDict) -> None:
+        """把字典加入版本列表并作为最新字典，超过 `max_dicts` 的旧版本丢弃"""
+        self.dicts[zstd_dict.dict_id] = zstd_dict
+        self.dicts.move_to_end(zstd_dict.dict_id)
+        while len(self.dicts) > self.max_dicts:
+            self.dicts.popitem(last=False)
+        self.zstd_dict = zstd_dict
+        self.dict_message = zstd_dict.dict_content
+        self.last_trained_at = time.time()
+
+    async def retrain(self) -> None:
+        """用采样的真实消息在线程中训练新字典，之后握手的连接使用新字典"""
+        with self._stats_lock:
+            samples, self.samples = self.samples, []
+        started = time.perf_counter()
+        try:
+            zstd_dict = await asyncio.to_thread(
+                zstd.train_dict, samples, self.dict_size
+            )
+        except Exception as e:
+            # 训练失败不影响使用旧字典
+            self.last_trained_at = time.time()
+            logger.exception(
+                f"❌ [📡Pipeline] [Zstd层] 字典训练失败，异常：{type(e).__name__}:{e}"
+            )
+            return
+        self.install_dict(zstd_dict)
+        logger.info(
+            f"🔧 [📡Pipeline] [Zstd层] 用{len(samples)}条样本重新训练字典 "
+            f"{zstd_dict.dict_id}，耗时{time.perf_counter() - started:.2f}秒，"
+            f"之前的平均压缩比{self.encode_ratio:.3f}，"
+            f"平均压缩耗时{self.encode_time * 1e6:.1f}微秒"
+        )
+
+    def _schedule_retrain(self) -> None:
+        """到了重新训练的时间且样本足够时，在后台开始训练"""
+        if self._training is not None and not self._training.done():
+            return
+        if time.time() - self.last_trained_at < self.retrain_interval:
+            return
+        if len(self.samples) < self.MIN_SAMPLES:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._training = loop.create_task(self.retrain())
+
+    def _sample(self, message: Buffer) -> None:
+        """按比例采样发出的消息"""
+        if len(self.samples) < self.max_samples and random.random() < self.sample_rate:
+            # message可能指向上一层复用的缓冲区，要复制
+            sample = bytes(message)
+            with self._stats_lock:
+                self.samples.append(sample)
+
     @override
     def handshake(self, message: bytes) -> tuple[Any, bytes]:
         """
         连接前握手工作，例如协商参数等。
         返回的第一个值会保存在连接中，贯穿之后的encode/decode调用。
         返回的第二个值会发送给对端。
+
+        message为空表示使用最新字典；为4字节时是客户端缓存的字典的dict_id，
+        该版本还在的话继续使用它，并只回复dict_id；更长则是对端的字典内容。
         """
-        if len(message) == 0:
-            # 如果没有训练过字典，用初始样本训练
+        reply = b""
+        zstd_dict: zstd.ZstdDict | None = None
+        if len(message) == _DICT_ID.size:
+            zstd_dict = self.dicts.get(_DICT_ID.unpack(message)[0])
+            if zstd_dict is not None:
+                reply = bytes(message)
+        elif len(message) > 0:
+            # 如果对端发送了字典数据，使用对端的字典
+            self.install_dict(zstd.ZstdDict(message))
+        if not reply:
+            # 如果没有训练过字典，用初始样本训练，反之定期用采样的真实消息更新字典
             if self.zstd_dict is None:
-                self.zstd_dict = self.train_dict()
-                self.last_trained_at = time.time()
-                self.dict_message = self.zstd_dict.dict_content
+                self.install_dict(self.train_dict())
             else:
-                # 反之定期的更新字典
-                # todo 如果上次训练时间超过24小时，重新训练字典
-                pass
-        else:
-            # 如果对端发送了字典数据，使用对端的字典
-            self.zstd_dict = zstd.ZstdDict(message)
-            self.dict_message = self.zstd_dict.dict_content
+                self._schedule_retrain()
+            zstd_dict = self.zstd_dict
+            reply = self.dict_message
 
-        assert self.dict_message
+        assert zstd_dict is not None and reply
 
+        window_log = self.window_log or self.DEFAULT_WINDOW_LOG
+        reduced = not self.budget.fits(self._compressor_size(window_log))
+        options = {zstd.CompressionParameter.compression_level: self.level}
+        if reduced:
+            window_log = min(window_log, self.reduced_window_log)
+        if reduced or self.window_log:
+            options[zstd.CompressionParameter.window_log] = window_log
+
+        # as_digested_dict会在zstd_dict内部建立已消化字典的cache，所有连接共用
+        # 但是部分压缩参数会有被字典的参数覆盖，这里没用到那些参数所以无妨
         ctx = self.ZstdContext(
             compressor=zstd.ZstdCompressor(
-                level=self.level,
-                # as_digested_dict会在self.zstd_dict内部建立已消化字典的cache，让下次加载更快
-                # 但是部分压缩参数会有被字典的参数覆盖，这里没用到那些参数所以无妨
-                zstd_dict=self.zstd_dict.as_digested_dict,
+                options=options, zstd_dict=zstd_dict.as_digested_dict
             ),
-            decompressor=zstd.ZstdDecompressor(zstd_dict=self.zstd_dict),
+            decompressor=zstd.ZstdDecompressor(zstd_dict=zstd_dict.as_digested_dict),
         )
-        return ctx, self.dict_message
+        self.budget.track(ctx, self._compressor_size(window_log), reduced)
+        return ctx, reply
+
+    @staticmethod
+    def _compressor_size(window_log: int) -> int:
+        """估算压缩上下文的内存：窗口加上约一半大小的匹配表"""
+        return (1 << window_log) + (1 << (window_log - 1))
 
     @override
-    def encode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def encode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
         对消息进行正向处理（流式压缩）
         """
@@ -177,26 +313,30 @@ class ZstdLayer(MessageProcessLayer, alias="zstd"):
         if not layer_ctx:
             return message
 
-        assert type(message) is bytes, "ZstdCompressor只能压缩bytes类型的消息"
+        assert isinstance(message, Buffer), "ZstdCompressor只能压缩bytes类型的消息"
 
-        # todo 如果self.samples长度不足，说明被清空了，收集样本数据以便后续训练字典
-        # todo， 记录实际压缩比率，和压缩耗时，对应level和dict_size参数，以便后续调优
+        if self.sample_rate > 0:
+            self._sample(message)
 
         # 使用预训练的字典进行压缩
         # 1. 写入数据到流
         # 2. FLUSH_BLOCK:
         #    这会强制输出当前块的数据，确保接收端能立即收到并解压。
         #    同时不会结束当前帧 (Frame)，保留了历史参考信息（流式压缩的核心优势）。
+        started = time.perf_counter()
         chunk = layer_ctx.compressor.compress(
             message, mode=zstd.ZstdCompressor.FLUSH_BLOCK
         )
-        ratio = len(chunk) / len(message)
-        self.encode_count += 1
-        self.encode_ratio += (ratio - self.encode_ratio) / self.encode_count
+        elapsed = time.perf_counter() - started
+        ratio = len(chunk) / len(message) if len(message) > 0 else 1.0
+        with self._stats_lock:
+            self.encode_count += 1
+            self.encode_ratio += (ratio - self.encode_ratio) / self.encode_count
+            self.encode_time += (elapsed - self.encode_time) / self.encode_count
         return chunk
 
     @override
-    def decode(self, layer_ctx: Any, message: JSONType | bytes) -> JSONType | bytes:
+    def decode(self, layer_ctx: Any, message: JSONType | Buffer) -> JSONType | Buffer:
         """
         对消息进行逆向处理（流式解压）
         """
@@ -204,7 +344,7 @@ class ZstdLayer(MessageProcessLayer, alias="zstd"):
         if not layer_ctx:
             return message
 
-        assert type(message) is bytes, "ZstdDecompressor只能解压bytes类型的消息"
+        assert isinstance(message, Buffer), "ZstdDecompressor只能解压bytes类型的消息"
 
         # 反之，使用字典流式解压
         # zstd 模块会自动处理跨包的数据缓冲
@@ -7,6 +7,7 @@
 
 import asyncio
 import logging
+from collections import OrderedDict
 from typing import TYPE_CHECKING, Any
 
 from redis.exceptions import ConnectionError as RedisConnectionError
@@ -18,7 +19,7 @@ import hetu  # for obtaining __version__
 from ..endpoint import connection
 from ..endpoint.response import RejectResponse, ResponseToClient
 from ..i18n import _
-from .pipeline.pipeline import PipeContext, ServerMessagePipeline
+from .pipeline.pipeline import PipeContext, ServerMessagePipeline, SharedMessage
 
 if TYPE_CHECKING:
     from sanic import Websocket
@@ -37,20 +38,71 @@ BAD_SUBS = [
 ]
 
 
+# 每个连接同时执行的call消息数，0为关闭并发，call消息按收到的顺序逐个执行
+RPC_CONCURRENCY = 0
+# 一条batch消息最多包含的调用数
+MAX_BATCH_CALLS = 32
+
+
 def check_length(name, data: list, left, right):
     if left > len(data) > right:
         raise ValueError(f"Invalid {name} message")
 
 
+def batch_calls(data: list) -> list[list]:
+    """检查batch消息 `["batch", concurrent, [[endpoint_name, args ...], ...]]`，返回调用列表"""
+    check_length("batch", data, 3, 3)
+    calls = data[2]
+    if type(calls) is not list or not 0 < len(calls) <= MAX_BATCH_CALLS:
+        raise ValueError(
+            _("batch消息的调用数必须在1-{max}之间").format(max=MAX_BATCH_CALLS)
+        )
+    for call in calls:
+        if type(call) is not list or not call or type(call[0]) is not str:
+            raise ValueError(_("无效的batch调用：{call}").format(call=call))
+    return calls
+
+
+def update_msg(broker: SubscriptionBroker) -> str:
+    """订阅推送的消息类型，开启差量推送时为delt，客户端按差量合并到已有的行"""
+    return "delt" if broker.DELTA_UPDATES else "updt"
+
+
+# worker内最近的订阅推送消息条数，用于合并不同连接的相同推送，0为关闭
+SHARED_PUSH_CACHE_SIZE = 1024
+_shared_pushes: OrderedDict[tuple, SharedMessage] = OrderedDict()
+
+
+def shared_push(msg_type: str, sub_id: str, data: dict) -> SharedMessage | list:
+    """
+    返回订阅推送消息。订阅的行来自worker内共享的读取结果（见 `SHARED_QUERIES`），
+    所以不同连接的相同订阅，推送的是同一批行对象。按行对象合并为同一个 `SharedMessage`，
+    只序列化一次。缓存持有行对象的引用，所以id不会被复用。
+    """
+    if SHARED_PUSH_CACHE_SIZE <= 0:
+        return [msg_type, sub_id, data]
+    key = (msg_type, sub_id, *((row_id, id(row)) for row_id, row in data.items()))
+    shared = _shared_pushes.get(key)
+    if shared is None:
+        shared = _shared_pushes[key] = SharedMessage([msg_type, sub_id, data])
+        if len(_shared_pushes) > SHARED_PUSH_CACHE_SIZE:
+            _shared_pushes.popitem(last=False)
+    else:
+        _shared_pushes.move_to_end(key)
+    return shared
+
+
 async def rpc(
     data: list,
     executor: EndpointExecutor,
     push_queue: asyncio.Queue,
     debug: int = 0,
+    req_id: Any = None,
 ):
-    """处理Client SDK调用Endpoint的命令"""
+    """处理Client SDK调用Endpoint的命令，有req_id时回复的消息末尾带上req_id"""
     # print(executor.context, 'rpc', data)
     check_length("rpc", data, 2, 100)
+    tag = () if req_id is None else (req_id,)
     ok, res = await executor.execute(data[1], *data[2:])
     # 如果关闭了replay，为了速度，不执行下面的字符串序列化
     if replay.level < logging.ERROR:
@@ -62,21 +114,131 @@ async def rpc(
         # release 模式下直接关闭连接，不向客户端泄露任何原因。
         if debug:
             reason = res if isinstance(res, str) else "server rejected the request."
-            await push_queue.put(["err", data[1], reason])
+            await push_queue.put(["err", data[1], reason, *tag])
             return True
         return False
 
     if isinstance(res, RejectResponse):
         # 软拒绝：发 rej 帧，连接保持
-        await push_queue.put(["rej", data[1], res.code])
+        await push_queue.put(["rej", data[1], res.code, *tag])
     elif isinstance(res, ResponseToClient):
-        await push_queue.put(["rsp", res.message])
+        await push_queue.put(["rsp", res.message, *tag])
     else:
         # 无视返回值，直接返回ok，如果不返回，Request无法对应
-        await push_queue.put(["rsp", "ok"])
+        await push_queue.put(["rsp", "ok", *tag])
     return True
 
 
+class RpcScheduler:
+    """
+    每个连接一个，执行带请求id的调用：`["call", req_id, ordered, endpoint, args...]`，
+    回复的rsp/rej/err消息末尾带上req_id，客户端按id对应请求。
+
+    开启 `RPC_CONCURRENCY` 后，调用在后台并发执行，慢的调用不再阻塞后面的消息，
+    同时执行的调用数超过限制时，暂停读取客户端消息。
+    ordered为真的调用和普通的rpc消息，按收到的顺序逐个执行，使用连接的Context，
+    登录等修改连接状态的调用必须用这种方式；其他调用使用Context的副本，不保证顺序。
+    """
+
+    def __init__(
+        self,
+        ws: Websocket,
+        executor: EndpointExecutor,
+        push_queue: asyncio.Queue,
+        debug: int = 0,
+    ):
+        self.ws = ws
+        self.executor = executor
+        self.push_queue = push_queue
+        self.debug = debug
+        self._ordered = asyncio.Lock()
+        self._slots = asyncio.Semaphore(max(RPC_CONCURRENCY, 1))
+        self._tasks: set[asyncio.Task] = set()
+
+    async def rpc(self, data: list) -> bool:
+        """执行普通rpc消息，等待之前的ordered调用完成"""
+        async with self._ordered:
+            return await rpc(data, self.executor, self.push_queue, self.debug)
+
+    async def call(self, data: list) -> bool:
+        """执行call消息，开启并发时在后台执行，直接返回True"""
+        check_length("call", data, 4, 100)
+        req_id, ordered = data[1], bool(data[2])
+        rpc_data = ["rpc", *data[3:]]
+        if RPC_CONCURRENCY <= 0:
+            return await rpc(
+                rpc_data, self.executor, self.push_queue, self.debug, req_id
+            )
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._run(rpc_data, req_id, ordered))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def batch(self, concurrent: bool, calls: list[list]) -> bool:
+        """
+        执行batch消息中的调用，所有回复按调用的顺序合为一条 `["bat", [回复, ...]]` 消息。
+        concurrent为真且开启了 `RPC_CONCURRENCY` 时，各调用使用Context副本并发执行，
+        和call消息共用并发数限制；否则和rpc消息一样按顺序逐个执行。
+        有调用非法时返回False，不发送回复。
+        """
+        queues = [asyncio.Queue() for _ in calls]
+        if concurrent and RPC_CONCURRENCY > 0:
+            results = await asyncio.gather(
+                *(self._run_slot(call, queue) for call, queue in zip(calls, queues))
+            )
+        else:
+            results = []
+            async with self._ordered:
+                for call, queue in zip(calls, queues):
+                    ok = await rpc(["rpc", *call], self.executor, queue, self.debug)
+                    results.append(ok)
+                    if not ok:
+                        break
+        if not all(results):
+            return False
+        # 每个调用正好一条回复
+        await self.push_queue.put(["bat", [queue.get_nowait() for queue in queues]])
+        return True
+
+    async def _run_slot(self, call: list, queue: asyncio.Queue) -> bool:
+        """占用一个并发名额，用Context副本执行batch中的一个调用"""
+        async with self._slots:
+            return await rpc(["rpc", *call], self.executor.fork(), queue, self.debug)
+
+    async def _run(self, data: list, req_id: Any, ordered: bool):
+        try:
+            if ordered:
+                # asyncio.Lock按等待的先后顺序获得，task按创建顺序开始执行
+                async with self._ordered:
+                    ok = await rpc(
+                        data, self.executor, self.push_queue, self.debug, req_id
+                    )
+            else:
+                ok = await rpc(
+                    data, self.executor.fork(), self.push_queue, self.debug, req_id
+                )
+            if not ok:
+                self.ws.fail_connection()
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            err_msg = _(
+                "❌ [📡WSReceiver] 执行异常，封包：{data}，异常：{err}"
+            ).format(data=data, err=f"{type(e).__name__}:{e}")
+            replay.info(err_msg)
+            logger.exception(err_msg)
+            self.ws.fail_connection()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """连接断开时取消还在执行的调用"""
+        for task in self._tasks:
+            task.cancel()
+
+
 async def sub_call(
     data: list,
     executor: EndpointExecutor,
@@ -104,8 +266,13 @@ async def sub_call(
             check_length("range", data, 5, 8)
             sub_id, sub_data = await broker.subscribe_range(table, ctx, *data[3:])
         case "logic_query":
-            # todo 逻辑订阅，query后再通过脚本进行二次筛选，再发送到客户端，更新时也会调用筛选代码
-            pass
+            # 带筛选条件的range订阅：sub component_name logic_query where index left ...
+            check_length("logic_query", data, 6, 10)
+            sub_id, sub_data = await broker.subscribe_query(table, ctx, *data[3:])
+        case "aoi":
+            # AOI视野订阅：sub component_name aoi x0 y0 x1 y1 [limit]
+            check_length("aoi", data, 7, 8)
+            sub_id, sub_data = await broker.subscribe_aoi(table, ctx, *data[3:])
         case _:
             raise ValueError(_(" [非法操作] 未知订阅操作：{op}").format(op=data[2]))
 
@@ -135,6 +302,7 @@ async def client_handler(
     """ws接受消息循环，是一个asyncio的task，由loop.call_soon方法添加到worker主协程的执行队列"""
     pipe = ServerMessagePipeline()
     ctx = executor.context
+    scheduler = RpcScheduler(ws, executor, push_queue, debug)
     last_data = None
     try:
         async for message in ws:
@@ -159,15 +327,34 @@ async def client_handler(
             match last_data[0]:
                 case "rpc":  # rpc endpoint_name args ...
                     # rpc() 内部按 debug 决定失败时发 err 帧（保持连接）还是关连接
-                    if not await rpc(last_data, executor, push_queue, debug):
+                    if not await scheduler.rpc(last_data):
+                        return ws.fail_connection()
+                case "call":  # call req_id ordered endpoint_name args ...
+                    if not await scheduler.call(last_data):
                         return ws.fail_connection()
-                case "sub":  # sub component_name get/range args ...
+                case "batch":  # batch concurrent [[endpoint_name, args ...], ...]
+                    calls = batch_calls(last_data)
+                    # 每个调用都计入接受上限
+                    flood_checker.received(len(calls) - 1)
+                    if flood_checker.recv_limit_reached(
+                        ctx, "Coroutines(Websocket.client_handler)"
+                    ):
+                        return ws.fail_connection()
+                    if not await scheduler.batch(bool(last_data[1]), calls):
+                        return ws.fail_connection()
+                case "sub":  # sub component_name get/range/logic_query/aoi args ...
                     sub_ok = await sub_call(last_data, executor, broker, push_queue)
                     if not sub_ok:
                         if debug:
                             await push_queue.put(BAD_SUBS)
                         else:
                             return ws.fail_connection()
+                case "aoi":  # aoi sub_id x0 y0 x1 y1，移动AOI订阅的矩形
+                    check_length("aoi", last_data, 6, 6)
+                    updates = await broker.move_aoi(*last_data[1:])
+                    if updates:
+                        reply = [update_msg(broker), last_data[1], updates]
+                        await push_queue.put(reply)
                 case "unsub":  # unsub sub_id
                     check_length("unsub", last_data, 2, 2)
                     await broker.unsubscribe(last_data[1])
@@ -196,7 +383,7 @@ async def client_handler(
         return ws.fail_connection()
     finally:
         # print(ctx, 'client_handler closed')
-        pass
+        scheduler.close()
 
 
 async def mq_puller(ws: Websocket, broker: SubscriptionBroker):
@@ -233,9 +420,9 @@ async def subscription_handler(
     try:
         while True:
             last_updates = await broker.get_updates()
+            msg_type = update_msg(broker)
             for sub_id, data in last_updates.items():
-                reply = ["updt", sub_id, data]
-                await push_queue.put(reply)
+                await push_queue.put(shared_push(msg_type, sub_id, data))
     except asyncio.CancelledError:
         # print('subscription_handler normal canceled')
         pass
@@ -17,7 +17,7 @@ from ..endpoint.executor import EndpointExecutor
 from ..i18n import _
 from ..system.caller import SystemCaller
 from ..system.context import SystemContext
-from .pipeline import ServerMessagePipeline
+from .pipeline import ServerMessagePipeline, SharedMessage
 from .receiver import client_handler, mq_puller, subscription_handler
 from .web import HETU_BLUEPRINT
 
@@ -25,6 +25,34 @@ logger = logging.getLogger("HeTu.root")
 replay = logging.getLogger("HeTu.replay")
 DISCONNECT_SYSTEM = "on_disconnect"
 
+# 合批发送：队列中有多条待推送消息时，等待此秒数内的后续消息，合并为一条 ["bat", [消息, ...]]
+# 只编码/压缩/加密一次。0为关闭，需要客户端SDK支持bat消息
+PUSH_COALESCE_WINDOW = 0.0
+# 一次合批的最大消息数
+PUSH_COALESCE_MAX = 64
+
+
+async def next_pushes(push_queue: asyncio.Queue) -> list:
+    """
+    取出下一批要发送的消息。队列中只有一条时立即返回，不增加空闲连接的延迟；
+    有堆积说明连接繁忙，再等待最多 `PUSH_COALESCE_WINDOW` 秒，收集后续消息一起发送。
+    """
+    batch = [await push_queue.get()]
+    if PUSH_COALESCE_WINDOW <= 0:
+        return batch
+    while not push_queue.empty() and len(batch) < PUSH_COALESCE_MAX:
+        batch.append(push_queue.get_nowait())
+    if len(batch) == 1:
+        return batch
+    deadline = asyncio.get_running_loop().time() + PUSH_COALESCE_WINDOW
+    try:
+        async with asyncio.timeout_at(deadline):
+            while len(batch) < PUSH_COALESCE_MAX:
+                batch.append(await push_queue.get())
+    except TimeoutError:
+        pass
+    return batch
+
 
 @HETU_BLUEPRINT.websocket("/hetu/<db_name>")  # noqa
 async def websocket_connection(request: Request, ws: Websocket, db_name: str) -> None:
@@ -113,7 +141,9 @@ async def websocket_connection(request: Request, ws: Websocket, db_name: str) ->
     await endpoint_executor.initialize(request.client_ip)
 
     # 初始化订阅管理器，一个连接一个订阅管理器
-    broker = SubscriptionBroker(request.app.ctx.default_backend)
+    broker = SubscriptionBroker(
+        request.app.ctx.default_backend, system_caller.row_cache
+    )
 
     # 初始化push消息队列
     push_queue = asyncio.Queue(1024)
@@ -149,14 +179,23 @@ async def websocket_connection(request: Request, ws: Websocket, db_name: str) ->
     # 这里循环发送，保证总是第一时间Push
     try:
         while True:
-            reply = await push_queue.get()
+            replies = await next_pushes(push_queue)
             # 如果关闭了replay，为了速度不执行下面的字符串序列化
             if replay.level < logging.ERROR:
-                replay.debug(">>> " + str(reply))
+                for reply in replies:
+                    replay.debug(">>> " + str(reply))
             # print(executor.context, 'got', reply)
-            await ws.send(msg_pipe.encode(pipe_ctx, reply))
-            # 检查发送上限
-            flood_checker.sent()
+            if len(replies) == 1:
+                reply = replies[0]
+            else:
+                # 合批后是新的消息，共享消息只能展开
+                reply = [
+                    "bat",
+                    [r.message if isinstance(r, SharedMessage) else r for r in replies],
+                ]
+            await ws.send(await msg_pipe.encode_async(pipe_ctx, reply))
+            # 检查发送上限，按合批前的消息数计
+            flood_checker.sent(len(replies))
             if flood_checker.send_limit_reached(context, "Coroutines(Websocket.push)"):
                 ws.fail_connection()
                 break
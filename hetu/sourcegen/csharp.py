@@ -74,10 +74,55 @@ def generate_component(component_cls: type[BaseComponent]):
     return lines
 
 
-def generate_all_components(namespace: str, output: str):
+def generate_row_struct(component_cls: type[BaseComponent]):
+    """
+    生成列式格式（见 `ColumnarLayer`）中行的struct布局，字段顺序和大小与服务器一致。
+    str为定长UTF-32，需要开启unsafe代码。
+    """
+    from hetu.server.pipeline.columnar import row_dtype
+
+    dtype = row_dtype(component_cls)
+    assert dtype.names
+    fields = []
+    for name in dtype.names:
+        field_type = dtype[name]
+        cs_name = "ID" if name == "id" else to_csharp_property_name(name)
+        match field_type.kind:
+            case "U":
+                fields.append(
+                    f"    public fixed uint {cs_name}[{field_type.itemsize // 4}];"
+                )
+            case "S":
+                fields.append(
+                    f"    public fixed byte {cs_name}[{field_type.itemsize}];"
+                )
+            case "b":
+                fields.append(f"    public byte {cs_name};")
+            case "f" if field_type.itemsize == 2:
+                # half按原始位传输
+                fields.append(f"    public ushort {cs_name};")
+            case _:
+                fields.append(f"    public {dtype_to_csharp(field_type)} {cs_name};")
+    unsafe = "unsafe " if any(dtype[name].kind in "US" for name in dtype.names) else ""
+
+    lines = [
+        "",
+        "[StructLayout(LayoutKind.Sequential, Pack = 1)]",
+        f"public {unsafe}struct {component_cls.name_}Row",
+        "{",
+        f"    public const int Size = {dtype.itemsize};",
+        *fields,
+        "}",
+        "",
+    ]
+    return lines
+
+
+def generate_all_components(namespace: str, output: str, columnar: bool = False):
     lines = [
         "using HeTu;",
         "using MessagePack;",
+        *(["using System.Runtime.InteropServices;"] if columnar else []),
         "",
         f"namespace {namespace}",
         "{",
@@ -106,6 +151,10 @@ def generate_all_components(namespace: str, output: str):
 
     for component_cls in tqdm(components):
         lines.extend([" " * 4 + line for line in generate_component(component_cls)])
+        if columnar:
+            lines.extend(
+                [" " * 4 + line for line in generate_row_struct(component_cls)]
+            )
 
     lines.append("}")
 
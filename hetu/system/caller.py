@@ -15,7 +15,9 @@ from ..common.slowlog import SlowLog
 from ..data.backend import RaceCondition
 from ..i18n import _
 from .definer import SystemClusters, SystemDefine
+from .hotkey import HotKeyGate
 from .lock import SystemLock
+from .rowcache import ConnectionRowCache
 
 if TYPE_CHECKING:
     from ..manager import ComponentTableManager
@@ -27,6 +29,7 @@ replay = logging.getLogger("HeTu.replay")
 SYSTEM_CLUSTERS = SystemClusters()
 SystemClusters = None
 SLOW_LOG = SlowLog()
+HOT_KEYS = HotKeyGate()
 
 
 class SystemCaller:
@@ -40,6 +43,8 @@ class SystemCaller:
         self.namespace = namespace
         self.tbl_mgr = tbl_mgr
         self.context = context
+        # 连接级行缓存，跨System调用复用读过的行
+        self.row_cache = ConnectionRowCache()
 
     @classmethod
     def call_check(cls, system: str) -> SystemDefine:
@@ -98,11 +103,15 @@ class SystemCaller:
         start_time = time.perf_counter()
         # 调用系统
         while context.race_count < sys.max_retry:
-            # 开始新的事务，并attach components
-            await session.__aenter__()
-
-            # 执行system和事务
+            # 该System冲突过的热点行，先在本worker内排队，逐个执行（失败时acquire会自行释放）
+            lease = await HOT_KEYS.acquire(sys_name)
+            # 执行system和事务，之后的任何异常都要走finally释放lease
             try:
+                # 开始新的事务，并attach components
+                await session.__aenter__()
+                idmap = session.idmap
+                self.row_cache.attach(idmap)
+
                 # 先检查uuid是否执行过了
                 if uuid and await context.repo[SystemLock].get(uuid=uuid):
                     replay.info(f"[UUIDExist][{sys_name}] 该uuid {uuid} 已执行过")
@@ -121,15 +130,35 @@ class SystemCaller:
                         lock.called = time.time()
                         lock.name = sys_name
                 # 执行事务
+                touched = (
+                    session.idmap.get_clean_row_keys() if HOT_KEYS.tracking else ()
+                )
                 await session.commit()
+                self.row_cache.store(idmap)
+                HOT_KEYS.record(sys_name, touched, conflict=False)
                 # logger.debug(f"✅ [📞System] 调用System成功: {sys_name}")
                 return rtn
-            except RaceCondition:
+            except RaceCondition as e:
                 context.race_count += 1
+                SLOW_LOG.log_race(sys_name, e)
+                # 用到的缓存行可能已过期，重试时从数据库重新读取
+                self.row_cache.invalidate_hits(idmap)
+                # 知道具体冲突的行时只统计该行，否则统计所有读过的行。
+                # UNIQ冲突的key是索引key，提交成功时不会统计到它，冲突率会一直是100%，不能用
+                HOT_KEYS.record(
+                    sys_name,
+                    [e.key]
+                    if e.key and e.check != "UNIQ"
+                    else session.idmap.get_clean_row_keys(),
+                    conflict=True,
+                )
+                lease.release()  # 不要持有锁sleep
                 # 重试时sleep一段时间，可降低再次冲突率约90%。
                 # delay增加会降低冲突率，但也会增加rtt波动。除1:-94%, 2:-91%, 5: -87%, 10: -85%
                 delay = random.random() / 5
-                replay.info(f"[RaceCondition][{sys_name}]{delay:.3f}s retry")
+                replay.info(
+                    f"[RaceCondition][{sys_name}][{e.check}:{e.key}]{delay:.3f}s retry"
+                )
                 logger.debug(
                     _(
                         "🔄 [📞System] 调用System遇到竞态: {sys_name}，{delay}秒后重试"
@@ -141,6 +170,7 @@ class SystemCaller:
                 # err_msg = f"嵌套系统调用异常，调用：{sys_name}{args}，异常：{type(e).__name__}:{e}"
                 raise
             finally:
+                lease.release()
                 # 上面如果执行过commit了，那么这句也无害
                 session.discard()
                 # 记录时间和重试次数到内存
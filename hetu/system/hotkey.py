@@ -0,0 +1,192 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2024, Heerozh. All rights reserved.
+@license: Apache2.0 可用作商业项目，再随便找个角落提及用到了此项目 :D
+@email: heeroz@gmail.com
+"""
+
+import asyncio
+import time
+from collections.abc import Iterable
+from contextvars import ContextVar, Token
+
+# 行的事务冲突率超过此值，就把涉及该行的System调用改为本worker内FIFO排队执行。0为关闭
+HOT_KEY_CONFLICT_RATE = 0.3
+# 冲突次数（衰减后）至少达到此值才会判定为热点，防止偶发冲突误判
+HOT_KEY_MIN_CONFLICTS = 5
+# 统计数据的半衰期（秒），冲突停止后，热点大约在 1~2 个半衰期后自动退回乐观并发
+HOT_KEY_HALF_LIFE = 5.0
+# 清理过期统计的间隔（秒）
+_PRUNE_INTERVAL = 1.0
+
+# 当前协程已持有的热点行锁，防止嵌套调用同一行时自己锁死自己
+_held_keys: ContextVar[frozenset[str]] = ContextVar("_held_keys", default=frozenset())
+
+
+class _KeyStat:
+    """单行的冲突统计，计数按半衰期指数衰减"""
+
+    __slots__ = ("commits", "conflicts", "hot", "stamp")
+
+    def __init__(self, now: float):
+        self.conflicts = 0.0
+        self.commits = 0.0
+        self.stamp = now
+        self.hot = False
+
+    def decay(self, now: float) -> None:
+        factor = 0.5 ** ((now - self.stamp) / HOT_KEY_HALF_LIFE)
+        self.conflicts *= factor
+        self.commits *= factor
+        self.stamp = now
+        self._update_hot()
+
+    def add(self, now: float, conflict: bool) -> None:
+        self.decay(now)
+        if conflict:
+            self.conflicts += 1
+        else:
+            self.commits += 1
+        self._update_hot()
+
+    def _update_hot(self) -> None:
+        # 有滞后区间：进入热点要冲突率达标，退出只看冲突数回落到一半以下。
+        # 串行化后本地冲突消失、提交数上升，如果用冲突率判定退出会来回震荡。
+        if self.hot:
+            self.hot = self.conflicts >= HOT_KEY_MIN_CONFLICTS / 2
+        elif self.conflicts >= HOT_KEY_MIN_CONFLICTS:
+            total = self.conflicts + self.commits
+            self.hot = self.conflicts / total >= HOT_KEY_CONFLICT_RATE
+
+
+class HotKeyGate:
+    """
+    热点行本地串行化。每个worker进程一个，由所有连接的 `SystemCaller` 共享。
+
+    按行key统计事务冲突率，冲突率超过 `HOT_KEY_CONFLICT_RATE` 的行视为热点行。
+    之后System调用前，如果该System之前冲突过的行中有热点行，就先按FIFO排队获取该行的锁，
+    让这些调用在本worker内逐个执行，避免大量乐观重试；冲突下降后自动恢复乐观并发。
+
+    调用前无法知道System会读写哪些行，所以以“该System上次冲突时读过的行”作为预测。
+    """
+
+    def __init__(self):
+        self._stats: dict[str, _KeyStat] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        # {system_name: {hot_key, ...}} 各System冲突过的热点行
+        self._sys_keys: dict[str, set[str]] = {}
+        self._last_prune = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return HOT_KEY_CONFLICT_RATE > 0
+
+    @property
+    def tracking(self) -> bool:
+        """是否有正在统计的行，没有的话提交成功时不需要收集行key"""
+        return bool(self._stats)
+
+    def clear(self) -> None:
+        self._stats.clear()
+        self._locks.clear()
+        self._sys_keys.clear()
+
+    def is_hot(self, key: str) -> bool:
+        stat = self._stats.get(key)
+        return stat is not None and stat.hot
+
+    def record(self, sys_name: str, keys: Iterable[str], conflict: bool) -> None:
+        """
+        记录一次System调用的结果。
+        冲突时统计所有读过的行；成功时只更新已在统计中的行，不增加新行。
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        stats = self._stats
+        for key in keys:
+            stat = stats.get(key)
+            if stat is None:
+                if not conflict:
+                    continue
+                stat = stats[key] = _KeyStat(now)
+            stat.add(now, conflict)
+            if stat.hot:
+                self._sys_keys.setdefault(sys_name, set()).add(key)
+        if now - self._last_prune > _PRUNE_INTERVAL:
+            self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        """衰减所有统计，删除冷却的行和锁"""
+        self._last_prune = now
+        cold = []
+        for key, stat in self._stats.items():
+            stat.decay(now)
+            if stat.conflicts < 0.1:
+                cold.append(key)
+        for key in cold:
+            del self._stats[key]
+        for key, lock in list(self._locks.items()):
+            # release()把锁交给等待者后，等待者运行前locked()为False，还要检查有无等待者，
+            # 否则之后会为同一行新建一把锁，两个调用同时持有
+            if not self.is_hot(key) and not lock.locked() and not lock._waiters:
+                del self._locks[key]
+        for sys_name, keys in list(self._sys_keys.items()):
+            if hot := {k for k in keys if self.is_hot(k)}:
+                self._sys_keys[sys_name] = hot
+            else:
+                del self._sys_keys[sys_name]
+
+    def hot_keys(self, sys_name: str) -> list[str]:
+        """
+        返回该System需要排队的热点行，已排序，按顺序加锁防止死锁。
+        嵌套调用时，当前协程已持有锁，只返回排在已持有的行之后的行，保证全局的加锁顺序一致，
+        排在前面的行不排队，退回乐观并发
+        """
+        keys = self._sys_keys.get(sys_name)
+        if not keys:
+            return []
+        held = _held_keys.get()
+        floor = max(held) if held else ""
+        return sorted(k for k in keys if k > floor and self.is_hot(k))
+
+    async def acquire(self, sys_name: str) -> HotKeyLease:
+        """
+        按FIFO排队获取该System的热点行锁，返回的 `HotKeyLease` 需调用 `release` 释放。
+        没有热点行时立即返回。
+        """
+        lease = HotKeyLease()
+        if not self.enabled or not self._sys_keys:
+            return lease
+        keys = self.hot_keys(sys_name)
+        if not keys:
+            return lease
+        try:
+            for key in keys:
+                if (lock := self._locks.get(key)) is None:
+                    lock = self._locks[key] = asyncio.Lock()
+                await lock.acquire()
+                lease.locks.append(lock)
+        except BaseException:
+            lease.release()
+            raise
+        lease.token = _held_keys.set(_held_keys.get() | set(keys))
+        return lease
+
+
+class HotKeyLease:
+    """`HotKeyGate.acquire` 获取到的热点行锁"""
+
+    __slots__ = ("locks", "token")
+
+    def __init__(self):
+        self.locks: list[asyncio.Lock] = []
+        self.token: Token[frozenset[str]] | None = None
+
+    def release(self) -> None:
+        """释放所有锁，可重复调用"""
+        if self.token is not None:
+            _held_keys.reset(self.token)
+            self.token = None
+        while self.locks:
+            self.locks.pop().release()
@@ -0,0 +1,95 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2024, Heerozh. All rights reserved.
+@license: Apache2.0 可用作商业项目，再随便找个角落提及用到了此项目 :D
+@email: heeroz@gmail.com
+"""
+
+from collections import OrderedDict
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from ..data.backend.idmap import IdentityMap
+    from ..data.backend.table import TableReference
+
+# 每个连接缓存的最大行数，0为关闭
+CONNECTION_ROW_CACHE_SIZE = 0
+
+
+class ConnectionRowCache:
+    """
+    连接级的乐观行缓存。每个连接的 `SystemCaller` 持有一个。
+
+    同一玩家连续的System调用，往往反复读取相同的行（自己的角色、背包等）。
+    本缓存保存上次调用提交成功后这些行的值，下次调用的事务缓存未命中时直接使用，省去数据库读取。
+
+    缓存的行可能已被其他连接修改，但和正常读取的行一样，提交时会检查 `_version`，
+    过期则事务冲突，此时清除用到的缓存行，重试时从数据库重新读取。
+    订阅推送收到行变动时，也会清除对应的缓存行。
+
+    易失数据（`volatile`）的Component不缓存：它们可以被 `direct_set` 直接修改，
+    不增加 `_version`，过期的缓存行能通过版本检查，提交时会覆盖掉直接写入的值。
+    """
+
+    def __init__(self):
+        self._rows: OrderedDict[tuple[TableReference, int], np.record] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return CONNECTION_ROW_CACHE_SIZE > 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get(self, table_ref: TableReference, row_id: int) -> np.record | None:
+        """返回缓存行的副本，未命中返回None"""
+        key = (table_ref, row_id)
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        self._rows.move_to_end(key)
+        return row.copy()
+
+    def attach(self, idmap: IdentityMap) -> None:
+        """让事务缓存未命中时，先从本缓存取行"""
+        if self.enabled:
+            idmap.warm = self.get
+
+    def store(self, idmap: IdentityMap) -> None:
+        """事务提交成功后调用，用提交后的行值更新缓存"""
+        if not self.enabled:
+            if self._rows:
+                self._rows.clear()
+            return
+        rows, gone = idmap.get_committed_rows()
+        cache = self._rows
+        for table_ref, row_ids in gone.items():
+            for row_id in row_ids:
+                cache.pop((table_ref, row_id), None)
+        for table_ref, ref_rows in rows.items():
+            if table_ref.comp_cls.volatile_:
+                continue
+            for row in ref_rows:
+                key = (table_ref, int(row.id))
+                cache[key] = row
+                cache.move_to_end(key)
+        while len(cache) > CONNECTION_ROW_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    def invalidate(self, table_ref: TableReference, row_ids: Iterable[int]) -> None:
+        """清除指定的缓存行"""
+        if not self._rows:
+            return
+        for row_id in row_ids:
+            self._rows.pop((table_ref, int(row_id)), None)
+
+    def invalidate_hits(self, idmap: IdentityMap) -> None:
+        """事务冲突时调用，清除该事务用到的缓存行"""
+        for key in idmap.get_warm_hits():
+            self._rows.pop(key, None)
+
+    def clear(self) -> None:
+        self._rows.clear()
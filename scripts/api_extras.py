@@ -7,6 +7,7 @@ are the topic-group page they belong on (matching docs/api/<group>.md).
 EXTRAS: dict[str, str] = {
     "hetu.data.backend.base.RaceCondition": "exceptions",
     "hetu.data.backend.base.UniqueViolation": "exceptions",
+    "hetu.data.backend.base.BoundViolation": "exceptions",
     "hetu.data.backend.repo.SessionRepository": "system",
     "hetu.data.backend.table.TableReference": "system",
     "hetu.data.backend.table.Table": "system",
@@ -47,6 +47,21 @@ def def_rls_test():
     return RLSTest
 
 
+def def_position():
+    from hetu.data import define_component, property_field, BaseComponent
+    import numpy as np
+
+    global Position
+
+    @define_component(namespace="pytest", spatial=("x", "y", 10))
+    class Position(BaseComponent):
+        owner: np.int64 = property_field(0, unique=False, index=True)
+        x: np.float32 = property_field(0)
+        y: np.float32 = property_field(0)
+
+    return Position
+
+
 def create_ref(model, backend) -> TableReference:
     """定义测试用的Item组件模型，创建空表，返回模型引用类。"""
     # 创建空表
@@ -122,6 +137,12 @@ async def filled_item_ref(item_ref, mod_auto_backend):
     )
 
 
+@pytest.fixture(scope="function")
+async def pos_ref(new_component_env, mod_auto_backend) -> TableReference:
+    """定义开启空间索引的Position组件模型，创建空表，返回模型引用类"""
+    return create_ref(def_position(), mod_auto_backend())
+
+
 @pytest.fixture
 async def filled_rls_ref(rls_ref, mod_auto_backend):
     """填充RLS测试表格的数据，返回填充后的表格引用对象"""
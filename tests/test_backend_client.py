@@ -60,6 +60,7 @@ async def test_redis_commit_payload(mod_item_model, mod_rls_test_model):
     rls_ref = TableReference(mod_rls_test_model, "pytest", 1)
     client = RedisBackendClient.__new__(RedisBackendClient)
     client.is_servant = False
+    client.dbi = 0
 
     # 建立测试数据
     idmap = IdentityMap()
@@ -334,6 +335,26 @@ async def test_redis_commit_payload(mod_item_model, mod_rls_test_model):
         + [b"\x80\x00\x00\x00\x00\x00\x00\x00\x00" + str(row.id).encode()]
     )
 
+    # 每个索引成员的变动，还要发布[旧成员, 新成员]到索引频道，新旧相同的不发布
+    changes = {}
+    for cmd in pushes:
+        if cmd[0] in ("ZADD", "ZREM"):
+            member = cmd[-1]
+            change = changes.setdefault(
+                (cmd[1], member.rsplit(b"\x00", 1)[-1]), [b"", b""]
+            )
+            change[cmd[0] == "ZADD"] = member
+    for (idx_key, _row_id), (old, new) in changes.items():
+        if old != new:
+            message = msgpack.packb([old, new], use_bin_type=False)
+            pushes.append(["PUBLISH", f"__index@0__:{idx_key}", message])
+    # update 1的time从20变为23
+    assert any(
+        old.startswith(b"\x80\x00\x00\x00\x00\x00\x00\x14\x00")
+        and new.startswith(b"\x80\x00\x00\x00\x00\x00\x00\x17\x00")
+        for old, new in changes.values()
+    )
+
     # commit
     json = []
 
@@ -366,6 +387,234 @@ async def test_redis_commit_payload(mod_item_model, mod_rls_test_model):
         assert push in json[1]
 
 
+async def test_redis_commit_race_diagnostics(mod_item_model):
+    """lua提交失败时，RaceCondition应带有冲突key和检查类型"""
+    from hetu.data.backend import BoundViolation, RaceCondition
+
+    item_ref = TableReference(mod_item_model, "pytest", 1)
+    client = RedisBackendClient.__new__(RedisBackendClient)
+    client.is_servant = False
+    client.dbi = 0
+    resp = []
+
+    async def mock_lua_commit(keys, payload_json):
+        return resp
+
+    client.lua_commit = mock_lua_commit
+
+    def make_idmap():
+        idmap = IdentityMap()
+        row = item_ref.comp_cls.new_row()
+        row.owner = 10
+        row.name = "diag"
+        idmap.add_insert(item_ref, row)
+        return idmap
+
+    key = "pytest:Item:{CLU1}:id:1"
+    resp = [b"RACE", b"VER", key.encode(), b"1", b"2"]
+    with pytest.raises(RaceCondition, match="Version mismatch") as exc_info:
+        await client.commit(make_idmap())
+    exc = exc_info.value
+    assert (exc.key, exc.check, exc.expected, exc.actual) == (key, "VER", "1", "2")
+
+    resp = [b"RACE", b"NX", key.encode(), b"", b""]
+    with pytest.raises(RaceCondition) as exc_info:
+        await client.commit(make_idmap())
+    exc = exc_info.value
+    assert (exc.key, exc.check, exc.expected, exc.actual) == (key, "NX", None, None)
+
+    idx_key = "pytest:Item:{CLU1}:index:name"
+    resp = [b"UNIQUE", b"UNIQ", idx_key.encode(), b"", b"123"]
+    with pytest.raises(RaceCondition, match="UNIQUE") as exc_info:
+        await client.commit(make_idmap())
+    assert exc_info.value.key == idx_key
+    assert exc_info.value.check == "UNIQ"
+    assert exc_info.value.actual == "123"
+
+    resp = [b"BOUND", b"BOUND", (key + ":qty").encode(), b"[0, ]", b"-1"]
+    with pytest.raises(BoundViolation, match="qty"):
+        await client.commit(make_idmap())
+
+    resp = b"unknown"
+    with pytest.raises(RuntimeError):
+        await client.commit(make_idmap())
+
+
+async def test_redis_commit_row_payload(mod_item_model, monkeypatch):
+    """开启ROW_CHANGE_PAYLOAD时，提交要把提交后的行发布到行频道"""
+    item_ref = TableReference(mod_item_model, "pytest", 1)
+    client = RedisBackendClient.__new__(RedisBackendClient)
+    client.is_servant = False
+    client.dbi = 0
+    monkeypatch.setattr(RedisBackendClient, "ROW_CHANGE_PAYLOAD", True)
+
+    idmap = IdentityMap()
+    rows = item_ref.comp_cls.new_rows(2)
+    rows.id = [1, 2]
+    rows.owner = [10, 20]
+    rows.name = ["a", "b"]
+    rows._version = [3, 7]
+    idmap.add_clean(item_ref, rows)
+    row, _ = idmap.get(item_ref, 1)
+    row = row.copy()
+    row.qty = 5
+    idmap.update(item_ref, row)
+    idmap.mark_deleted(item_ref, 2)
+    idmap.add_delta(item_ref, 3, "qty", 1, None, None)
+
+    json = []
+
+    async def mock_lua_commit(keys, payload_json):
+        nonlocal json
+        json = msgpack.unpackb(payload_json[0], raw=True)
+        return b"committed"
+
+    client.lua_commit = mock_lua_commit
+    await client.commit(idmap)
+
+    key = "pytest:Item:{CLU1}:id:"
+    assert client.row_channel(item_ref, 1) == "__row@0__:" + key + "1"
+    published = {cmd[1].decode(): cmd[2] for cmd in json[1] if cmd[0] == b"PUBLISH"}
+    # 修改的行发布整行，版本+1
+    image = client.parse_row_change(item_ref, published["__row@0__:" + key + "1"])
+    assert image is not None
+    assert (image["qty"], image["name"], image["_version"]) == (5, "a", 4)
+    # 删除的行发布空内容
+    assert (
+        client.parse_row_change(item_ref, published["__row@0__:" + key + "2"]) is None
+    )
+    # 原子增量的行由lua脚本读取后发布
+    assert json[1][-1] == [
+        b"ROWPUB",
+        (key + "3").encode(),
+        (f"__row@0__:{key}3").encode(),
+        b"PUBLISH",
+    ]
+
+
+async def test_redis_direct_set_row_payload(mod_rls_test_model, monkeypatch):
+    """开启ROW_CHANGE_PAYLOAD时，direct_set也要把写入后的行发布到行频道"""
+    rls_ref = TableReference(mod_rls_test_model, "pytest", 1)
+    client = RedisBackendClient.__new__(RedisBackendClient)
+    client.is_servant = False
+    client.dbi = 0
+    client.change_log_maxlen = 100
+    monkeypatch.setattr(RedisBackendClient, "ROW_CHANGE_PAYLOAD", True)
+
+    calls = []
+
+    async def mock_lua_commit(keys, payload_json):
+        calls.append((keys, msgpack.unpackb(payload_json[0], raw=True)))
+        return b"committed"
+
+    client.lua_commit = mock_lua_commit
+    await client.direct_set(rls_ref, 5, friend="9")
+
+    key = "pytest:RLSTest:{CLU1}:id:5"
+    channel = client.row_channel(rls_ref, 5)
+    assert channel == "__row@0__:" + key
+    [(keys, (checks, pushes, _deleted))] = calls
+    assert keys == [key] and checks == []
+    assert pushes[0] == [b"HSET", key.encode(), b"friend", b"9"]
+    assert pushes[1] == [b"ROWPUB", key.encode(), channel.encode(), b"PUBLISH"]
+    # 变动日志也要记录，断线恢复后补发
+    assert pushes[2][0] == b"XADD"
+    assert msgpack.unpackb(pushes[2][-1]) == [channel]
+
+
+async def test_redis_commit_sharded_publish(mod_item_model):
+    """集群模式下，提交时的频道都用SPUBLISH发布，频道和key在同一个slot"""
+    from redis.crc import key_slot
+
+    item_ref = TableReference(mod_item_model, "pytest", 1)
+    client = RedisBackendClient.__new__(RedisBackendClient)
+    client.is_servant = False
+    client.dbi = 0
+    client.raw_clustering = True
+
+    idmap = IdentityMap()
+    row = item_ref.comp_cls.new_row()
+    row.id = 1
+    row._version = 1
+    idmap.add_clean(item_ref, row)
+    row = row.copy()
+    row.owner = 5
+    idmap.update(item_ref, row)
+    idmap.add_delta(item_ref, 2, "owner", 1, None, None)
+
+    json = []
+    keys = []
+
+    async def mock_lua_commit(_keys, payload_json):
+        nonlocal json, keys
+        json = msgpack.unpackb(payload_json[0], raw=True)
+        keys = _keys
+        return b"committed"
+
+    client.lua_commit = mock_lua_commit
+    await client.commit(idmap)
+
+    commands = {cmd[0] for cmd in json[1]}
+    assert b"SPUBLISH" in commands and b"PUBLISH" not in commands
+    incr = [cmd for cmd in json[1] if cmd[0] == b"INCR"]
+    assert incr[0][-1] == b"SPUBLISH"
+    channel = client.index_channel(item_ref, "owner")
+    assert incr[0][-2] == channel.encode()
+    assert client.is_change_channel_(channel)
+    assert not client.is_change_channel_(client.row_channel(item_ref, 1))
+    assert key_slot(channel.encode()) == key_slot(keys[0].encode())
+
+
+async def test_redis_commit_change_log(mod_item_model):
+    """开启变动日志时，提交要把变动的频道写入变动日志"""
+    item_ref = TableReference(mod_item_model, "pytest", 1)
+    client = RedisBackendClient.__new__(RedisBackendClient)
+    client.is_servant = False
+    client.dbi = 0
+    client.change_log_maxlen = 1000
+
+    idmap = IdentityMap()
+    row = item_ref.comp_cls.new_row()
+    row.id = 1
+    row._version = 1
+    idmap.add_clean(item_ref, row)
+    row = row.copy()
+    row.owner = 5
+    idmap.update(item_ref, row)
+    idmap.add_delta(item_ref, 2, "qty", 1, None, None)
+
+    json = []
+
+    async def mock_lua_commit(keys, payload_json):
+        nonlocal json
+        json = msgpack.unpackb(payload_json[0], raw=True)
+        return b"committed"
+
+    client.lua_commit = mock_lua_commit
+    await client.commit(idmap)
+
+    xadd = [arg.decode() for arg in json[1][-1][:-1]]
+    assert xadd == ["XADD", "pytest:changelog:{CLU1}", "MAXLEN", "~", "1000", "*", "ch"]
+    channels = msgpack.unpackb(json[1][-1][-1], raw=False)
+    assert client.change_log_key_of_(channels[0]) == client.change_log_key(item_ref)
+    assert sorted(channels) == sorted(
+        [
+            client.row_channel(item_ref, 1),
+            client.row_channel(item_ref, 2),
+            client.index_channel(item_ref, "owner"),
+        ]
+    )
+
+    # 只读事务（只有版本检查）不写入变动日志
+    idmap = IdentityMap()
+    row = item_ref.comp_cls.new_row()
+    row.id = 1
+    row._version = 2
+    idmap.add_clean(item_ref, row)
+    await client.commit(idmap)
+    assert json[0] and not json[1]
+
+
 async def test_insert(item_ref, rls_ref, mod_auto_backend):
     """测试client的commit(insert)/get"""
     # 启动backend
@@ -36,6 +36,37 @@ def test_add_clean_and_get(mod_item_model):
         id_map.add_clean(item_ref, row)
 
 
+def test_snapshot_rows(mod_item_model):
+    """测试快照读的行不参与提交时的版本检查"""
+    Item = mod_item_model
+    item_ref = TableReference(Item, "TestServer", 1)
+
+    id_map = IdentityMap()
+    rows = Item.new_rows(3)
+    rows.id = [100, 101, 102]
+    rows.name = ["a", "b", "c"]
+    id_map.add_clean(item_ref, rows[:2], validate=False)
+    id_map.add_clean(item_ref, rows[2])
+
+    assert id_map.is_snapshot(item_ref, 100)
+    assert not id_map.is_snapshot(item_ref, 102)
+    assert set(id_map.get_clean_rows()[item_ref]) == {102}
+    assert id_map.get_clean_row_keys() == {"TestServer:Item:{CLU1}:id:102"}
+
+    # 重新正常读取后，恢复版本检查
+    id_map.validate(item_ref, 100)
+    assert set(id_map.get_clean_rows()[item_ref]) == {100, 102}
+
+    # 修改过的行总是检查版本
+    row, _ = id_map.get(item_ref, 101)
+    assert row is not None
+    row = row.copy()
+    row.owner = 9
+    id_map.update(item_ref, row)
+    assert not id_map.is_snapshot(item_ref, 101)
+    assert "TestServer:Item:{CLU1}:id:101" in id_map.get_clean_row_keys()
+
+
 def test_add_wrong_component(mod_item_model, mod_rls_test_model):
     """测试添加错误组件类型报错"""
     item_ref = TableReference(mod_item_model, "TestServer", 1)
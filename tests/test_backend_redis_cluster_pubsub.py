@@ -5,6 +5,7 @@
 @email: heeroz@gmail.com
 """
 
+import asyncio
 from typing import cast
 
 import pytest
@@ -35,3 +36,233 @@ async def test_backend_redis_pubsub(mod_auto_backend):
     msg2 = await pubsub.get_message()
     assert msg1["data"] == b"1"
     assert msg2["data"] == b"2"
+
+
+class FakeKeyspacePubSub:
+    """代替AsyncKeyspacePubSub，记录向Redis发出的订阅"""
+
+    def __init__(self, client, change_log_of=None, is_sharded=None):
+        self.subscribes = []
+        self.unsubscribes = []
+        self.batches = []
+        self.queue = asyncio.Queue()
+
+    async def subscribe_many(self, channels):
+        await asyncio.sleep(0.01)
+        self.batches.append(list(channels))
+        self.subscribes.extend(channels)
+
+    async def unsubscribe_many(self, channels):
+        self.unsubscribes.extend(channels)
+
+    async def get_message(self):
+        return await self.queue.get()
+
+    async def close(self):
+        pass
+
+    def publish(self, channel):
+        self.queue.put_nowait({"channel": channel.encode(), "data": b"hset"})
+
+
+async def test_pubsub_multiplexer(monkeypatch):
+    """测试worker共享pubsub的频道引用计数和消息分发"""
+    from hetu.data.backend.redis import pubsub
+
+    monkeypatch.setattr(pubsub, "AsyncKeyspacePubSub", FakeKeyspacePubSub)
+    mux = pubsub.PubSubMultiplexer(None)  # type: ignore
+    fake = cast(FakeKeyspacePubSub, mux._pubsub)
+    conn1 = mux.handle()
+    conn2 = mux.handle()
+
+    # 同时订阅同一频道，只向Redis订阅一次，且都等到订阅完成
+    await asyncio.gather(conn1.subscribe("row{1}"), conn2.subscribe("row{1}"))
+    await conn2.subscribe("row{2}")
+    assert fake.subscribes == ["row{1}", "row{2}"]
+    assert conn1.subscribed == {"row{1}"}
+    assert mux.channels == {"row{1}", "row{2}"}
+
+    # 消息只分发给订阅了该频道的连接
+    fake.publish("row{1}")
+    fake.publish("row{2}")
+    assert (await conn1.get_message())["channel"] == b"row{1}"
+    assert (await conn2.get_message())["channel"] == b"row{1}"
+    assert (await conn2.get_message())["channel"] == b"row{2}"
+    assert conn1.message_queue.empty()
+
+    # 还有其他连接订阅时，不向Redis取消订阅
+    await conn1.unsubscribe("row{1}")
+    assert fake.unsubscribes == []
+    fake.publish("row{1}")
+    assert (await conn2.get_message())["channel"] == b"row{1}"
+    assert conn1.message_queue.empty()
+
+    # 最后一个连接关闭时才取消
+    await conn2.close()
+    assert sorted(fake.unsubscribes) == ["row{1}", "row{2}"]
+    assert mux.channels == set()
+
+    # 等待订阅时连接被取消，订阅完成后自动向Redis取消
+    task = asyncio.create_task(conn1.subscribe("row{3}"))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert conn1.subscribed == set()
+    await asyncio.sleep(0.05)
+    assert fake.unsubscribes[-1] == "row{3}"
+    assert mux.channels == set()
+
+    # 批量订阅只向Redis发一次命令，已订阅的频道不重复订阅
+    fake.batches.clear()
+    await conn1.subscribe("row{4}")
+    await conn2.subscribe_many(["row{4}", "row{5}", "row{6}"])
+    assert fake.batches == [["row{4}"], ["row{5}", "row{6}"]]
+    assert conn2.subscribed == {"row{4}", "row{5}", "row{6}"}
+    await conn2.unsubscribe_many(["row{4}", "row{5}"])
+    assert fake.unsubscribes[-1:] == ["row{5}"]
+    assert mux.channels == {"row{4}", "row{6}"}
+
+    await mux.close()
+
+
+@use_redis_family_backend_only
+@pytest.mark.timeout(30)
+async def test_mq_clients_share_pubsub(mod_auto_backend):
+    """同一worker的MQ客户端共用一个pubsub连接"""
+    backend = mod_auto_backend()
+    client: RedisBackendClient = cast(RedisBackendClient, backend.master)
+
+    mq1 = client.get_mq_client()
+    mq2 = client.get_mq_client()
+    assert mq1._mq._mux is mq2._mq._mux
+
+    await mq1.subscribe("key{1}")
+    await mq2.subscribe("key{1}")
+    client.io.publish("key{1}", b"1")
+    await asyncio.wait_for(mq1.pull(), 5)
+    await asyncio.wait_for(mq2.pull(), 5)
+    assert mq1.pulled_set == {"key{1}"}
+    assert mq2.pulled_set == {"key{1}"}
+
+    await mq1.close()
+    assert client.pubsub_mux().channels == {"key{1}"}
+    await mq2.close()
+    assert client.pubsub_mux().channels == set()
+
+
+class FakeStreamClient:
+    """只实现变动日志用到的stream命令"""
+
+    def __init__(self):
+        self.entries: list[tuple[bytes, dict]] = []
+        self.max_deleted = b"0-0"
+        self.seq = 0
+
+    def add(self, *channels):
+        import msgpack
+
+        self.seq += 1
+        entry_id = f"{self.seq}-0".encode()
+        self.entries.append((entry_id, {b"ch": msgpack.packb(list(channels))}))
+
+    def trim(self):
+        self.max_deleted = self.entries[-1][0]
+        self.entries.clear()
+
+    async def xrevrange(self, name, count=None):
+        return self.entries[::-1][:count]
+
+    async def xinfo_stream(self, name):
+        return {"max-deleted-entry-id": self.max_deleted}
+
+    async def xrange(self, name, min=b"-", count=None):
+        start = int(min.lstrip(b"(").split(b"-")[0]) if min != b"-" else 0
+        return [e for e in self.entries if int(e[0].split(b"-")[0]) > start][:count]
+
+
+async def test_pubsub_change_log_replay():
+    """测试断线恢复后从变动日志补发检查点之后的消息"""
+    from hetu.data.backend.redis.pubsub import AsyncKeyspacePubSub
+
+    stream = FakeStreamClient()
+    pubsub = AsyncKeyspacePubSub(stream, lambda channel: "log")  # type: ignore
+    pubsub._subscribed.update({"row{1}", "row{2}", "row{3}"})
+
+    async def replayed():
+        await pubsub.replay_change_logs()
+        rtn = set()
+        while not pubsub.message_queue.empty():
+            msg = pubsub.message_queue.get_nowait()
+            assert msg["data"] is None
+            rtn.add(msg["channel"].decode())
+        return rtn
+
+    # 没有检查点，全部补发
+    assert await replayed() == {"row{1}", "row{2}", "row{3}"}
+
+    stream.add("row{1}")
+    await pubsub.checkpoint()
+    stream.add("row{2}", "idx{9}")
+    await pubsub.checkpoint()
+    stream.add("row{3}")
+    # 从上上次检查点开始补发，只补发订阅了的频道
+    assert await replayed() == {"row{2}", "row{3}"}
+    # 补发后检查点推进到日志末尾
+    assert await replayed() == set()
+
+    # 检查点之后的日志被淘汰了，全部补发
+    stream.add("row{1}")
+    stream.trim()
+    assert await replayed() == {"row{1}", "row{2}", "row{3}"}
+
+
+async def test_sharded_pubsub():
+    """测试分片频道的订阅，断线重连后按slot重新订阅"""
+    from redis.asyncio import ConnectionPool
+
+    from hetu.data.backend.redis.pubsub import ShardedPubSub
+
+    ps = ShardedPubSub(ConnectionPool())
+    sent = []
+
+    async def execute_command(*args):
+        sent.append(args)
+
+    ps.execute_command = execute_command  # type: ignore
+    assert not ps.subscribed
+    await ps.ssubscribe("row{1}", "idx{1}")
+    await ps.ssubscribe("row{2}")
+    assert ps.subscribed
+
+    # 重连时每个slot一条SSUBSCRIBE
+    sent.clear()
+    await ps.on_connect(None)  # type: ignore
+    assert sorted((cmd[0], sorted(cmd[1:])) for cmd in sent) == [
+        ("SSUBSCRIBE", ["idx{1}", "row{1}"]),
+        ("SSUBSCRIBE", ["row{2}"]),
+    ]
+
+    await ps.sunsubscribe("row{1}", "idx{1}")
+    await ps.sunsubscribe("row{2}")
+    assert sent[-1] == ("SUNSUBSCRIBE", "row{2}")
+    assert not ps.subscribed
+
+
+async def test_cluster_node_pubsub_args():
+    """测试集群节点的ShardedPubSub和Redis.pubsub()参数一致，共用client的event_dispatcher"""
+    from redis.asyncio.cluster import ClusterNode
+
+    from hetu.data.backend.redis.pubsub import AsyncKeyspacePubSub
+
+    pubsub = AsyncKeyspacePubSub(FakeStreamClient())  # type: ignore
+    pubsub.cluster_connect(ClusterNode("127.0.0.1", 1))
+    node = pubsub.node_resources["127.0.0.1:1"]
+    try:
+        expected = node["client"].pubsub()
+        assert node["pubsub"]._event_dispatcher is expected._event_dispatcher
+        assert node["pubsub"].connection_pool is expected.connection_pool
+    finally:
+        for task in pubsub._tasks:
+            task.cancel()
+        await asyncio.gather(*pubsub._tasks, return_exceptions=True)
@@ -570,6 +570,57 @@ async def test_unique_table(new_component_env, mod_auto_backend):
         assert result.id[0] == last_row_id
 
 
+async def test_range_box(pos_ref, mod_auto_backend):
+    """测试空间索引的自动维护和框选查询"""
+    backend: Backend = mod_auto_backend()
+    grid = pos_ref.comp_cls.spatial_
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(pos_ref.comp_cls)
+        for i, (x, y) in enumerate([(1, 1), (12, 3), (25, 25), (-3, 8), (9, 19)]):
+            row = pos_ref.comp_cls.new_row()
+            row.owner = i
+            row.x, row.y = x, y
+            await repo.insert(row)
+        with pytest.raises(ValueError, match="increment"):
+            repo.increment(row.id, "x", 1)
+    await backend.wait_for_synced()
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(pos_ref.comp_cls)
+        rows = await repo.range_box(-5, -5, 15, 15)
+        assert sorted(rows.owner) == [0, 1, 3]
+        assert rows[rows.owner == 1]._cell[0] == grid.cell_of(12, 3)
+        assert len(await repo.range_box(-5, -5, 15, 15, limit=2)) == 2
+
+        # 移动后格子跟着更新
+        row = (await repo.range_box(0, 0, 2, 2))[0]
+        row.x, row.y = 24, 24
+        await repo.update(row)
+    await backend.wait_for_synced()
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(pos_ref.comp_cls)
+        assert sorted((await repo.range_box(20, 20, 30, 30)).owner) == [0, 2]
+        assert len(await repo.range_box(0, 0, 2, 2)) == 0
+
+        # 同格子内矩形外的行超过limit，也不影响矩形内的行
+        for i in range(3):
+            row = pos_ref.comp_cls.new_row()
+            row.owner = 10 + i
+            row.x, row.y = 8, 8
+            await repo.insert(row)
+        row = pos_ref.comp_cls.new_row()
+        row.owner = 20
+        row.x, row.y = 1, 1
+        await repo.insert(row)
+    await backend.wait_for_synced()
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(pos_ref.comp_cls)
+        assert (await repo.range_box(0, 0, 2, 2, limit=2)).owner.tolist() == [20]
+
+
 async def test_upsert_limit(mod_item_model):
     """测试upsert不能用于非unique字段"""
     backend = Backend.__new__(Backend)
@@ -735,3 +786,93 @@ async def test_session_insert_then_upsert(item_ref, mod_auto_backend):
             assert upserted_row.id == row.id
             assert upserted_row.time == 1
             assert context.insert is False
+
+
+async def test_increment(item_ref, mod_auto_backend):
+    """测试原子增量操作，包括索引更新和边界检查"""
+    from hetu.data.backend import BoundViolation
+
+    backend: Backend = mod_auto_backend()
+
+    async with backend.session("pytest", 1) as session:
+        item_repo = session.using(item_ref.comp_cls)
+        row = item_ref.comp_cls.new_row()
+        row.owner = 10
+        row.name = "Counter"
+        row.time = 1
+        row.qty = 1
+        await item_repo.insert(row)
+        row_id = int(row.id)
+
+    # 不读取直接增量，包括索引字段
+    async with backend.session("pytest", 1) as session:
+        item_repo = session.using(item_ref.comp_cls)
+        item_repo.increment(row_id, "qty", 5)
+        item_repo.increment(row_id, "qty", 3, max=100)
+        item_repo.increment(row_id, "owner", -3)
+
+    async with backend.session("pytest", 1) as session:
+        session.only_master = True
+        item_repo = session.using(item_ref.comp_cls)
+        row = await item_repo.get(id=row_id)
+        assert row.qty == 9
+        assert row.owner == 7
+        assert row._version == 2
+        # 索引已更新
+        assert len(await item_repo.range(owner=(10, 10))) == 0
+        rows = await item_repo.range(owner=(7, 7))
+        assert len(rows) == 1 and rows[0].id == row_id
+
+    # 超出边界，整个事务都不应写入
+    with pytest.raises(BoundViolation):
+        async with backend.session("pytest", 1) as session:
+            item_repo = session.using(item_ref.comp_cls)
+            item_repo.increment(row_id, "owner", 1)
+            item_repo.increment(row_id, "qty", -10, min=0)
+    # 超出字段类型的范围(int16)
+    with pytest.raises(BoundViolation):
+        async with backend.session("pytest", 1) as session:
+            item_repo = session.using(item_ref.comp_cls)
+            item_repo.increment(row_id, "qty", 40000)
+
+    # 已读取的行，本地检查边界，并和之后的get保持一致
+    async with backend.session("pytest", 1) as session:
+        session.only_master = True
+        item_repo = session.using(item_ref.comp_cls)
+        row = await item_repo.get(id=row_id)
+        assert row.owner == 7
+        with pytest.raises(BoundViolation):
+            item_repo.increment(row_id, "qty", -10, min=0)
+        item_repo.increment(row_id, "qty", -9, min=0)
+        row = await item_repo.get(id=row_id)
+        assert row.qty == 0
+
+    # 先增量再读取，读到增量后的值
+    async with backend.session("pytest", 1) as session:
+        session.only_master = True
+        item_repo = session.using(item_ref.comp_cls)
+        item_repo.increment(row_id, "qty", 2)
+        row = await item_repo.get(id=row_id)
+        assert row.qty == 2
+
+    async with backend.session("pytest", 1) as session:
+        session.only_master = True
+        item_repo = session.using(item_ref.comp_cls)
+        row = await item_repo.get(id=row_id)
+        assert row.qty == 2
+
+        # 不支持的字段
+        with pytest.raises(ValueError, match="unique"):
+            item_repo.increment(row_id, "time", 1)
+        with pytest.raises(ValueError, match="float64"):
+            item_repo.increment(row_id + 1, "model", 1.0)
+        with pytest.raises(ValueError):
+            item_repo.increment(row_id, "qty", 1.5)
+
+    # 不存在的行
+    from hetu.data.backend import RaceCondition
+
+    with pytest.raises(RaceCondition):
+        async with backend.session("pytest", 1) as session:
+            item_repo = session.using(item_ref.comp_cls)
+            item_repo.increment(row_id + 1, "qty", 1)
@@ -80,6 +80,45 @@ async def test_version_race(item_ref, mod_auto_backend):
     await asyncio.gather(task1, task2)
 
 
+async def test_race_diagnostics(item_ref, mod_auto_backend):
+    import asyncio
+
+    from hetu.data.backend import RaceCondition
+
+    # 冲突异常应指明是哪一行、哪种检查失败
+    backend: Backend = mod_auto_backend()
+
+    async with backend.session("pytest", 1) as session:
+        item_repo = session.using(item_ref.comp_cls)
+        row = item_ref.comp_cls.new_row()
+        row.owner = 1
+        row.name = "Diag"
+        row.time = 233900
+        await item_repo.insert(row)
+        row_id = int(row.id)
+
+    await backend.wait_for_synced()
+
+    async def update_owner(sleep):
+        async with backend.session("pytest", 1) as _session:
+            _item_repo = _session.using(item_ref.comp_cls)
+            _row = await _item_repo.get(id=row_id)
+            assert _row
+            _row.owner = _row.owner + 1  # type: ignore
+            await asyncio.sleep(sleep)
+            await _item_repo.update(_row)
+
+    task1 = asyncio.create_task(update_owner(0.2))
+    task2 = asyncio.create_task(update_owner(0.01))
+    await task2
+    with pytest.raises(RaceCondition) as exc_info:
+        await task1
+    exc = exc_info.value
+    assert exc.key == backend.master.row_key(item_ref, row_id)
+    assert exc.check == "VER"
+    assert exc.expected == "1"
+
+
 async def test_stale_read_race(item_ref, mod_auto_backend):
     """
     测试陈旧读（stale read）场景：
@@ -146,6 +185,73 @@ async def test_stale_read_race(item_ref, mod_auto_backend):
         await task1
 
 
+async def test_snapshot_read_no_race(item_ref, mod_auto_backend):
+    """validate=False的快照读，提交时不检查版本，其他事务修改该行不会引起冲突"""
+    import asyncio
+
+    from hetu.data.backend import RaceCondition
+
+    backend: Backend = mod_auto_backend()
+
+    async with backend.session("pytest", 1) as session:
+        item_repo = session.using(item_ref.comp_cls)
+        row_a = item_ref.comp_cls.new_row()
+        row_a.owner = 1
+        row_a.name = "StaticA"
+        row_a.time = 200
+        row_a.qty = 1
+        await item_repo.insert(row_a)
+
+        row_b = item_ref.comp_cls.new_row()
+        row_b.id = SnowflakeID().next_id()
+        row_b.owner = 2
+        row_b.name = "WriteB"
+        row_b.time = 201
+        row_b.qty = 0
+        await item_repo.insert(row_b)
+
+    await backend.wait_for_synced()
+
+    async def copy_a_to_b(sleep, revalidate):
+        async with backend.session("pytest", 1) as _session:
+            _item_repo = _session.using(item_ref.comp_cls)
+            _a = await _item_repo.get(name="StaticA", validate=False)
+            assert _a is not None
+            if revalidate:
+                # 再次正常读取，恢复版本检查
+                assert await _item_repo.get(name="StaticA") is not None
+            await asyncio.sleep(sleep)
+            _b = await _item_repo.get(name="WriteB")
+            assert _b is not None
+            _b.qty = int(_a.qty)  # type: ignore
+            await _item_repo.update(_b)
+
+    async def modify_a(sleep):
+        async with backend.session("pytest", 1) as _session:
+            _item_repo = _session.using(item_ref.comp_cls)
+            _a = await _item_repo.get(name="StaticA")
+            assert _a is not None
+            await asyncio.sleep(sleep)
+            _a.qty = _a.qty + 1  # type: ignore
+            await _item_repo.update(_a)
+
+    task1 = asyncio.create_task(copy_a_to_b(0.2, False))
+    task2 = asyncio.create_task(modify_a(0.05))
+    await asyncio.gather(task1, task2)
+
+    async with backend.session("pytest", 1) as session:
+        item_repo = session.using(item_ref.comp_cls)
+        row_b = await item_repo.get(name="WriteB")
+        assert row_b is not None and row_b.qty == 1
+
+    # 快照读之后又正常读取的行，仍要检查版本
+    task1 = asyncio.create_task(copy_a_to_b(0.2, True))
+    task2 = asyncio.create_task(modify_a(0.05))
+    await task2
+    with pytest.raises(RaceCondition):
+        await task1
+
+
 async def test_unique_commit_race(item_ref, mod_auto_backend):
     """测试服务器端提交时，牵涉unique的竞态检查。"""
     import asyncio
@@ -299,3 +405,33 @@ async def test_retry_generator(item_ref, mod_auto_backend):
 
     print("test_retry_generator retry:", retry)
     assert retry > 4  # 应该有重试发生
+
+
+async def test_increment_no_race(item_ref, mod_auto_backend):
+    """测试并发的原子增量不会触发RaceCondition"""
+    import asyncio
+
+    backend: Backend = mod_auto_backend()
+
+    async with backend.session("pytest", 1) as session:
+        item_repo = session.using(item_ref.comp_cls)
+        row = item_ref.comp_cls.new_row()
+        row.name = "HotCounter"
+        row.qty = 0
+        await item_repo.insert(row)
+        row_id = int(row.id)
+
+    async def incr_task(sleep):
+        async with backend.session("pytest", 1) as _session:
+            _item_repo = _session.using(item_ref.comp_cls)
+            _item_repo.increment(row_id, "qty", 1)
+            await asyncio.sleep(sleep)
+
+    # 全部同时开始，交错提交，get+update方式下除了第一个都会竞态
+    await asyncio.gather(*[incr_task(0.01 * (i % 5)) for i in range(20)])
+
+    async with backend.session("pytest", 1) as session:
+        session.only_master = True
+        item_repo = session.using(item_ref.comp_cls)
+        row = await item_repo.get(id=row_id)
+        assert row.qty == 20
@@ -1,5 +1,6 @@
 import time
 from contextvars import ContextVar
+from types import SimpleNamespace
 from typing import AsyncGenerator, cast
 
 import pytest
@@ -252,6 +253,245 @@ async def test_subscribe_updates(
     assert len(broker._subs[sub_11_12].row_subs) == 1  # type: ignore
 
 
+def test_make_delta():
+    """测试差量推送只保留变化的属性"""
+    sub = RowSubscription.__new__(RowSubscription)
+    sub.remember_sent([{"id": 1, "x": 1.0, "name": "a"}])
+    # 未变化的行不推送，变化的只推送变化的属性
+    updates = {1: {"id": 1, "x": 1.0, "name": "a"}}
+    assert sub.make_delta(updates) == {}
+    assert sub.make_delta({1: {"id": 1, "x": 2.0, "name": "a"}}) == {1: {"x": 2.0}}
+    # 新的行发送整行，删除发送None
+    assert sub.make_delta({2: {"id": 2, "x": 0.0}, 1: None}) == {
+        2: {"id": 2, "x": 0.0},
+        1: None,
+    }
+    assert sub.make_delta({1: {"id": 1, "x": 2.0, "name": "a"}}) == {
+        1: {"id": 1, "x": 2.0, "name": "a"}
+    }
+
+
+async def test_subscribe_delta_updates(
+    broker: SubscriptionBroker,
+    filled_item_ref,
+    admin_ctx,
+    background_mq_puller_task,
+    monkeypatch,
+):
+    """测试开启差量推送后，行订阅和索引订阅都只推送变化的属性"""
+    monkeypatch.setattr(SubscriptionBroker, "DELTA_UPDATES", True)
+    backend = broker._backend
+
+    sub_row, _ = await broker.subscribe_get(filled_item_ref, admin_ctx, "name", "Itm10")
+    sub_10_11, _ = await broker.subscribe_range(
+        filled_item_ref, admin_ctx, "owner", 10, right=11, limit=44
+    )
+    sub_11_12, _ = await broker.subscribe_range(
+        filled_item_ref, admin_ctx, "owner", 11, right=12, limit=55
+    )
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(filled_item_ref.comp_cls)
+        row = await repo.get(time=110)
+        assert row
+        row.owner = 11
+        row_id = row.id
+        await repo.update(row)
+
+    updates = await broker.get_updates()
+    # 已有的行只推送变化的属性
+    assert updates[sub_row] == {row_id: {"owner": 11}}
+    assert updates[sub_10_11] == {row_id: {"owner": 11}}
+    # 新进入范围的行推送整行
+    assert updates[sub_11_12][row_id]["name"] == "Itm10"
+    assert updates[sub_11_12][row_id]["owner"] == 11
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(filled_item_ref.comp_cls)
+        row = await repo.get(id=row_id)
+        row.qty = 5
+        await repo.update(row)
+    updates = await broker.get_updates()
+    assert updates == {
+        sub_row: {row_id: {"qty": 5}},
+        sub_10_11: {row_id: {"qty": 5}},
+        sub_11_12: {row_id: {"qty": 5}},
+    }
+
+
+@use_redis_family_backend_only
+async def test_index_subscribe_incremental(
+    broker: SubscriptionBroker,
+    filled_item_ref,
+    admin_ctx,
+    background_mq_puller_task,
+    monkeypatch,
+):
+    """测试索引订阅用提交发布的索引变动增量更新，只有top-N边界受影响时才重新查询"""
+    backend = broker._backend
+    servant = backend.servant
+    queries = []
+    real_query = servant.range_index_members
+
+    async def range_index_members(*args, **kwargs):
+        queries.append(args)
+        return await real_query(*args, **kwargs)
+
+    monkeypatch.setattr(servant, "range_index_members", range_index_members)
+
+    # time最大的3行: 134, 133, 132
+    sub_top, rows = await broker.subscribe_range(
+        filled_item_ref, admin_ctx, "time", 0, 1000, limit=3, desc=True
+    )
+    assert sub_top
+    assert [row["time"] for row in rows] == [134, 133, 132]
+
+    async def set_time(old, new):
+        async with backend.session("pytest", 1) as session:
+            repo = session.using(filled_item_ref.comp_cls)
+            row = await repo.get(time=old)
+            assert row
+            if new is None:
+                await repo.delete(row.id)
+            else:
+                row.time = new
+                await repo.update(row)
+            return row.id
+
+    # 第一次变动要查询一次，取得索引成员值
+    row_id = await set_time(133, 233)
+    updates = await broker.get_updates()
+    assert updates[sub_top] == {row_id: updates[sub_top][row_id]}
+    assert updates[sub_top][row_id]["time"] == 233
+    assert len(queries) == 1
+
+    # 挤进top3，原边界行132被挤出，不需要重新查询
+    row_id = await set_time(110, 200)
+    updates = await broker.get_updates()
+    assert updates[sub_top][row_id]["time"] == 200
+    assert list(updates[sub_top].values()).count(None) == 1
+    assert len(queries) == 1
+
+    # top3外的变动，不需要重新查询
+    await set_time(120, 99)
+    updates = await broker.get_updates(timeout=0.5)
+    assert sub_top not in updates
+    assert len(queries) == 1
+
+    # top3的行被删除，空出位置，要重新查询补上
+    row_id = await set_time(233, None)
+    updates = await broker.get_updates()
+    assert updates[sub_top][row_id] is None
+    assert len(updates[sub_top]) == 2
+    assert len(queries) == 2
+
+    # 维护工具在事务外重建索引，发布空消息，订阅要重新查询
+    backend.master.get_table_maintenance().rebuild_index(filled_item_ref)
+    await broker.get_updates(timeout=0.5)
+    assert len(queries) == 3
+
+
+async def test_redis_mq_empty_payload():
+    """索引频道收到空消息（维护工具发布）时，不保存内容，订阅要重新查询"""
+    from hetu.data.backend import MQClient
+    from hetu.data.backend.redis.mq import RedisMQClient
+
+    channel = "__index@0__:pytest:Item:{CLU1}:index:time"
+    change = b"\x92\xa1a\xa1b"
+    messages = []
+
+    async def get_message():
+        return messages.pop(0)
+
+    mq = RedisMQClient.__new__(RedisMQClient)
+    MQClient.__init__(mq)
+    mq._mq = SimpleNamespace(get_message=get_message)  # type: ignore
+
+    messages.append({"channel": channel.encode(), "data": change})
+    await mq.pull()
+    assert mq.take_payloads([channel]) == {channel: [change]}
+
+    messages.append({"channel": channel.encode(), "data": change})
+    messages.append({"channel": channel.encode(), "data": b""})
+    await mq.pull()
+    await mq.pull()
+    assert mq.take_payloads([channel]) == {}
+
+
+@use_redis_family_backend_only
+async def test_row_subscribe_payload(
+    broker: SubscriptionBroker,
+    filled_item_ref,
+    admin_ctx,
+    background_mq_puller_task,
+    monkeypatch,
+):
+    """测试开启ROW_CHANGE_PAYLOAD后，行订阅直接使用提交发布的行内容，不再读取数据库"""
+    from hetu.data.backend import BackendClient
+
+    monkeypatch.setattr(BackendClient, "ROW_CHANGE_PAYLOAD", True)
+    backend = broker._backend
+    servant = backend.servant
+    reads = []
+    real_get = servant.get
+
+    async def get(*args, **kwargs):
+        reads.append(args)
+        return await real_get(*args, **kwargs)
+
+    sub_row, row = await broker.subscribe_get(
+        filled_item_ref, admin_ctx, "name", "Itm10"
+    )
+    assert sub_row and row
+    row_id = row["id"]
+    monkeypatch.setattr(servant, "get", get)
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(filled_item_ref.comp_cls)
+        item = await repo.get(id=row_id)
+        assert item
+        item.qty = 321
+        await repo.update(item)
+    updates = await broker.get_updates()
+    assert updates[sub_row][row_id]["qty"] == 321
+    assert "_version" not in updates[sub_row][row_id]
+
+    # 原子增量的行由lua脚本发布
+    async with backend.session("pytest", 1) as session:
+        session.using(filled_item_ref.comp_cls).increment(row_id, "qty", 9)
+    updates = await broker.get_updates()
+    assert updates[sub_row][row_id]["qty"] == 330
+
+    async with backend.session("pytest", 1) as session:
+        session.using(filled_item_ref.comp_cls).delete(row_id)
+    updates = await broker.get_updates()
+    assert updates[sub_row][row_id] is None
+    assert reads == []
+
+
+@use_redis_family_backend_only
+async def test_row_subscribe_payload_direct_set(
+    broker: SubscriptionBroker,
+    filled_rls_ref,
+    admin_ctx,
+    background_mq_puller_task,
+    monkeypatch,
+):
+    """测试开启ROW_CHANGE_PAYLOAD后，易失数据的direct_set也能通知到行订阅"""
+    from hetu.data.backend import BackendClient
+
+    monkeypatch.setattr(BackendClient, "ROW_CHANGE_PAYLOAD", True)
+    backend = broker._backend
+    sub_row, row = await broker.subscribe_get(filled_rls_ref, admin_ctx, "owner", 10)
+    assert sub_row and row
+    row_id = row["id"]
+
+    await backend.master.direct_set(filled_rls_ref, row_id, friend="9")
+    updates = await broker.get_updates()
+    assert updates[sub_row][row_id]["friend"] == 9
+    assert updates[sub_row][row_id]["owner"] == 10
+
+
 async def test_row_subscribe_cache(
     broker: SubscriptionBroker, filled_item_ref, admin_ctx, background_mq_puller_task
 ):
@@ -308,6 +548,227 @@ async def test_row_subscribe_cache(
     assert updates[sub_11_12][row1_id]["owner"] == 12  # query 11-12更新row数据
 
 
+async def test_shared_query_cache(monkeypatch):
+    """测试worker内共享的查询结果：通知之后开始的读取才能共享，进行中的读取合并"""
+    import asyncio
+
+    from hetu.data import subcache
+    from hetu.data.subcache import SharedQueryCache
+
+    cache = SharedQueryCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    # 同时到达的读取只执行一次
+    since = time.monotonic()
+    assert await asyncio.gather(*[cache.fetch("k", since, loader)] * 3) == [1, 1, 1]
+    assert len(calls) == 1
+    assert await cache.fetch("k", since, loader) == 1
+    # 有新的通知，结果已过期
+    assert await cache.fetch("k", time.monotonic(), loader) == 2
+
+    # 进行中的读取失败，等待者自己读取
+    async def broken():
+        await asyncio.sleep(0.01)
+        raise ConnectionError()
+
+    since = time.monotonic()
+    first = asyncio.create_task(cache.fetch("e", since, broken))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(cache.fetch("e", since, loader))
+    with pytest.raises(ConnectionError):
+        await first
+    assert await second == 3
+
+    monkeypatch.setattr(subcache, "SUBSCRIPTION_SHARED_CACHE_SIZE", 1)
+    await cache.fetch("k2", time.monotonic(), loader)
+    assert len(cache) == 1
+    monkeypatch.setattr(subcache, "SUBSCRIPTION_SHARED_CACHE_SIZE", 0)
+    await cache.fetch("k2", 0, loader)
+    assert len(calls) == 5
+
+
+async def test_subscribe_shared_reads(
+    broker: SubscriptionBroker, filled_item_ref, admin_ctx, user_id10_ctx
+):
+    """测试同一worker内多个连接订阅同一行时，变动后只读取一次"""
+    import asyncio
+
+    from hetu.data.sub import SHARED_QUERIES
+
+    backend = broker._backend
+    other = SubscriptionBroker(backend)
+    sub_a, _ = await broker.subscribe_get(filled_item_ref, admin_ctx, "name", "Itm10")
+    sub_b, _ = await other.subscribe_get(
+        filled_item_ref, user_id10_ctx, "name", "Itm10"
+    )
+    assert sub_a and sub_b
+
+    async def puller(b):
+        while True:
+            await b.mq_pull()
+
+    tasks = [asyncio.create_task(puller(b)) for b in (broker, other)]
+    try:
+        async with backend.session("pytest", 1) as session:
+            repo = session.using(filled_item_ref.comp_cls)
+            row = await repo.get(name="Itm10")
+            assert row
+            row.qty = 777
+            await repo.update(row)
+
+        # 等两个连接都收到通知
+        async with asyncio.timeout(5):
+            while not (broker._mq_client.pulled_set and other._mq_client.pulled_set):
+                await asyncio.sleep(0.01)
+        misses = SHARED_QUERIES.misses
+        updates_a, updates_b = await asyncio.gather(
+            broker.get_updates(), other.get_updates()
+        )
+        assert updates_a[sub_a][row.id]["qty"] == 777
+        assert updates_b[sub_b][row.id]["qty"] == 777
+        assert "_version" not in updates_a[sub_a][row.id]
+        assert SHARED_QUERIES.misses == misses + 1
+    finally:
+        for task in tasks:
+            task.cancel()
+        await other.close()
+
+
+def test_row_predicate(mod_item_model):
+    from hetu.data.predicate import RowPredicate
+
+    rows = mod_item_model.new_rows(4)
+    rows.qty = [0, 5, 10, 15]
+    rows.name = ["a", "b", "c", "d"]
+    pred = RowPredicate(mod_item_model, [["qty", ">", 0], ["name", "in", ["b", "d"]]])
+    assert pred.mask(rows).tolist() == [False, True, False, True]
+    dicts = [mod_item_model.struct_to_dict(row) for row in rows]
+    assert pred.mask_dicts(dicts).tolist() == [False, True, False, True]
+    assert str(pred) == "qty > 0 & name in ['b', 'd']"
+    # 可以无损转换的值照常使用
+    pred = RowPredicate(mod_item_model, [["qty", "==", 5.0], ["model", "<", 0.1]])
+    assert pred.mask(rows).tolist() == [False, True, False, False]
+
+    for where in (
+        [],
+        [["hp", ">", 0]],
+        [["qty", "=~", 0]],
+        [["qty", "in", 1]],
+        [["qty", ">", "abc"]],
+        [["qty", ">", 0]] * 9,
+        # 转换会丢失信息的值：int属性的小数，超过属性长度的字符串
+        [["qty", "<", 0.5]],
+        [["qty", "in", [1, 2.5]]],
+        [["name", "==", "a" * 9]],
+        [["name", "in", ["b", "a" * 9]]],
+    ):
+        with pytest.raises(ValueError):
+            RowPredicate(mod_item_model, where)
+
+
+async def test_subscribe_query(
+    broker: SubscriptionBroker, filled_item_ref, admin_ctx, background_mq_puller_task
+):
+    """测试带筛选条件的订阅，只推送符合条件的行和符合状态的变化"""
+    backend = broker._backend
+    where = [["time", ">=", 120], ["qty", ">", 0]]
+    sub_id, rows = await broker.subscribe_query(
+        filled_item_ref, admin_ctx, where, "owner", 10, limit=33
+    )
+    assert sub_id == "Item.owner[10:None:1][:33]?time >= 120 & qty > 0"
+    assert sorted(row["time"] for row in rows) == list(range(120, 135))
+    # 范围内所有行都要订阅，才能知道行变得符合条件
+    assert len(broker._subs[sub_id].channels) == 25 + 1
+    assert broker.count() == (0, 1)
+
+    async def update(by_time, **values):
+        async with backend.session("pytest", 1) as session:
+            repo = session.using(filled_item_ref.comp_cls)
+            row = await repo.get(time=by_time)
+            assert row
+            for k, v in values.items():
+                setattr(row, k, v)
+            await repo.update(row)
+            return int(row.id)
+
+    # 不再符合条件，推送删除
+    row_id = await update(120, qty=0)
+    updates = await broker.get_updates()
+    assert updates == {sub_id: {row_id: None}}
+
+    # 一直不符合条件的行，不推送
+    await update(110, qty=5)
+    assert await broker.get_updates(timeout=0.5) == {}
+
+    # 变得符合条件，推送该行
+    row_id = await update(111, time=140)
+    updates = await broker.get_updates()
+    assert updates[sub_id][row_id]["time"] == 140
+
+    # 符合条件的行更新，照常推送
+    await update(140, qty=7)
+    updates = await broker.get_updates()
+    assert updates[sub_id][row_id]["qty"] == 7
+
+
+async def test_subscribe_aoi(
+    broker: SubscriptionBroker, pos_ref, admin_ctx, background_mq_puller_task
+):
+    """测试AOI订阅，矩形移动和行移动时推送进出矩形的行"""
+    backend = broker._backend
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(pos_ref.comp_cls)
+        for i, (x, y) in enumerate([(1, 1), (12, 3), (25, 25), (-3, 8), (35, 5)]):
+            row = pos_ref.comp_cls.new_row()
+            row.owner = i
+            row.x, row.y = x, y
+            await repo.insert(row)
+    await backend.wait_for_synced()
+
+    with pytest.raises(ValueError):
+        await broker.subscribe_aoi(pos_ref, admin_ctx, 0, 0, 10, 100000)
+
+    sub_id, rows = await broker.subscribe_aoi(pos_ref, admin_ctx, -5, -5, 15, 15)
+    assert sub_id == "Position.aoi[1]"
+    assert sorted(row["owner"] for row in rows) == [0, 1, 3]
+    ids = {row["owner"]: row["id"] for row in rows}
+
+    # 移动矩形，只返回进出的行
+    updates = await broker.move_aoi(sub_id, 5, -5, 40, 15)
+    assert updates[ids[0]] is None
+    assert updates[ids[3]] is None
+    assert ids[1] not in updates
+    assert [row["owner"] for row in updates.values() if row] == [4]
+    with pytest.raises(ValueError):
+        await broker.move_aoi("Position.aoi[99]", 0, 0, 1, 1)
+
+    async def move(owner, x, y):
+        async with backend.session("pytest", 1) as session:
+            repo = session.using(pos_ref.comp_cls)
+            row = await repo.get(owner=owner)
+            row.x, row.y = x, y
+            await repo.update(row)
+            return int(row.id)
+
+    # 行走出矩形，推送删除
+    row_id = await move(1, 12, 30)
+    assert await broker.get_updates() == {sub_id: {row_id: None}}
+
+    # 矩形外的行移动，不推送
+    await move(2, 26, 26)
+    assert await broker.get_updates(timeout=0.5) == {}
+
+    # 行走进矩形，推送该行
+    row_id = await move(2, 20, 10)
+    updates = await broker.get_updates()
+    assert updates[sub_id][row_id]["x"] == 20
+
+
 async def test_cancel_subscribe(broker: SubscriptionBroker, filled_item_ref, admin_ctx):
     sub_row, _ = await broker.subscribe_get(filled_item_ref, admin_ctx, "name", "Itm10")
     sub_10, _ = await broker.subscribe_range(
@@ -622,3 +1083,51 @@ async def test_mq_backlog(
     monkeypatch.setattr(time, "time", lambda: time_time() + 210)
     notified_channels = await mq.get_message()
     assert len(notified_channels) == 2
+
+
+async def test_mq_event_driven_delivery(monkeypatch):
+    """测试get_message由pull唤醒，有消息立即返回，间隔内的消息合批"""
+    import asyncio
+
+    from hetu.data.backend import MQClient
+
+    class LocalMQ(MQClient):
+        def push(self, channel_name):
+            self.pulled_deque.add(time.time(), channel_name)
+            self.pulled_set.add(channel_name)
+            self._notify_pulled()
+
+    monkeypatch.setattr(MQClient, "UPDATE_FREQUENCY", 5)
+    mq = LocalMQ()
+
+    # 没消息时堵塞，不轮询
+    task = asyncio.create_task(mq.get_message())
+    await asyncio.sleep(0.05)
+    assert not task.done()
+
+    # 有消息立即返回
+    start = asyncio.get_running_loop().time()
+    mq.push("row{1}")
+    assert await task == {"row{1}"}
+    assert asyncio.get_running_loop().time() - start < 0.1
+
+    # 距上次返回不足1/UPDATE_FREQUENCY秒，等待间隔满，期间的消息合并返回
+    mq.push("row{2}")
+    task = asyncio.create_task(mq.get_message())
+    await asyncio.sleep(0.05)
+    assert not task.done()
+    mq.push("row{3}")
+    assert await task == {"row{2}", "row{3}"}
+    assert asyncio.get_running_loop().time() - start >= 0.2
+    assert not mq.pulled_deque and not mq.pulled_set
+
+    # 间隔已满时，BATCH_WINDOW内陆续到达的通知也一起返回
+    monkeypatch.setattr(MQClient, "BATCH_WINDOW", 0.05)
+    mq._last_delivery = 0.0
+    task = asyncio.create_task(mq.get_message())
+    await asyncio.sleep(0)
+    mq.push("row{4}")
+    await asyncio.sleep(0.01)
+    assert not task.done()
+    mq.push("row{5}")
+    assert await task == {"row{4}", "row{5}"}
@@ -249,7 +249,7 @@ async def test_general_worker_keeper_concurrent_claim_race(
     real_get_by_id = SessionRepository.get_by_id
     state = {"blinded": False}
 
-    async def get_by_id_blind_once(self, row_id):
+    async def get_by_id_blind_once(self, row_id, validate=True):
         if (
             not state["blinded"]
             and self.ref.comp_cls is WorkerLease
@@ -257,7 +257,7 @@ async def test_general_worker_keeper_concurrent_claim_race(
         ):
             state["blinded"] = True
             return None  # 假装没看到 winner 的行，制造 TOCTOU
-        return await real_get_by_id(self, row_id)
+        return await real_get_by_id(self, row_id, validate)
 
     monkeypatch.setattr(SessionRepository, "get_by_id", get_by_id_blind_once)
 
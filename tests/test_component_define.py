@@ -168,6 +168,44 @@ def test_str_max_len(new_component_env):
         TestStrLen.str_max_len("num")
 
 
+def test_spatial_define(new_component_env):
+    from hetu.data.spatial import CELL_FIELD
+
+    @define_component(namespace="pytest", force=True)
+    class TestPlain(BaseComponent):
+        x: np.float32 = property_field(0)
+
+    assert TestPlain.spatial_ is None
+    assert "spatial" not in TestPlain.json_
+
+    @define_component(namespace="pytest", force=True, spatial=("x", "y", 10))
+    class TestSpatial(BaseComponent):
+        x: np.float32 = property_field(0)
+        y: np.float32 = property_field(0)
+
+    grid = TestSpatial.spatial_
+    assert grid is not None
+    assert CELL_FIELD in TestSpatial.indexes_
+    # 副本也保留空间索引定义
+    assert TestSpatial.duplicate("pytest", "copy").spatial_.cell_size == 10
+
+    # 同一行格子的编码连续，负坐标也一样
+    assert grid.cell_of(-0.5, 5) + 1 == grid.cell_of(0, 5)
+    assert grid.cell_of(0, 5) < grid.cell_of(0, -5) + (1 << 33)
+    ranges = grid.box_ranges(-5, -5, 25, 5)
+    assert len(ranges) == 2
+    assert ranges[0] == (grid.cell_of(-5, -5), grid.cell_of(25, -5))
+    assert ranges[1] == (grid.cell_of(-5, 5), grid.cell_of(25, 5))
+    with pytest.raises(ValueError):
+        grid.box_ranges(0, 0, 10, 10000)
+
+    with pytest.raises(AssertionError, match="数字"):
+
+        @define_component(namespace="pytest", force=True, spatial=("x", "y", 10))
+        class TestSpatialBad(BaseComponent):
+            x: np.float32 = property_field(0)
+
+
 def test_keyword_define(new_component_env):
     with pytest.raises(ValueError, match="关键字"):
 
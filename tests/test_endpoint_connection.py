@@ -180,3 +180,20 @@ async def test_endpoint_permission_fail_closed(mod_test_app, tbl_mgr, new_ctx):
     assert executor.execute_check("ep_owner_sneaky", ()) is None
     # 对照：EVERYBODY 端点匿名可正常通过网关
     assert executor.execute_check("ep_public", ()) is not None
+
+
+async def test_executor_fork(mod_test_app, tbl_mgr, new_ctx):
+    ctx = new_ctx()
+    ctx.caller = 5
+    executor = EndpointExecutor("pytest", tbl_mgr, ctx)
+    forked = executor.fork()
+
+    # 副本的事务属性和System调用器独立，用户数据和行缓存共用
+    fctx = forked.context
+    assert fctx is not ctx and fctx.caller == 5
+    assert fctx.systems is not ctx.systems and fctx.systems.context is fctx
+    assert fctx.systems.row_cache is ctx.systems.row_cache
+    assert fctx.user_data is ctx.user_data
+    fctx.repo = {"x": 1}
+    assert ctx.repo == {}
+    assert forked.alive_checker is executor.alive_checker
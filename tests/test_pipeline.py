@@ -1,7 +1,10 @@
+import gc
 import hashlib
 import hmac
+import threading
 from typing import Any
 
+import msgspec
 import pytest
 from nacl.public import PrivateKey
 
@@ -91,6 +94,46 @@ def test_zstd_encode_decode_roundtrip(base_pipeline, mod_item_model):
     assert 0.5 > zstd_layer.encode_ratio > 0.1
 
 
+async def test_zstd_retrain_from_samples(base_pipeline, mod_item_model):
+    zstd_layer = pipeline.ZstdLayer(level=3, sample_rate=1.0, retrain_interval=0)
+    base_pipeline.add_layer(zstd_layer)
+    ctx, msg = base_pipeline.handshake([b""])
+    old_dict = zstd_layer.zstd_dict
+    assert old_dict is not None
+
+    # 采样实际发出的消息，并记录压缩比和耗时
+    for i in range(zstd_layer.MIN_SAMPLES):
+        row = mod_item_model.new_row(id_=i)
+        row.name = f"n{i}"
+        base_pipeline.encode(
+            ctx,
+            ["updt", "Item.id[1:None:1][:1]", {i: BaseComponent.struct_to_dict(row)}],
+        )
+    assert len(zstd_layer.samples) == zstd_layer.MIN_SAMPLES
+    assert zstd_layer.encode_time > 0
+
+    # 到期后的握手在后台训练，不阻塞
+    base_pipeline.handshake([b""])
+    assert zstd_layer._training is not None
+    await zstd_layer._training
+    new_dict = zstd_layer.zstd_dict
+    assert new_dict is not None and new_dict.dict_id != old_dict.dict_id
+    assert zstd_layer.samples == []
+    assert list(zstd_layer.dicts) == [old_dict.dict_id, new_dict.dict_id]
+
+    # 客户端缓存的旧字典还在，只回复dict_id；不认识的回复最新字典
+    old_id = old_dict.dict_id.to_bytes(4, "little")
+    _ctx, reply = zstd_layer.handshake(old_id)
+    assert reply == old_id
+    ctx_old, _reply = base_pipeline.handshake([old_id])
+    payload = {"id": 1, "name": "abc"}
+    assert base_pipeline.decode(ctx_old, base_pipeline.encode(ctx_old, payload)) == (
+        payload
+    )
+    _ctx, reply = zstd_layer.handshake((12345).to_bytes(4, "little"))
+    assert reply == new_dict.dict_content
+
+
 def test_zlib_encode_decode_roundtrip(base_pipeline, mod_item_model):
     zlib_layer = pipeline.ZlibLayer(level=6)
     base_pipeline.add_layer(zlib_layer)
@@ -121,6 +164,131 @@ def test_zlib_encode_decode_roundtrip(base_pipeline, mod_item_model):
     assert 0.5 > zlib_layer.encode_ratio > 0.1
 
 
+def test_context_memory_budget(base_pipeline):
+    zlib_layer = pipeline.ZlibLayer(level=6, memory_budget=300 * 1024)
+    base_pipeline.add_layer(zlib_layer)
+    # 第一个连接在预算内，第二个超出预算，使用较小的压缩窗口
+    ctx1, _ = base_pipeline.handshake([b""])
+    used = zlib_layer.budget.used
+    ctx2, _ = base_pipeline.handshake([b""])
+    assert zlib_layer.budget.reduced == 1
+    assert zlib_layer.budget.used - used < used
+
+    # 客户端解压不需要知道窗口大小
+    payload = ["rsp", {"data": "x" * 5000}]
+    for ctx in (ctx1, ctx2):
+        assert base_pipeline.decode(ctx, base_pipeline.encode(ctx, payload)) == payload
+
+    # 连接断开后释放
+    del ctx1, ctx2, ctx
+    gc.collect()
+    assert zlib_layer.budget.used == 0 and zlib_layer.budget.reduced == 0
+    # 释放后的预算可以再用，新连接不再降级
+    ctx3, _ = base_pipeline.handshake([b""])
+    assert zlib_layer.budget.reduced == 0
+    assert zlib_layer.budget.used == used
+    assert base_pipeline.decode(ctx3, base_pipeline.encode(ctx3, payload)) == payload
+
+
+def test_zstd_memory_budget(base_pipeline):
+    zstd_layer = pipeline.ZstdLayer(level=3, memory_budget=1)
+    base_pipeline.add_layer(zstd_layer)
+    ctx, _ = base_pipeline.handshake([b""])
+    assert zstd_layer.budget.reduced == 1
+    payload = ["rsp", {"data": "y" * 300_000}]
+    encoded = base_pipeline.encode(ctx, payload)
+    # 帧头的窗口描述符为reduced_window_log
+    assert (encoded[5] >> 3) + 10 == zstd_layer.reduced_window_log
+    assert base_pipeline.decode(ctx, encoded) == payload
+
+
+def test_shared_message_encoded_once(base_pipeline, mod_item_model, monkeypatch):
+    base_pipeline.add_layer(pipeline.ZlibLayer(level=6))
+    ctx1, _ = base_pipeline.handshake([b""])
+    ctx2, _ = base_pipeline.handshake([b""])
+
+    row = BaseComponent.struct_to_dict(mod_item_model.new_row(id_=123))
+    message = ["updt", "Item.id[123:None:1][:1]", {123: row}]
+    shared = pipeline.SharedMessage(message)
+
+    jsonb_layer = base_pipeline._layers[0]
+    calls = []
+    original = jsonb_layer.encode
+    monkeypatch.setattr(
+        jsonb_layer, "encode", lambda c, m: calls.append(m) or original(c, m)
+    )
+    # 每个连接的压缩流各自独立，但序列化只做一次
+    encoded1 = base_pipeline.encode(ctx1, shared)
+    encoded2 = base_pipeline.encode(ctx2, shared)
+    assert len(calls) == 1
+    expected = base_pipeline.decode(ctx1, encoded1)
+    assert expected == base_pipeline.decode(ctx2, encoded2)
+    assert expected[2] == {123: row}
+
+    # 之后的普通消息照常处理，压缩流不受影响
+    encoded = base_pipeline.encode(ctx1, message)
+    assert base_pipeline.decode(ctx1, encoded) == expected
+
+
+def test_buffer_handoff(base_pipeline):
+    jsonb_layer = base_pipeline._layers[0]
+    # jsonb层返回内部缓冲区的memoryview，不复制
+    view = jsonb_layer.encode(None, ["rsp", "ok"])
+    assert isinstance(view, memoryview)
+    assert view.obj is jsonb_layer.buffer
+    # 结果还被引用时，不能覆盖，换新的缓冲区
+    other = jsonb_layer.encode(None, ["rsp", "a much longer message"])
+    assert bytes(view) == pipeline.JSONBinaryLayer().msg_encoder.encode(["rsp", "ok"])
+    assert other.obj is not view.obj
+    del view, other
+
+    # 经过压缩和加密层，管道的输入输出都可以是buffer
+    base_pipeline.add_layer(pipeline.ZlibLayer(level=6))
+    ctx, _ = base_pipeline.handshake([b""])
+    encoded = base_pipeline.encode(ctx, ["rsp", {"a": 1}])
+    assert type(encoded) is bytes
+    assert base_pipeline.decode(ctx, memoryview(bytearray(encoded))) == [
+        "rsp",
+        {"a": 1},
+    ]
+
+
+async def test_encode_async_offload(base_pipeline, monkeypatch):
+    zlib_layer = pipeline.ZlibLayer(level=6)
+    base_pipeline.add_layer(zlib_layer)
+    ctx, _ = base_pipeline.handshake([b""])
+    monkeypatch.setattr(pipeline.MessagePipeline, "OFFLOAD_THRESHOLD", 1024)
+
+    threads = []
+    original = zlib_layer.encode
+    monkeypatch.setattr(
+        zlib_layer,
+        "encode",
+        lambda c, m: threads.append(threading.current_thread()) or original(c, m),
+    )
+    # 小消息在事件循环中压缩，大消息在线程池中压缩，流式压缩的顺序不变
+    messages = [["rsp", "small"], ["rsp", "x" * 4096], ["rsp", "small again"]]
+    encoded = [await base_pipeline.encode_async(ctx, m) for m in messages]
+    assert threads[0] is threading.main_thread()
+    assert threads[1].name.startswith("HeTuPipeline")
+    assert threads[2] is threading.main_thread()
+    assert [base_pipeline.decode(ctx, e) for e in encoded] == messages
+
+    # 共享消息也只序列化一次
+    shared = pipeline.SharedMessage(["updt", "Item.id[1:None:1][:1]", {1: "y" * 4096}])
+    encoded = await base_pipeline.encode_async(ctx, shared)
+    assert base_pipeline.decode(ctx, encoded) == shared.message
+    assert len(shared.encoded) == 1
+    assert zlib_layer.encode_count == 4
+
+    # worker退出时关闭线程池，之后再用会重新创建
+    pipeline.MessagePipeline.shutdown_offload()
+    assert pipeline.MessagePipeline._offload_pool is None
+    encoded = await base_pipeline.encode_async(ctx, messages[1])
+    assert base_pipeline.decode(ctx, encoded) == messages[1]
+    pipeline.MessagePipeline.shutdown_offload()
+
+
 def test_brotli_encode_decode_roundtrip(base_pipeline, mod_item_model):
     brotli_layer: BrotliLayer = pipeline.BrotliLayer(quality=4)
     base_pipeline.add_layer(brotli_layer)
@@ -225,3 +393,53 @@ def test_crypto_handshake_ignores_signed_key_when_server_has_no_auth_key():
     ctx, server_pub = layer.handshake(hello)
     assert isinstance(ctx, pipeline.CryptoLayer.CryptoContext)
     assert len(server_pub) == 32
+
+
+def test_columnar_layer(base_pipeline, mod_item_model):
+    from hetu.server.pipeline.columnar import ROW_EXT, ROWS_EXT
+
+    pipe = pipeline.MessagePipeline()
+    columnar = pipeline.ColumnarLayer()
+    pipe.add_layer(columnar)
+    pipe.add_layer(pipeline.JSONBinaryLayer())
+    pipe.add_layer(pipeline.ZlibLayer(level=1))
+    # 握手回复schema表，旧客户端发送空消息则不生效
+    ctx_new, _ = pipe.handshake([b"1", b""])
+    ctx_old, _ = pipe.handshake([b"", b""])
+    schemas = msgspec.msgpack.decode(columnar.schema_message)
+    assert [name for name, _fields in schemas].index("Item") == columnar.schema_ids[
+        "Item"
+    ]
+
+    rows = []
+    for i in range(50):
+        row = mod_item_model.new_row(id_=1_000_000 + i)
+        row.owner, row.model, row.time, row.name = 1234567, 1.5, 1760000000000, f"i{i}"
+        rows.append(BaseComponent.struct_to_dict(row))
+        del rows[-1]["_version"]
+    sub = ["sub", "Item.owner[1:None:1][:50]", rows]
+    packed = columnar.encode(True, sub)
+    assert type(packed[2]) is msgspec.msgpack.Ext and packed[2].code == ROWS_EXT
+    assert sub[2] is rows
+    plain_size = len(pipeline.JSONBinaryLayer().msg_encoder.encode(sub))
+    assert len(pipeline.JSONBinaryLayer().msg_encoder.encode(packed)) < plain_size
+
+    # 属性不全的差量行保持原样，删除为None
+    delta = ["delt", "Item.id[1:None:1][:1]", {1: rows[1], 2: {"qty": 3}, 3: None}]
+    packed = columnar.encode(True, delta)
+    assert packed[2][1].code == ROW_EXT
+    assert packed[2][2] == {"qty": 3} and packed[2][3] is None
+
+    # 经过完整管道后还原，不认识的消息原样通过
+    for message in (sub, delta, ["bat", [sub, delta]], ["rsp", {"a": 1}]):
+        assert pipe.decode(ctx_new, pipe.encode(ctx_new, message)) == message
+        assert pipe.decode(ctx_old, pipe.encode(ctx_old, message)) == message
+
+    # 共享消息按列式握手结果分别编码
+    shared = pipeline.SharedMessage(sub)
+    pipe.encode(ctx_new, shared)
+    pipe.encode(ctx_new, shared)
+    pipe.encode(ctx_old, shared)
+    assert len(shared.encoded) == 2
+    # until对共享消息同样生效
+    assert pipe.encode(ctx_new, shared, until=1) == pipe.encode(ctx_new, sub, until=1)
@@ -9,7 +9,12 @@ import numpy as np
 from types import SimpleNamespace
 
 from hetu.data import BaseComponent, Permission, define_component, property_field
-from hetu.sourcegen.csharp import generate_component, generate_all_components
+from hetu.server.pipeline.columnar import row_dtype
+from hetu.sourcegen.csharp import (
+    generate_all_components,
+    generate_component,
+    generate_row_struct,
+)
 from hetu.system import SystemClusters
 
 
@@ -161,3 +166,30 @@ def test_generate_all_components_dedup_duplicates(tmp_path, monkeypatch):
     assert "ChatMessage:Universe" not in code
     # 只输出一个干净的 master 类
     assert code.count("public class ChatMessage : IBaseComponent") == 1
+
+
+def test_row_struct_csharp_gen():
+    @define_component(namespace="HeTu", volatile=True, force=True)
+    class RowComponent(BaseComponent):
+        owner: np.int64 = property_field(0)
+        name: "U4" = property_field("")  # noqa: F821
+        half: np.float16 = property_field(0.0)
+        used: bool = property_field(False)
+
+    code = "\n".join(generate_row_struct(RowComponent))
+
+    # 字段顺序和大小与服务器列式格式的行结构一致，不含_version
+    expect = """
+[StructLayout(LayoutKind.Sequential, Pack = 1)]
+public unsafe struct RowComponentRow
+{
+    public const int Size = 35;
+    public ushort Half;
+    public long ID;
+    public fixed uint Name[4];
+    public long Owner;
+    public sbyte Used;
+}
+"""
+    assert code == expect
+    assert row_dtype(RowComponent).itemsize == 2 + 8 + 16 + 8 + 1
@@ -164,6 +164,47 @@ async def test_get_race_condition(
     assert direct_caller.context.race_count == 0
 
 
+async def test_race_hot_key_report(
+    mod_test_app, tbl_mgr, executor: EndpointExecutor, new_ctx
+):
+    # 测试冲突key统计和监控回调
+    import asyncio
+
+    from hetu.system.caller import SLOW_LOG, SystemCaller
+
+    races = []
+
+    def hook(sys_name, race):
+        races.append((sys_name, race.key, race.check))
+        raise ValueError("回调异常不应影响System调用")
+
+    SLOW_LOG.clear()
+    SLOW_LOG.set_metrics_hook(hook)
+    try:
+        direct_caller = SystemCaller("pytest", tbl_mgr, new_ctx())
+        await asyncio.gather(
+            executor.execute("race_upsert", 0.4),
+            direct_caller.call("race_upsert", 0.1),
+        )
+    finally:
+        SLOW_LOG.set_metrics_hook(None)
+
+    assert len(races) == 1
+    sys_name, key, check = races[0]
+    assert sys_name == "race_upsert"
+    assert key is not None and check is not None
+    hot = SLOW_LOG.hot_keys()
+    assert len(hot) == 1
+    assert hot[0][0] == key
+    assert hot[0][1].count == 1
+    assert hot[0][1].checks == {check: 1}
+    assert hot[0][1].systems == {"race_upsert": 1}
+    assert key in str(SLOW_LOG)
+
+    SLOW_LOG.clear()
+    assert SLOW_LOG.hot_keys() == []
+
+
 async def test_range_race_condition(mod_test_app, tbl_mgr, executor, new_ctx):
     from hetu.system.caller import SystemCaller
     from hetu.system.context import SystemContext
@@ -0,0 +1,207 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from hetu.common.snowflake_id import SnowflakeID
+from hetu.system import hotkey
+from hetu.system.hotkey import HotKeyGate
+
+SnowflakeID().init(1, 0)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    _clock = FakeClock()
+    monkeypatch.setattr(hotkey, "time", SimpleNamespace(monotonic=_clock))
+    return _clock
+
+
+@pytest.fixture
+def gate(monkeypatch, clock):
+    monkeypatch.setattr(hotkey, "HOT_KEY_CONFLICT_RATE", 0.3)
+    monkeypatch.setattr(hotkey, "HOT_KEY_MIN_CONFLICTS", 3)
+    return HotKeyGate()
+
+
+def test_hot_key_detect(gate):
+    # 冲突次数不够，不算热点
+    gate.record("sys", ["boss", "player1"], conflict=True)
+    gate.record("sys", ["boss", "player2"], conflict=True)
+    assert not gate.is_hot("boss")
+    assert gate.hot_keys("sys") == []
+
+    # 冲突率达标
+    gate.record("sys", ["boss", "player3"], conflict=True)
+    assert gate.is_hot("boss")
+    assert not gate.is_hot("player3")
+    assert gate.hot_keys("sys") == ["boss"]
+    assert gate.hot_keys("other_sys") == []
+
+    # 成功提交只更新已统计的行
+    gate.record("sys", ["boss", "player4"], conflict=False)
+    assert "player4" not in gate._stats
+
+    # 串行化后冲突消失，冲突率下降也要保持热点（滞后区间），防止震荡
+    for _ in range(20):
+        gate.record("sys", ["boss"], conflict=False)
+    assert gate.is_hot("boss")
+
+
+def test_hot_key_cool_down(gate, clock):
+    for _ in range(4):
+        gate.record("sys", ["boss"], conflict=True)
+    assert gate.hot_keys("sys") == ["boss"]
+
+    # 冲突下降后退回乐观并发，并清理统计
+    clock.now += hotkey.HOT_KEY_HALF_LIFE * 2
+    gate.record("sys", ["boss"], conflict=False)
+    assert not gate.is_hot("boss")
+    assert gate.hot_keys("sys") == []
+    clock.now += hotkey.HOT_KEY_HALF_LIFE * 10
+    gate.record("sys", [], conflict=False)
+    assert not gate.tracking
+    assert not gate._sys_keys
+
+
+def test_hot_key_disabled(gate, monkeypatch):
+    monkeypatch.setattr(hotkey, "HOT_KEY_CONFLICT_RATE", 0)
+    for _ in range(10):
+        gate.record("sys", ["boss"], conflict=True)
+    assert not gate.tracking
+
+
+async def test_hot_key_serialize(gate):
+    for _ in range(3):
+        gate.record("sys", ["boss"], conflict=True)
+
+    running = 0
+    max_running = 0
+    order = []
+
+    async def call(i):
+        nonlocal running, max_running
+        lease = await gate.acquire("sys")
+        try:
+            running += 1
+            max_running = max(max_running, running)
+            order.append(i)
+            await asyncio.sleep(0.01)
+            # 嵌套调用同一热点行不会锁死
+            inner = await gate.acquire("sys")
+            assert not inner.locks
+            inner.release()
+            running -= 1
+        finally:
+            lease.release()
+            lease.release()  # 可重复调用
+
+    await asyncio.gather(*[call(i) for i in range(5)])
+    assert max_running == 1
+    assert order == list(range(5))  # FIFO
+
+    # 释放后，同一协程再次调用要重新排队
+    lease = await gate.acquire("sys")
+    assert len(lease.locks) == 1
+    lease.release()
+
+    # 非热点System不排队
+    lease = await gate.acquire("other_sys")
+    assert not lease.locks
+
+
+async def test_hot_key_nested_crossed(gate):
+    """两个System互相嵌套调用，热点行交叉，加锁顺序要全局一致，不能死锁"""
+    for _ in range(3):
+        gate.record("sys_x", ["x"], conflict=True)
+        gate.record("sys_y", ["y"], conflict=True)
+
+    async def call(outer, inner):
+        lease = await gate.acquire(outer)
+        try:
+            await asyncio.sleep(0.01)
+            nested = await gate.acquire(inner)
+            rtn = [len(lease.locks), len(nested.locks)]
+            nested.release()
+            return rtn
+        finally:
+            lease.release()
+
+    results = await asyncio.wait_for(
+        asyncio.gather(call("sys_x", "sys_y"), call("sys_y", "sys_x")), 1
+    )
+    # 已持有y时，排在前面的x不排队，退回乐观并发
+    assert results == [[1, 1], [1, 0]]
+
+
+async def test_hot_key_prune_handed_lock(gate, clock):
+    """锁交给等待者、等待者还没运行时，清理不能删掉这把锁"""
+    for _ in range(3):
+        gate.record("sys", ["boss"], conflict=True)
+    # 在各自的task中获取，不然会继承当前协程持有的行
+    release = asyncio.Event()
+
+    async def holder():
+        lease = await gate.acquire("sys")
+        await release.wait()
+        lease.release()
+
+    holding = asyncio.create_task(holder())
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(gate.acquire("sys"))
+    await asyncio.sleep(0)
+    lock = gate._locks["boss"]
+    assert lock._waiters
+
+    # 热点已冷却，持有者释放后立即清理
+    clock.now += hotkey.HOT_KEY_HALF_LIFE * 10
+    release.set()
+    await asyncio.sleep(0)
+    assert holding.done()
+    assert not lock.locked() and not waiter.done()
+    gate._prune(clock.now)
+    assert gate._locks.get("boss") is lock
+    assert len((await waiter).locks) == 1
+
+
+async def test_hot_key_system_caller(
+    mod_test_app, tbl_mgr, executor, new_ctx, monkeypatch
+):
+    """测试SystemCaller在热点行上串行化后，调用都能成功"""
+    from hetu.system.caller import HOT_KEYS, SystemCaller
+
+    monkeypatch.setattr(hotkey, "HOT_KEY_MIN_CONFLICTS", 2)
+    HOT_KEYS.clear()
+
+    ok, _ = await executor.execute("login", 1234)
+    assert ok
+    ok, _ = await executor.execute("create_row", 3, 0, "a")
+    assert ok
+
+    callers = [SystemCaller("pytest", tbl_mgr, new_ctx()) for _ in range(6)]
+    await asyncio.gather(
+        *[
+            caller.call("race_range", 0.05 + i / 1000)
+            for i, caller in enumerate(callers)
+        ]
+    )
+    assert sum(caller.context.race_count for caller in callers) > 0
+    assert HOT_KEYS.hot_keys("race_range")
+
+    # 热点行已串行化，不再竞态
+    await asyncio.gather(
+        *[
+            caller.call("race_range", 0.01 + i / 1000)
+            for i, caller in enumerate(callers)
+        ]
+    )
+    assert sum(caller.context.race_count for caller in callers) == 0
+    HOT_KEYS.clear()
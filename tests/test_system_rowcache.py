@@ -0,0 +1,181 @@
+import pytest
+
+from hetu.common.snowflake_id import SnowflakeID
+from hetu.system import rowcache
+from hetu.system.rowcache import ConnectionRowCache
+
+SnowflakeID().init(1, 0)
+
+
+@pytest.fixture
+def cache_on(monkeypatch):
+    monkeypatch.setattr(rowcache, "CONNECTION_ROW_CACHE_SIZE", 100)
+
+
+@pytest.fixture
+def warm_hits(monkeypatch):
+    """统计各缓存的命中次数"""
+    hits = {}
+    real_get = ConnectionRowCache.get
+
+    def get(self, table_ref, row_id):
+        row = real_get(self, table_ref, row_id)
+        if row is not None:
+            hits.setdefault(id(self), []).append(row_id)
+        return row
+
+    monkeypatch.setattr(ConnectionRowCache, "get", get)
+    return hits
+
+
+async def test_row_cache_reuse(
+    cache_on, warm_hits, mod_test_app, tbl_mgr, executor, new_ctx
+):
+    from hetu.system.caller import SystemCaller
+
+    ok, _ = await executor.execute("login", 1234)
+    assert ok
+    ok, _ = await executor.execute("create_row", 3, 0, "a")
+    assert ok
+
+    caller = SystemCaller("pytest", tbl_mgr, new_ctx())
+    hits = warm_hits.setdefault(id(caller.row_cache), [])
+    await caller.call("race_upsert", 0.01)
+    assert len(caller.row_cache) == 1
+    assert hits == []
+
+    # 第二次调用直接使用缓存的行，提交的版本检查通过
+    await caller.call("race_upsert", 0.02)
+    assert len(hits) == 1
+    assert caller.context.race_count == 0
+
+    # 其他连接修改了该行，缓存过期，提交时冲突，重试时从数据库重新读取
+    ok, _ = await executor.execute("race_upsert", 0.03)
+    assert ok
+    await caller.call("race_upsert", 0.04)
+    assert caller.context.race_count == 1
+    assert len(hits) == 2
+
+    # 重试后缓存的是最新的值
+    await caller.call("race_upsert", 0.05)
+    assert caller.context.race_count == 0
+    assert len(hits) == 3
+
+
+async def test_row_cache_disabled(warm_hits, mod_test_app, tbl_mgr, executor, new_ctx):
+    from hetu.system.caller import SystemCaller
+
+    ok, _ = await executor.execute("login", 1234)
+    assert ok
+    ok, _ = await executor.execute("create_row", 3, 0, "a")
+    assert ok
+
+    caller = SystemCaller("pytest", tbl_mgr, new_ctx())
+    await caller.call("race_upsert", 0.01)
+    await caller.call("race_upsert", 0.02)
+    assert len(caller.row_cache) == 0
+    assert warm_hits == {}
+
+
+def test_row_cache_bounded(cache_on, monkeypatch, mod_item_model):
+    from hetu.data.backend.idmap import IdentityMap
+    from hetu.data.backend.table import TableReference
+
+    monkeypatch.setattr(rowcache, "CONNECTION_ROW_CACHE_SIZE", 2)
+    item_ref = TableReference(mod_item_model, "pytest", 1)
+    cache = ConnectionRowCache()
+
+    idmap = IdentityMap()
+    rows = mod_item_model.new_rows(3)
+    rows.id = [1, 2, 3]
+    rows._version = [5, 5, 5]
+    idmap.add_clean(item_ref, rows)
+    # 修改的行版本+1，删除的行移出缓存
+    row, _ = idmap.get(item_ref, 2)
+    assert row is not None
+    row = row.copy()
+    row.qty = 10
+    idmap.update(item_ref, row)
+    cache.store(idmap)
+    assert len(cache) == 2  # 超出上限，淘汰最旧的
+    assert cache.get(item_ref, 1) is None
+    cached = cache.get(item_ref, 2)
+    assert cached is not None
+    assert cached._version == 6 and cached.qty == 10
+    assert cache.get(item_ref, 3)._version == 5
+
+    idmap = IdentityMap()
+    idmap.warm = cache.get
+    assert idmap.take_warm(item_ref, 3) is not None
+    assert idmap.has_warm_hits
+    idmap.mark_deleted(item_ref, 3)
+    cache.store(idmap)
+    assert cache.get(item_ref, 3) is None
+
+    # 订阅通知清除缓存
+    cache.invalidate(item_ref, [2])
+    assert len(cache) == 0
+
+
+async def test_row_cache_read_only_validate(cache_on, item_ref, mod_auto_backend):
+    from hetu.data.backend import RaceCondition
+
+    backend = mod_auto_backend()
+    cache = ConnectionRowCache()
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(item_ref.comp_cls)
+        row = item_ref.comp_cls.new_row()
+        row.owner = 1
+        row.name = "Cached"
+        await repo.insert(row)
+        row_id = int(row.id)
+
+    # 读取并缓存
+    async with backend.session("pytest", 1) as session:
+        idmap = session.idmap
+        assert await session.using(item_ref.comp_cls).get(id=row_id) is not None
+    cache.store(idmap)
+
+    # 只读事务用到未过期的缓存行，提交通过
+    async with backend.session("pytest", 1) as session:
+        cache.attach(session.idmap)
+        cached = await session.using(item_ref.comp_cls).get(id=row_id)
+        assert cached is not None and cached.name == "Cached"
+        assert session.idmap.has_warm_hits
+
+    async with backend.session("pytest", 1) as session:
+        repo = session.using(item_ref.comp_cls)
+        row = await repo.get(id=row_id)
+        assert row is not None
+        row.owner = 2
+        await repo.update(row)
+
+    # 缓存行已过期，只读事务也要冲突
+    with pytest.raises(RaceCondition):
+        async with backend.session("pytest", 1) as session:
+            cache.attach(session.idmap)
+            assert await session.using(item_ref.comp_cls).get(id=row_id) is not None
+
+
+async def test_row_cache_skip_volatile(cache_on, filled_rls_ref, mod_auto_backend):
+    """易失数据会被direct_set修改且不增加版本，不能缓存"""
+    backend = mod_auto_backend()
+    cache = ConnectionRowCache()
+    comp_cls = filled_rls_ref.comp_cls
+
+    async with backend.session("pytest", 1) as session:
+        idmap = session.idmap
+        row = await session.using(comp_cls).get(owner=10)
+        assert row is not None and row.friend == 11
+        row.friend = 12
+        await session.using(comp_cls).update(row)
+    cache.store(idmap)
+    assert len(cache) == 0
+
+    await backend.master.direct_set(filled_rls_ref, row.id, friend="9")
+    async with backend.session("pytest", 1) as session:
+        cache.attach(session.idmap)
+        row = await session.using(comp_cls).get(id=row.id)
+        assert row is not None and row.friend == 9
+        assert not session.idmap.has_warm_hits
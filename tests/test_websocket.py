@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import os
+from types import SimpleNamespace
 from typing import Callable, cast
 
 import pytest
@@ -10,6 +11,7 @@ from nacl.public import PrivateKey
 from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
 
 from hetu.endpoint.definer import EndpointDefines
+from hetu.endpoint.response import ResponseToClient
 from hetu.safelogging.default import DEFAULT_LOGGING_CONFIG
 from hetu.server import pipeline, worker_main
 from hetu.server import websocket as websocket_server
@@ -363,3 +365,140 @@ def test_call_flooding_lv2_flooding(test_server):
                     await asyncio.sleep(1)
 
     test_server.test_client.websocket("/hetu/pytest_1", mimic=flooding_routine_lv2)
+
+
+async def test_push_coalescing(monkeypatch):
+    """测试合批推送：空闲时立即发送，有堆积时收集窗口内的消息一起发送"""
+    queue = asyncio.Queue()
+    await queue.put(["rsp", 1])
+    await queue.put(["rsp", 2])
+    # 关闭时一条一条发送
+    assert await websocket_server.next_pushes(queue) == [["rsp", 1]]
+
+    monkeypatch.setattr(websocket_server, "PUSH_COALESCE_WINDOW", 0.05)
+    monkeypatch.setattr(websocket_server, "PUSH_COALESCE_MAX", 3)
+    # 只有一条时不等待
+    assert await websocket_server.next_pushes(queue) == [["rsp", 2]]
+
+    # 有堆积时，等待窗口内的后续消息，最多PUSH_COALESCE_MAX条
+    for i in range(2):
+        await queue.put(["updt", i])
+    asyncio.get_running_loop().call_later(0.01, queue.put_nowait, ["updt", 2])
+    asyncio.get_running_loop().call_later(0.02, queue.put_nowait, ["updt", 3])
+    batch = await websocket_server.next_pushes(queue)
+    assert batch == [["updt", 0], ["updt", 1], ["updt", 2]]
+    assert await websocket_server.next_pushes(queue) == [["updt", 3]]
+
+
+def test_shared_push():
+    """测试不同连接推送同一批行对象时，合并为同一个共享消息"""
+    from hetu.server import receiver
+
+    row = {"id": 1, "value": 5}
+    shared = receiver.shared_push("updt", "Comp.id[1:None:1][:1]", {1: row})
+    same = receiver.shared_push("updt", "Comp.id[1:None:1][:1]", {1: row})
+    assert same is shared
+    assert shared.message == ["updt", "Comp.id[1:None:1][:1]", {1: row}]
+    # 内容相同但不是同一个行对象，不能确定没被修改，不合并
+    other = receiver.shared_push("updt", "Comp.id[1:None:1][:1]", {1: dict(row)})
+    assert other is not shared
+    assert receiver.shared_push("delt", "Comp.id[1:None:1][:1]", {1: row}) is not shared
+
+
+class FakeExecutor:
+    """
+    记录同时执行数的假Endpoint执行器，调用参数为sleep秒数，返回Endpoint名。
+    fork出的副本共用计数，在副本上执行的Endpoint名记在 `forked` 中
+    """
+
+    def __init__(self, root=None):
+        self.context = None
+        self.root = root or self
+        self.running = 0
+        self.peak = 0
+        self.forked = []
+
+    def fork(self):
+        return FakeExecutor(self.root)
+
+    async def execute(self, endpoint, delay=0):
+        if endpoint == "illegal":
+            return False, None
+        root = self.root
+        if self is not root:
+            root.forked.append(endpoint)
+        root.running += 1
+        root.peak = max(root.peak, root.running)
+        await asyncio.sleep(delay)
+        root.running -= 1
+        return True, ResponseToClient([endpoint])
+
+
+async def test_concurrent_calls(monkeypatch):
+    """测试带请求id的调用并发执行，ordered的调用保持顺序"""
+    from hetu.server import receiver
+
+    monkeypatch.setattr(receiver, "RPC_CONCURRENCY", 2)
+    ws = SimpleNamespace(fail_connection=lambda: pytest.fail("连接不应断开"))
+    executor = FakeExecutor()
+    queue = asyncio.Queue()
+    scheduler = receiver.RpcScheduler(ws, executor, queue)  # type: ignore
+
+    # 慢的调用不阻塞后面的调用，回复带上请求id
+    assert await scheduler.call(["call", 1, False, "slow", 0.05])
+    assert await scheduler.call(["call", 2, False, "fast", 0])
+    # 超过并发数时等待空位
+    assert await scheduler.call(["call", 3, True, "first", 0.01])
+    assert await scheduler.call(["call", 4, True, "second", 0])
+    await asyncio.gather(*scheduler._tasks)
+    replies = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert replies.index(["rsp", ["fast"], 2]) < replies.index(["rsp", ["slow"], 1])
+    assert replies.index(["rsp", ["first"], 3]) < replies.index(["rsp", ["second"], 4])
+    assert executor.peak <= 2
+    # 不要求顺序的调用用Context副本执行，ordered的调用用连接的Context
+    assert sorted(executor.forked) == ["fast", "slow"]
+
+    # 关闭时只能逐个执行，照样带上请求id
+    monkeypatch.setattr(receiver, "RPC_CONCURRENCY", 0)
+    assert await scheduler.call(["call", 5, False, "inline", 0])
+    assert queue.get_nowait() == ["rsp", ["inline"], 5]
+    assert not scheduler._tasks
+    assert "inline" not in executor.forked
+
+
+async def test_batch_calls(monkeypatch):
+    """测试batch消息的调用合为一条回复，回复顺序和调用顺序一致"""
+    from hetu.server import receiver
+
+    monkeypatch.setattr(receiver, "RPC_CONCURRENCY", 2)
+    ws = SimpleNamespace(fail_connection=lambda: pytest.fail("连接不应断开"))
+    executor = FakeExecutor()
+    queue = asyncio.Queue()
+    scheduler = receiver.RpcScheduler(ws, executor, queue)  # type: ignore
+
+    calls = receiver.batch_calls(["batch", True, [["slow", 0.02], ["fast", 0]]])
+    assert await scheduler.batch(True, calls)
+    assert queue.get_nowait() == ["bat", [["rsp", ["slow"]], ["rsp", ["fast"]]]]
+    assert executor.peak == 2
+    assert sorted(executor.forked) == ["fast", "slow"]
+
+    executor.peak = 0
+    executor.forked.clear()
+    assert await scheduler.batch(False, calls)
+    assert queue.get_nowait() == ["bat", [["rsp", ["slow"]], ["rsp", ["fast"]]]]
+    assert executor.peak == 1
+    assert not executor.forked
+
+    # 没开启并发时，concurrent的batch也按顺序用连接的Context执行
+    monkeypatch.setattr(receiver, "RPC_CONCURRENCY", 0)
+    assert await scheduler.batch(True, calls)
+    assert queue.get_nowait() == ["bat", [["rsp", ["slow"]], ["rsp", ["fast"]]]]
+    assert executor.peak == 1
+    assert not executor.forked
+
+    # 有非法调用时整批失败，不回复
+    assert not await scheduler.batch(False, [["fast", 0], ["illegal"]])
+    assert queue.empty()
+    for bad in ([], [[]], [[1]], [["fast", 0]] * (receiver.MAX_BATCH_CALLS + 1)):
+        with pytest.raises(ValueError):
+            receiver.batch_calls(["batch", False, bad])